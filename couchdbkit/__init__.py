@@ -31,8 +31,13 @@ all_by_module = {
                                 'NoResultFound', 'ReservedWordError', 
                                 'DocsPathNotFound'],
     'couchdbkit.client':        ['Server', 'Database', 'ViewResults',
-                                'View', 'TempView'],
-    'couchdbkit.loaders':       ['BaseDocsLoader', 'FileSystemDocsLoader'],
+                                'View', 'TempView', 'Row', 'MultiQuery', 
+                                'Paginator', 'Page'],
+    'couchdbkit.cache':         ['LRUCache', 'ViewCache', 'DocumentCache'],
+    'couchdbkit.bloom':         ['BloomFilter', 'DocIdFilter'],
+    'couchdbkit.localview':     ['LocalView'],
+    'couchdbkit.loaders':       ['BaseDocsLoader', 'FileSystemDocsLoader',
+                                'UpdateHandlersLoader'],
     'couchdbkit.schema':        ['Property', 'StringProperty', 'IntegerProperty', 
                                 'DecimalProperty', 'BooleanProperty', 'FloatProperty', 
                                 'DateTimeProperty', 'DateProperty', 'TimeProperty', 
@@ -41,11 +46,13 @@ all_by_module = {
                                 'convert_property', 'DocumentSchema', 'DocumentBase', 
                                 'QueryMixin', 'AttachmentMixin', 'Document', 'StaticDocument',
                                 'SchemaProperty', 'ListProperty', 'DictProperty', 
-                                'StringListProperty', 'contain']
+                                'StringListProperty', 'contain', 'Session',
+                                'wrap_any']
                             
 }
 
-attribute_modules = dict.fromkeys(['exceptions', 'resource', 'client', 'schema'])
+attribute_modules = dict.fromkeys(['exceptions', 'resource', 'client', 'schema',
+                                'cache', 'localview', 'bloom'])
 
 object_origins = {}
 for module, items in all_by_module.iteritems():
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008-2009 Benoit Chesneau <benoitc@e-engura.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Bloom filter of document ids. It answers "maybe" or "no" to the question
+"does this document exist ?" without asking the database:
+
+    >>> from couchdbkit.bloom import DocIdFilter
+    >>> db.id_filter = DocIdFilter(db, capacity=5000000, path='/var/tmp/ids.bloom')
+    >>> 'someid' in db  # no request if 'someid' is definitely missing
+
+The filter is built from `_all_docs` and updated from the `_changes` feed
+at most every `refresh_interval` seconds, and with documents saved by the
+database object. Documents created by other clients since the last
+refresh could be reported missing.
+"""
+
+from hashlib import md5
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+import anyjson
+
+__all__ = ['BloomFilter', 'DocIdFilter']
+
+MAGIC = 'CKBF'
+HEADER_SIZE = 4096
+_HEADER = struct.Struct('<4sHQHI')
+
+class BloomFilter(object):
+    """ Bloom filter stored in a memory map, anonymous or backed by a
+    file. The file starts with a header of 4096 bytes containing the size
+    of the filter and some metadata (a JSON value). """
+
+    def __init__(self, capacity=1000000, error_rate=0.01, path=None):
+        """
+        @param capacity: int, expected number of items
+        @param error_rate: float, wanted false positive rate at capacity
+        @param path: str, path of the file used to persist the filter.
+        ValueError is raised if it exists and isn't a filter with the
+        same capacity and error rate.
+        """
+        self.nbits = int(math.ceil(-capacity * math.log(error_rate) /
+            (math.log(2) ** 2)))
+        self.nhashes = max(int(round(self.nbits * math.log(2) / capacity)), 1)
+        self.path = path
+        self.metadata = None
+        size = HEADER_SIZE + (self.nbits + 7) // 8
+
+        self._file = None
+        if path is None:
+            self._map = mmap.mmap(-1, size)
+            self._write_header()
+            return
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # never overwrite a file which isn't this filter
+            if os.path.getsize(path) != size:
+                raise ValueError("%s isn't a filter of this capacity "
+                        "and error rate" % path)
+            self._file = open(path, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), size)
+            if not self._read_header():
+                self.close()
+                raise ValueError("%s isn't a filter of this capacity "
+                        "and error rate" % path)
+            return
+
+        self._file = open(path, 'w+b')
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self.clear()
+
+    def _read_header(self):
+        magic, version, nbits, nhashes, meta_len = _HEADER.unpack(
+                self._map[:_HEADER.size])
+        if magic != MAGIC or version != 1 or nbits != self.nbits or \
+                nhashes != self.nhashes:
+            return False
+        meta = self._map[_HEADER.size:_HEADER.size + meta_len]
+        self.metadata = anyjson.deserialize(meta)
+        return True
+
+    def _write_header(self):
+        meta = anyjson.serialize(self.metadata)
+        if _HEADER.size + len(meta) > HEADER_SIZE:
+            raise ValueError("metadata are too large")
+        header = _HEADER.pack(MAGIC, 1, self.nbits, self.nhashes, len(meta))
+        self._map[:_HEADER.size + len(meta)] = header + meta
+
+    def _positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', md5(item).digest())
+        nbits = self.nbits
+        return [(h1 + i * h2) % nbits for i in xrange(self.nhashes)]
+
+    def add(self, item):
+        """ add `item` to the filter """
+        m = self._map
+        for pos in self._positions(item):
+            idx = HEADER_SIZE + (pos >> 3)
+            m[idx] = chr(ord(m[idx]) | (1 << (pos & 7)))
+
+    def __contains__(self, item):
+        m = self._map
+        for pos in self._positions(item):
+            if not ord(m[HEADER_SIZE + (pos >> 3)]) & (1 << (pos & 7)):
+                return False
+        return True
+
+    def set_metadata(self, metadata):
+        """ save metadata in the header """
+        self.metadata = metadata
+        self._write_header()
+
+    def clear(self):
+        """ remove all items and metadata """
+        self.metadata = None
+        self._map.seek(HEADER_SIZE)
+        size = len(self._map) - HEADER_SIZE
+        block = '\0' * min(size, 1024 * 1024)
+        while size > 0:
+            self._map.write(block[:size])
+            size -= len(block)
+        self._write_header()
+
+    def flush(self):
+        """ write changes to the file """
+        if self._file is not None:
+            self._map.flush()
+
+    def close(self):
+        self.flush()
+        self._map.close()
+        if self._file is not None:
+            self._file.close()
+
+
+class DocIdFilter(object):
+    """ Bloom filter of the document ids of a database, used by
+    `Database.doc_exist` when set as `db.id_filter`. """
+
+    def __init__(self, db, capacity=1000000, error_rate=0.01, path=None,
+            refresh_interval=1.0, batch_size=10000):
+        """
+        @param db: Database instance
+        @param capacity: int, expected number of documents
+        @param error_rate: float, false positive rate at capacity
+        @param path: str, file where the filter is persisted
+        @param refresh_interval: float, minimum time between two reads
+        of the changes feed
+        @param batch_size: int, number of ids fetched by request
+        """
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.bloom = BloomFilter(capacity=capacity, error_rate=error_rate,
+                path=path)
+        self._last_refresh = 0
+        self._lock = threading.RLock()
+
+        meta = self.bloom.metadata
+        if meta is None or meta.get('server') != db.server.uri or \
+                meta.get('dbname') != db.dbname:
+            self.build()
+
+    def build(self):
+        """ build the filter from all ids of the database """
+        self._lock.acquire()
+        try:
+            self.bloom.clear()
+            seq = self.db.info()['update_seq']
+            params = { 'limit': self.batch_size + 1 }
+            while True:
+                rows = self.db.res.get('_all_docs', **params)['rows']
+                if len(rows) > self.batch_size:
+                    next_row = rows.pop()
+                else:
+                    next_row = None
+                for row in rows:
+                    self.bloom.add(row['id'])
+                if next_row is None:
+                    break
+                params['startkey'] = next_row['id']
+            self._save_seq(seq)
+            # ids created during the build
+            self._refresh()
+        finally:
+            self._lock.release()
+
+    def _save_seq(self, seq):
+        self.bloom.set_metadata({ 'server': self.db.server.uri,
+            'dbname': self.db.dbname, 'seq': seq })
+        self.bloom.flush()
+
+    def _refresh(self):
+        since = self.bloom.metadata['seq']
+        while True:
+            result = self.db.res.get('_changes', since=since,
+                    limit=self.batch_size)
+            results = result.get('results', [])
+            for change in results:
+                if not change.get('deleted'):
+                    self.bloom.add(change['id'])
+            since = result.get('last_seq', since)
+            if len(results) < self.batch_size:
+                break
+        self._save_seq(since)
+        self._last_refresh = time.time()
+
+    def refresh(self, force=False):
+        """ add ids created since last refresh. The changes feed is read
+        at most every `refresh_interval` seconds unless `force` is True. """
+        if not force and \
+                time.time() - self._last_refresh < self.refresh_interval:
+            return
+        self._lock.acquire()
+        try:
+            self._refresh()
+        finally:
+            self._lock.release()
+
+    def add(self, docid):
+        """ add an id, used for documents saved by the database object """
+        # bits are set by read-modify-write of bytes, concurrent updates
+        # could lose them
+        self._lock.acquire()
+        try:
+            self.bloom.add(docid)
+        finally:
+            self._lock.release()
+
+    def might_contain(self, docid):
+        """ return False if the document `docid` doesn't exist, True if
+        it may exist """
+        if docid in self.bloom:
+            return True
+        self.refresh()
+        return docid in self.bloom
+
+    def close(self):
+        self.bloom.close()
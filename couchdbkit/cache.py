@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008-2009 Benoit Chesneau <benoitc@e-engura.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+In-process caches used by couchdbkit. Caches are opt-in, you attach them
+to a database object:
+
+    >>> from couchdbkit import Server
+    >>> from couchdbkit.cache import ViewCache
+    >>> db = Server()['couchdbkit_test']
+    >>> db.view_cache = ViewCache(max_bytes=4*1024*1024, ttl=60)
+    >>> results = db.view('stats/by_day', group=True)
+
+Documents could also be cached:
+
+    >>> from couchdbkit.cache import DocumentCache
+    >>> db.doc_cache = DocumentCache(max_entries=10000)
+    >>> db.doc_cache.subscribe(db)
+
+"""
+
+import cPickle
+import threading
+import time
+
+import anyjson
+
+__all__ = ['LRUCache', 'ViewCache', 'DocumentCache']
+
+# positions in a cache entry
+_PREV, _NEXT, _KEY, _VALUE, _SIZE, _EXPIRES = range(6)
+
+class LRUCache(object):
+    """ Least recently used cache bounded by number of entries and by
+    size in bytes. Entries could expire after `ttl` seconds. The cache
+    is thread-safe.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None):
+        """
+        @param max_entries: int, maximum number of entries or None
+        @param max_bytes: int, maximum size of all entries or None
+        @param ttl: float, default time to live in seconds of an
+        entry or None if entries don't expire.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, 0, None]
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """ return value of `key` and mark it as recently used """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[_EXPIRES] is not None and entry[_EXPIRES] <= time.time():
+                self._remove(entry)
+                return default
+            self._unlink(entry)
+            self._link(entry)
+            return entry[_VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size=0, ttl=None):
+        """ add `value` to the cache.
+
+        @param size: int, size in bytes of the value
+        @param ttl: float, time to live of this entry. Default ttl of the
+        cache is used if None.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # would evict everything and still not fit
+                return
+            entry = [None, None, key, value, size, expires]
+            self._link(entry)
+            self._entries[key] = entry
+            self.size += size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        """ remove `key` from the cache """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        """ return list of keys, from the least to the most recently
+        used """
+        self._lock.acquire()
+        try:
+            keys = []
+            entry = self._root[_NEXT]
+            while entry is not self._root:
+                keys.append(entry[_KEY])
+                entry = entry[_NEXT]
+            return keys
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """ remove all entries """
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            root = self._root
+            root[:] = [root, root, None, None, 0, None]
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def _link(self, entry):
+        # most recently used entries are at the end of the list
+        root = self._root
+        last = root[_PREV]
+        entry[_PREV] = last
+        entry[_NEXT] = root
+        last[_NEXT] = root[_PREV] = entry
+
+    def _unlink(self, entry):
+        entry[_PREV][_NEXT] = entry[_NEXT]
+        entry[_NEXT][_PREV] = entry[_PREV]
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry[_KEY]]
+        self.size -= entry[_SIZE]
+
+    def _evict(self):
+        root = self._root
+        while root[_NEXT] is not root:
+            if self.max_entries is not None and \
+                    len(self._entries) > self.max_entries:
+                self._remove(root[_NEXT])
+            elif self.max_bytes is not None and self.size > self.max_bytes:
+                self._remove(root[_NEXT])
+            else:
+                break
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ViewCache(object):
+    """ Cache of view results. Results are cached by view path and
+    encoded parameters. Decoded results are kept pickled, each hit loads
+    a new copy so cached results can't be changed by the code using them.
+    Loading the pickle is about 3 times faster than decoding the JSON
+    response again. The cache is bounded by the size of the pickles.
+
+    If `check_update_seq` is True, the `update_seq` of the database is
+    checked at most once every `seq_interval` seconds (whatever the
+    number of views cached) and cached results are only used while the
+    database didn't change.
+    """
+
+    def __init__(self, max_bytes=10*1024*1024, max_entries=None, ttl=None,
+            check_update_seq=False, seq_interval=1.0):
+        """
+        @param max_bytes: int, maximum size of cached responses
+        @param max_entries: int, maximum number of cached responses
+        @param ttl: float, time to live of a result in seconds
+        @param check_update_seq: bool, invalidate results when
+        database `update_seq` change.
+        @param seq_interval: float, minimum time between two checks of
+        `update_seq` for a database.
+        """
+        self.cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes,
+                ttl=ttl)
+        self.check_update_seq = check_update_seq
+        self.seq_interval = seq_interval
+        self.hits = 0
+        self.misses = 0
+        self._seqs = {}
+
+    def fetch(self, view, params):
+        """ return results of `view` for `params`, from the cache if
+        possible. """
+        params = params.copy()
+        if params.pop('_raw_json', False):
+            return view._exec(_raw_json=True, **params)
+
+        key = view._cache_key(params)
+        seq = None
+        if self.check_update_seq:
+            seq = self.update_seq(view._db)
+
+        lock = self.cache._lock
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] == seq:
+            lock.acquire()
+            try:
+                self.hits += 1
+            finally:
+                lock.release()
+            return cPickle.loads(entry[1])
+
+        lock.acquire()
+        try:
+            self.misses += 1
+        finally:
+            lock.release()
+        result = anyjson.deserialize(view._exec(_raw_json=True, **params))
+        data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        self.cache.set(key, (seq, data), size=len(data))
+        return result
+
+    def update_seq(self, db):
+        """ return last known `update_seq` of `db`, the database is
+        asked if last check is older than `seq_interval`. """
+        dbkey = (db.server.uri, db.dbname)
+        now = time.time()
+        checked = self._seqs.get(dbkey)
+        if checked is not None and now - checked[0] < self.seq_interval:
+            return checked[1]
+        seq = db.info()['update_seq']
+        lock = self.cache._lock
+        lock.acquire()
+        try:
+            self._seqs[dbkey] = (now, seq)
+        finally:
+            lock.release()
+        return seq
+
+    def invalidate(self, db=None):
+        """ remove cached results of `db` or all results if db is None"""
+        lock = self.cache._lock
+        lock.acquire()
+        try:
+            if db is None:
+                self.cache.clear()
+                self._seqs.clear()
+                return
+
+            dbkey = (db.server.uri, db.dbname)
+            for key in self.cache.keys():
+                if key[0] == dbkey:
+                    self.cache.delete(key)
+            self._seqs.pop(dbkey, None)
+        finally:
+            lock.release()
+
+
+class DocumentCache(object):
+    """ Cache of documents used by `Database.get`. Writes done with
+    couchdbkit update the cache with the new revision (write-through) or
+    invalidate it. Changes done by other clients are found by calling
+    `process_changes` or by listening the changes feed of the database 
+    with `subscribe`. 
+
+    Documents are cached serialized so returned documents could be
+    changed without altering the cache.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None, ttl=None,
+            ttls=None):
+        """
+        @param max_entries: int, maximum number of cached documents
+        @param max_bytes: int, maximum size of cached documents
+        @param ttl: float, default time to live of a document in seconds
+        @param ttls: dict, time to live by database name
+        """
+        self.cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.hits = 0
+        self.misses = 0
+        self._seqs = {}
+        self._listeners = {}
+
+    def _key(self, db, docid):
+        return ((db.server.uri, db.dbname), docid)
+
+    def get(self, db, docid):
+        """ return cached document `docid` of `db` or None """
+        lock = self.cache._lock
+        entry = self.cache.get(self._key(db, docid))
+        lock.acquire()
+        try:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        finally:
+            lock.release()
+        return anyjson.deserialize(entry[1])
+
+    def set(self, db, doc):
+        """ cache last revision of `doc` """
+        if '_rev' not in doc:
+            self.delete(db, doc['_id'])
+            return
+        raw = anyjson.serialize(doc)
+        self.cache.set(self._key(db, doc['_id']), (doc['_rev'], raw),
+                size=len(raw), ttl=self.ttls.get(db.dbname, self.ttl))
+
+    def delete(self, db, docid):
+        """ remove document `docid` of `db` from the cache """
+        self.cache.delete(self._key(db, docid))
+
+    def invalidate(self, db=None):
+        """ remove documents of `db` or all documents if db is None """
+        lock = self.cache._lock
+        lock.acquire()
+        try:
+            if db is None:
+                self.cache.clear()
+                return
+            dbkey = (db.server.uri, db.dbname)
+            for key in self.cache.keys():
+                if key[0] == dbkey:
+                    self.cache.delete(key)
+        finally:
+            lock.release()
+
+    def apply_changes(self, db, results):
+        """ remove from the cache documents changed by other revisions
+        than the cached ones. 
+
+        @param results: list of results of the changes feed
+        """
+        for change in results:
+            key = self._key(db, change['id'])
+            entry = self.cache.get(key)
+            if entry is None:
+                continue
+            revs = [rev['rev'] for rev in change.get('changes', [])]
+            if change.get('deleted') or entry[0] not in revs:
+                self.cache.delete(key)
+
+    def process_changes(self, db):
+        """ invalidate documents changed in `db` since last call. The
+        first call for a database remove all its documents from the 
+        cache. """
+        dbkey = (db.server.uri, db.dbname)
+        since = self._seqs.get(dbkey)
+        if since is None:
+            self._seqs[dbkey] = db.info()['update_seq']
+            self.invalidate(db)
+            return
+        result = db.res.get('_changes', since=since)
+        self.apply_changes(db, result.get('results', []))
+        self._seqs[dbkey] = result.get('last_seq', since)
+
+    def subscribe(self, db, timeout=60000):
+        """ listen the changes feed of `db` from a daemon thread and
+        invalidate changed documents as soon as they are changed. 
+        
+        @param timeout: int, timeout of a longpoll request in
+        milliseconds.
+        """
+        dbkey = (db.server.uri, db.dbname)
+        if dbkey in self._listeners:
+            return self._listeners[dbkey]
+        listener = _ChangesListener(self, db._clone(), timeout)
+        self._listeners[dbkey] = listener
+        listener.start()
+        return listener
+
+    def unsubscribe(self, db):
+        """ stop listening changes of `db` """
+        listener = self._listeners.pop((db.server.uri, db.dbname), None)
+        if listener is not None:
+            listener.stop()
+
+
+class _ChangesListener(threading.Thread):
+    """ thread listening changes of a database with longpoll requests """
+
+    def __init__(self, cache, db, timeout):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.cache = cache
+        self.db = db
+        self.timeout = timeout
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        db = self.db
+        since = db.info()['update_seq']
+        self.cache.invalidate(db)
+        while not self._stop_event.isSet():
+            try:
+                result = db.res.get('_changes', feed='longpoll',
+                        since=since, timeout=self.timeout)
+            except Exception:
+                # connection lost, changes are asked again from the same
+                # sequence
+                self._stop_event.wait(1.0)
+                continue
+            self.cache.apply_changes(db, result.get('results', []))
+            since = result.get('last_seq', since)
@@ -40,13 +40,21 @@ Example:
 
 
 
+from array import array
 import base64
 import cgi
+import copy
+from hashlib import md5
 from itertools import groupby
 from mimetypes import guess_type
+import random
 import re
+import sys
+import threading
+import time
 
 import anyjson
+from restkit import RequestFailed
 from restkit.rest import url_quote
 
 from couchdbkit.exceptions import *
@@ -55,6 +63,183 @@ from couchdbkit.utils import validate_dbname
 
 DEFAULT_UUID_BATCH_COUNT = 1000
 
+def _run_parallel(funcs, max_workers=4):
+    """ call functions of `funcs` from at most `max_workers` threads.
+
+    @return: tuple (results, errors). results are in the order of
+    `funcs`, if a function raised, its result is None and errors 
+    contains the `sys.exc_info()` of the exception at the same index.
+    """
+    results = [None] * len(funcs)
+    errors = [None] * len(funcs)
+    pending = iter(enumerate(funcs))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                try:
+                    idx, func = pending.next()
+                except StopIteration:
+                    return
+            finally:
+                lock.release()
+            try:
+                results[idx] = func()
+            except:
+                errors[idx] = sys.exc_info()
+
+    nb_workers = min(max(max_workers, 1), len(funcs))
+    if nb_workers <= 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker) for i in range(nb_workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return results, errors
+
+_NAN = float('nan')
+
+class _ColumnBuilder(object):
+    """ accumulate values of a column. The kind of the column is taken
+    from its first value not None. Numbers are stored in a typed array
+    ('l' then 'd' if a float or None is found, None being stored as NaN),
+    any other value make the column a list. Strings of a column share the
+    same pool. """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.values = None
+        self.kind = None
+        # None values found before the kind is known
+        self.nones = 0
+
+    def append(self, value):
+        kind = self.kind
+        if kind is None:
+            if value is None:
+                self.nones += 1
+                return
+            if isinstance(value, bool):
+                kind = 'list'
+                self.values = [None] * self.nones
+            elif isinstance(value, (int, long)) and not self.nones:
+                kind = 'l'
+                self.values = array('l')
+            elif isinstance(value, (int, long, float)):
+                kind = 'd'
+                self.values = array('d', [_NAN] * self.nones)
+            else:
+                kind = 'list'
+                self.values = [None] * self.nones
+            self.kind = kind
+        
+        if kind == 'l':
+            if isinstance(value, (int, long)) and not isinstance(value, bool):
+                try:
+                    self.values.append(value)
+                    return
+                except OverflowError:
+                    self._to_list()
+            elif isinstance(value, float) or value is None:
+                self.values = array('d', self.values)
+                self.kind = 'd'
+                if value is None:
+                    value = _NAN
+                self.values.append(value)
+                return
+            else:
+                self._to_list()
+        elif kind == 'd':
+            if value is None:
+                self.values.append(_NAN)
+                return
+            if isinstance(value, (int, long, float)) and \
+                    not isinstance(value, bool):
+                self.values.append(value)
+                return
+            self._to_list()
+
+        if isinstance(value, basestring):
+            value = self.pool.setdefault(value, value)
+        self.values.append(value)
+
+    def _to_list(self):
+        values = self.values.tolist()
+        if self.kind == 'd':
+            # JSON has no NaN, they are None values
+            values = [value if value == value else None for value in values]
+        self.values = values
+        self.kind = 'list'
+
+
+def _field_getter(field):
+    """ return a function getting value of dotted path `field` in a
+    row. Path items are mapping keys or list indexes """
+    path = []
+    for name in field.split('.'):
+        if name.isdigit():
+            path.append(int(name))
+        else:
+            path.append(name)
+
+    def getter(row):
+        value = row
+        for name in path:
+            try:
+                value = value[name]
+            except (KeyError, IndexError, TypeError):
+                return None
+        return value
+    return getter
+
+def _key_hash(key):
+    """ return a hashable value of a view key, equal for keys CouchDB
+    doesn't distinguish even if their json differs, like 1 and 1.0 or
+    objects with members in another order. """
+    if isinstance(key, bool):
+        return (bool, key)
+    elif isinstance(key, str):
+        return key.decode('utf-8')
+    elif isinstance(key, (list, tuple)):
+        return (list, tuple([_key_hash(item) for item in key]))
+    elif isinstance(key, dict):
+        return (dict, tuple(sorted([(_key_hash(name), _key_hash(value)) \
+                for name, value in key.iteritems()])))
+    return key
+
+class _BackgroundCall(threading.Thread):
+    """ run a function in a daemon thread and keep its result 
+    so it could be collected later with `result`. """
+
+    def __init__(self, func, *args, **kwargs):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._result = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self.func(*self.args, **self.kwargs)
+        except:
+            self._exc_info = sys.exc_info()
+
+    def result(self):
+        """ wait for the call and return its result. Exception raised
+        in the thread is raised again here. """
+        self.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
 class Server(object):
     """ Server object that allows you to access and manage a couchdb node. 
     A Server object can be used like any `dict` object.
@@ -89,6 +274,7 @@ class Server(object):
         self.res = CouchdbResource(uri, transport=transport, use_proxy=use_proxy,
             min_size=min_size, max_size=max_size, pool_class=pool_class)
         self.uuids = []
+        self._version = None
         
     def info(self, _raw_json=False):
         """ info of server 
@@ -99,6 +285,15 @@ class Server(object):
         """
         return self.res.get(_raw_json=_raw_json)
     
+    def version(self):
+        """ version of the CouchDB server as a tuple of int, like
+        (0, 10, 0). """
+        if self._version is None:
+            version = self.info().get('version', '')
+            self._version = tuple([int(v) for v in 
+                re.findall(r'\d+', version)[:3]])
+        return self._version
+    
     def all_dbs(self, _raw_json=False):
         """ get list of databases in CouchDb host 
         
@@ -193,6 +388,18 @@ class Database(object):
     A Database object can act as a Dict object.
     """
 
+    # cache used by views, see :mod:`couchdbkit.cache`
+    view_cache = None
+
+    # cache of documents, see :mod:`couchdbkit.cache`
+    doc_cache = None
+
+    # bloom filter of document ids, see :mod:`couchdbkit.bloom`
+    id_filter = None
+
+    # minimum time between two updates of `last_used` of an auto view
+    auto_view_touch_interval = 3600
+
     def __init__(self, server, dbname):
         """Constructor for Database
 
@@ -206,10 +413,22 @@ class Database(object):
                             
         self.dbname = validate_dbname(dbname)
         self.server = server
-        self.res = server.res.clone()
-        if "/" in dbname:
-            self.res.client.safe = ":/%"
-        self.res.update_uri('/%s' % url_quote(dbname, safe=":"))
+        self.res = self._get_resource()
+        self._auto_views = {}
+
+    def _get_resource(self):
+        res = self.server.res.clone()
+        if "/" in self.dbname:
+            res.client.safe = ":/%"
+        res.update_uri('/%s' % url_quote(self.dbname, safe=":"))
+        return res
+
+    def _clone(self):
+        """ return a copy of this database object with its own
+        resource, so it could be used from another thread. """
+        db = copy.copy(self)
+        db.res = db._get_resource()
+        return db
     
     def __repr__(self):
         return "<%s %s>" % (self.__class__.__name__, self.dbname)
@@ -251,6 +470,11 @@ class Database(object):
         @param docid: str, document id
         @return: boolean, True if document exist
         """
+        # local documents are not in _all_docs and the changes feed
+        if self.id_filter is not None and \
+                not docid.startswith('_local/') and \
+                not self.id_filter.might_contain(docid):
+            return False
 
         try:
             data = self.res.head(self.escape_docid(docid))
@@ -258,6 +482,41 @@ class Database(object):
             return False
         return True
         
+    def revs_many(self, ids):
+        """ get current revisions of documents with `_all_docs` requests.
+        
+        @param ids: list of document ids
+        @return: dict by id of dicts like {'rev': '1-xxx', 'deleted':
+        False}. Value is None if the document never existed.
+        """
+        ids = list(ids)
+        revs = dict.fromkeys(ids)
+        if self.id_filter is not None:
+            ids = [docid for docid in ids if 
+                    self.id_filter.might_contain(docid)]
+        if not ids:
+            return revs
+
+        for row in self.view('_all_docs', cache=False, keys=ids):
+            if 'error' in row:
+                continue
+            value = row['value']
+            revs[row['key']] = { 'rev': value['rev'], 
+                    'deleted': value.get('deleted', False) }
+        return revs
+
+    def exists_many(self, ids):
+        """ test if documents exist with `_all_docs` requests instead of
+        one request per document.
+
+        @param ids: list of document ids
+        @return: dict of booleans by id
+        """
+        exists = {}
+        for docid, rev in self.revs_many(ids).iteritems():
+            exists[docid] = rev is not None and not rev['deleted']
+        return exists
+
     def get(self, docid, rev=None, wrapper=None, _raw_json=False):
         """Get document from database
         
@@ -272,11 +531,17 @@ class Database(object):
         @return: dict, representation of CouchDB document as
          a dict.
         """
-        docid = self.escape_docid(docid)
-        if rev is not None:
-            doc = self.res.get(docid, _raw_json=_raw_json, rev=rev)
+        cache = self.doc_cache
+        if cache is not None and rev is None and not _raw_json:
+            doc = cache.get(self, docid)
+            if doc is None:
+                doc = self.res.get(self.escape_docid(docid))
+                cache.set(self, doc)
+        elif rev is not None:
+            doc = self.res.get(self.escape_docid(docid), _raw_json=_raw_json,
+                    rev=rev)
         else:
-            doc = self.res.get(docid, _raw_json=_raw_json)
+            doc = self.res.get(self.escape_docid(docid), _raw_json=_raw_json)
 
         if wrapper is not None:
             if not callable(wrapper):
@@ -285,6 +550,45 @@ class Database(object):
         
         return doc
 
+    def get_changed(self, revs, wrapper=None):
+        """ fetch documents whose revision changed. Current revisions are
+        asked first with `_all_docs` (without documents), then documents
+        that changed are fetched in one request.
+
+        @param revs: dict, known revision by document id. Revision could
+        be None if the document isn't known.
+        @param wrapper: callable. function that takes dict as a param. 
+        Used to wrap an object.
+
+        @return: dict of changed documents by id. Value is None if the
+        document has been deleted or doesn't exist. Ids of documents
+        not changed aren't in the dict.
+        """
+        if wrapper is not None and not callable(wrapper):
+            raise TypeError("wrapper isn't a callable")
+        if not revs:
+            return {}
+
+        changed = {}
+        to_fetch = []
+        for row in self.view('_all_docs', cache=False, keys=list(revs)):
+            docid = row['key']
+            value = row.get('value') or {}
+            if 'error' in row or value.get('deleted'):
+                if revs[docid] is not None:
+                    changed[docid] = None
+            elif value['rev'] != revs[docid]:
+                to_fetch.append(docid)
+
+        if to_fetch:
+            for row in self.view('_all_docs', cache=False, keys=to_fetch,
+                    include_docs=True):
+                doc = row.get('doc')
+                if doc is not None and wrapper is not None:
+                    doc = wrapper(doc)
+                changed[row['key']] = doc
+        return changed
+
     def all_docs(self, by_seq=False, _raw_json=False, **params):
         """Get all documents from a database
 
@@ -374,13 +678,34 @@ class Database(object):
             except:
                 res = self.res.post(payload=doc, _raw_json=_raw_json, **params)
                 
-        if _raw_json:    
+        cache = self.doc_cache
+        if self.id_filter is not None or cache is not None:
+            # id of the response, the server gives it when the doc is
+            # posted
+            if _raw_json:
+                docid = anyjson.deserialize(res)['id']
+            else:
+                docid = res['id']
+            if self.id_filter is not None:
+                self.id_filter.add(docid)
+            if _raw_json and cache is not None:
+                cache.delete(self, docid)
+
+        if _raw_json:
             return res
                 
         if 'batch' in params and 'id' in res:
             doc.update({ '_id': res['id']})
+            if cache is not None:
+                cache.delete(self, res['id'])
         else:
             doc.update({ '_id': res['id'], '_rev': res['rev']})
+            if cache is not None:
+                if '_attachments' in doc:
+                    # stored doc has only stubs of attachments
+                    cache.delete(self, res['id'])
+                else:
+                    cache.set(self, doc)
         
     def bulk_save(self, docs, use_uuids=True, all_or_nothing=False, _raw_json=False):
         """ bulk save. Modify Multiple Documents With a Single Request
@@ -393,8 +718,10 @@ class Database(object):
         @param _raw_json: return raw json instead deserializing it
         be committed even if this creates conflicts.
         
-        With `_raw_json=True` it return raw response. When False it return anything
-        but update list of docs with new revisions and members (like deleted)
+        With `_raw_json=True` it return raw response. When False it update 
+        list of docs with new revisions and members (like deleted) and 
+        return the results list, where documents not saved have an `error`
+        member (like 'conflict').
         
         .. seealso:: `HTTP Bulk Document API <http://wiki.apache.org/couchdb/HTTP_Bulk_Document_API>`
         
@@ -427,30 +754,176 @@ class Database(object):
         # update docs
         results = self.res.post('/_bulk_docs', payload=payload, _raw_json=_raw_json)
         
+        cache = self.doc_cache
+        id_filter = self.id_filter
+        if cache is not None or id_filter is not None:
+            # ids of the response, the server gives them to docs without
+            # `_id`
+            if _raw_json:
+                rows = anyjson.deserialize(results)
+            else:
+                rows = results
+            for row in rows:
+                if 'id' not in row:
+                    continue
+                if cache is not None:
+                    cache.delete(self, row['id'])
+                if id_filter is not None:
+                    id_filter.add(row['id'])
+
         if _raw_json:
             return results
         
         for i, res in enumerate(results):
-            docs[i].update({'_id': res['id'], '_rev': res['rev']})
+            if 'error' in res:
+                # document not saved, like on conflict
+                continue
+            doc = docs[i]
+            doc.update({'_id': res['id'], '_rev': res['rev']})
+            if cache is not None and not doc.get('_deleted') and \
+                    '_attachments' not in doc:
+                cache.set(self, doc)
+        return results
     
+    def update_doc(self, docid, fn, max_retries=10, backoff=0.05):
+        """ update a document with optimistic concurrency. `fn` is applied
+        to the last revision of the document and the result is saved. On
+        conflict, the document is fetched again and `fn` applied again,
+        after a jittered exponential backoff.
+
+        @param docid: str, document id
+        @param fn: function taking the document (a dict with only `_id`
+        if the document doesn't exist) and returning the new document. If
+        it returns None the document passed is saved.
+        @param max_retries: int, maximum number of retries on conflict
+        @param backoff: float, time in seconds waited before the first
+        retry. It's doubled on each retry.
+
+        @return: dict, the saved document
+        """
+        return self.update_many([docid], fn, max_retries=max_retries,
+                backoff=backoff)[docid]
+
+    def update_many(self, ids, fn, max_retries=10, backoff=0.05):
+        """ like `update_doc` but for many documents. Documents are
+        fetched and saved with one request each time, and only
+        documents in conflict are retried.
+        
+        @return: dict of saved documents by id
+        """
+        pending = []
+        seen = set()
+        for docid in ids:
+            if docid not in seen:
+                seen.add(docid)
+                pending.append(docid)
+
+        saved = {}
+        attempt = 0
+        while pending:
+            current = {}
+            for row in self.view('_all_docs', cache=False, keys=pending,
+                    include_docs=True):
+                if row.get('doc') is not None:
+                    current[row['key']] = row['doc']
+
+            docs = []
+            for docid in pending:
+                doc = current.get(docid) or { '_id': docid }
+                new_doc = fn(doc)
+                if new_doc is None:
+                    new_doc = doc
+                new_doc['_id'] = docid
+                docs.append(new_doc)
+
+            conflicts = []
+            for doc, res in zip(docs, self.bulk_save(docs, use_uuids=False)):
+                error = res.get('error')
+                if error == 'conflict':
+                    conflicts.append(doc['_id'])
+                elif error is not None:
+                    raise RequestFailed("%s: %s" % (error, res.get('reason')),
+                            http_code=res.get('status', 500))
+                else:
+                    saved[doc['_id']] = doc
+
+            pending = conflicts
+            if not pending:
+                break
+            if attempt >= max_retries:
+                raise ResourceConflict("%s still in conflict after %s retries" %
+                        (", ".join(pending), max_retries), http_code=409)
+            time.sleep(backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
+        return saved
+
+    def update_handler(self, handler_name, docid=None, body=None, **params):
+        """ call an update handler of a design doc. The document is 
+        changed on the server, so small changes don't need to send the 
+        whole document.
+
+        @param handler_name: str, name of the handler like 
+        'designname/handlername'
+        @param docid: str, id of the document to update. If None, the
+        handler is called without document.
+        @param body: str or object converted to JSON, body of the request
+        @param params: params of the request
+
+        @return: tuple (response, rev). response is deserialized if it's
+        JSON, rev is the new revision of the document or None if the
+        handler didn't save it.
+        """
+        dname, hname = handler_name.split('/', 1)
+        path = '_design/%s/_update/%s' % (dname, hname)
+        if docid is not None:
+            path = '%s/%s' % (path, self.escape_docid(docid))
+            result = self.res.put(path, payload=body, **params)
+        else:
+            result = self.res.post(path, payload=body, **params)
+        rev = self.res.get_response().get('x-couch-update-newrev')
+
+        if docid is not None:
+            if self.doc_cache is not None:
+                self.doc_cache.delete(self, docid)
+            if self.id_filter is not None and rev is not None:
+                self.id_filter.add(docid)
+        return result, rev
+
     def bulk_delete(self, docs, all_or_nothing=False, _raw_json=False):
         """ bulk delete. 
         It adds '_deleted' member to doc then uses bulk_save to save them.
         
+        @param docs: list of docs or document ids. Revisions of ids are
+        fetched with one request, missing documents are ignored.
         @param _raw_json: return raw json instead deserializing it
         
         With `_raw_json=True` it return raw response. When False it return anything
         but update list of docs with new revisions and members.
         
         """
+        docs = list(docs)
+        ids = [doc for doc in docs if isinstance(doc, basestring)]
+        if ids:
+            revs = self.revs_many(ids)
+            resolved = []
+            for doc in docs:
+                if isinstance(doc, basestring):
+                    rev = revs[doc]
+                    if rev is None or rev['deleted']:
+                        continue
+                    doc = { '_id': doc, '_rev': rev['rev'] }
+                resolved.append(doc)
+            docs = resolved
+
         for doc in docs:
             doc['_deleted'] = True
-        self.bulk_save(docs, use_uuids=False, all_or_nothing=all_or_nothing,
-                    _raw_json=_raw_json)
+        return self.bulk_save(docs, use_uuids=False, 
+                all_or_nothing=all_or_nothing, _raw_json=_raw_json)
  
     def delete_doc(self, doc, _raw_json=False):
         """ delete a document or a list of documents
-        @param doc: str or dict,  document id or full doc.
+        @param doc: str or dict,  document id or full doc. Or a list
+        of them, deleted with `bulk_delete`.
         @param _raw_json: return raw json instead deserializing it
         @return: dict like:
        
@@ -459,13 +932,19 @@ class Database(object):
             {"ok":true,"rev":"2839830636"}
         """
         result = { 'ok': False }
-        if isinstance(doc, dict):
+        if isinstance(doc, (list, tuple)):
+            return self.bulk_delete(doc, _raw_json=_raw_json)
+        elif isinstance(doc, dict):
             if not '_id' or not '_rev' in doc:
                 raise KeyError('_id and _rev are required to delete a doc')
                 
+            if self.doc_cache is not None:
+                self.doc_cache.delete(self, doc['_id'])
             docid = self.escape_docid(doc['_id'])
             result = self.res.delete(docid, _raw_json=_raw_json, rev=doc['_rev'])
         elif isinstance(doc, basestring): # we get a docid
+            if self.doc_cache is not None:
+                self.doc_cache.delete(self, doc)
             docid = self.escape_docid(doc)
             data = self.res.head(docid)
             response = self.res.get_response()
@@ -502,6 +981,11 @@ class Database(object):
                 raise KeyError("dest doesn't exist or this not a document ('_id' or '_rev' missig).")
     
         if destination:
+            destid = str(destination).split('?')[0]
+            if self.doc_cache is not None:
+                self.doc_cache.delete(self, destid)
+            if self.id_filter is not None:
+                self.id_filter.add(destid)
             result = self.res.copy('/%s' % docid, headers={ "Destination": str(destination) },
                                 _raw_json=_raw_json)
             return result
@@ -512,7 +996,8 @@ class Database(object):
         return result
             
         
-    def view(self, view_name, obj=None, wrapper=None, **params):
+    def view(self, view_name, obj=None, wrapper=None, cache=None,
+            row_class=None, wrap_by_doc_type=False, **params):
         """ get view results from database. viewname is generally 
         a string like `designname/viewnam". It return an ViewResults
         object on which you could iterate, list, ... . You could wrap
@@ -526,6 +1011,14 @@ class Database(object):
         and beginning slash will be removed. Usefull with c-l for example.
         @param obj, Object with a wrapper function
         @param wrapper: function used to wrap results 
+        @param cache: `couchdbkit.cache.ViewCache` instance used for this
+        view. By default `view_cache` of the database is used. Set it to
+        False to not use any cache.
+        @param row_class: class used to decode rows instead of dicts,
+        like :class:`Row`. 
+        @param wrap_by_doc_type: wrap each row with the schema class
+        defined for its `doc_type`, see `couchdbkit.schema.wrap_any`.
+        It can't be used with `obj` or `wrapper`.
         @param params: params of the view
         
         """
@@ -540,21 +1033,196 @@ class Database(object):
             dname = view_name.pop(0)
             vname = '/'.join(view_name)
             view_path = '_design/%s/_view/%s' % (dname, vname)
+        if wrap_by_doc_type and (obj is not None or wrapper is not None):
+            raise ValueError("wrap_by_doc_type can't be used with obj or wrapper")
         if obj is not None:
             if not hasattr(obj, 'wrap'):
                 raise AttributeError(" no 'wrap' method found in obj %s)" % str(obj))
             wrapper = obj.wrap
+        elif wrap_by_doc_type:
+            # schema imports this module
+            from couchdbkit.schema.base import wrap_any
+            wrapper = wrap_any
+
+        if cache is None:
+            cache = self.view_cache
+        return View(self, view_path, wrapper=wrapper, cache=cache,
+                row_class=row_class)(**params)
+
+    def temp_view(self, design, obj=None, wrapper=None, cache=None,
+            row_class=None, promote=False, **params):
+        """ get adhoc view results. Like view it reeturn a ViewResult object.
+        
+        @param promote: bool, if True the design is saved once in a
+        `_design/_auto_<hash>` document and this permanent view is queried
+        instead, so its index isn't rebuilt on each call. Like any view,
+        the query waits for the index to be updated, pass `stale='ok'`
+        to not wait. Unused auto views are removed with
+        `cleanup_auto_views`.
+        """
+        if obj is not None:
+            if not hasattr(obj, 'wrap'):
+                raise AttributeError(" no 'wrap' method found in obj %s)" % str(obj))
+            wrapper = obj.wrap
+        if cache is None:
+            cache = self.view_cache
+        if promote:
+            return _PromotedView(self, design, wrapper=wrapper, cache=cache,
+                    row_class=row_class)(**params)
+        return TempView(self, design, wrapper=wrapper, cache=cache,
+                row_class=row_class)(**params)
+        
+    def _auto_view_name(self, design):
+        """ return the name of the auto design doc of `design` """
+        signature = anyjson.serialize([design.get('language', 'javascript'),
+            design.get('map'), design.get('reduce')])
+        return '_auto_%s' % md5(signature).hexdigest()
+
+    def _promote_temp_view(self, design):
+        """ save `design` in an auto design doc if needed and return the
+        name of its view. `last_used` of the design doc is updated at
+        most every `auto_view_touch_interval` seconds by this database
+        object. """
+        language = design.get('language', 'javascript')
+        name = self._auto_view_name(design)
+        
+        now = time.time()
+        last_touch = self._auto_views.get(name)
+        if last_touch is None or \
+                now - last_touch >= self.auto_view_touch_interval:
+            docid = '_design/%s' % name
+            try:
+                ddoc = self.get(docid)
+            except ResourceNotFound:
+                view = { 'map': design['map'] }
+                if design.get('reduce'):
+                    view['reduce'] = design['reduce']
+                ddoc = { '_id': docid, 'language': language,
+                        'views': { 'view': view } }
+            # updating other fields than views don't change the view index
+            ddoc['couchdbkit_last_used'] = int(now)
+            try:
+                self.save_doc(ddoc)
+            except ResourceConflict:
+                # saved at the same time from another client
+                pass
+            self._auto_views[name] = now
+        return '%s/view' % name
 
-        return View(self, view_path, wrapper=wrapper)(**params)
+    def cleanup_auto_views(self, max_age=7*24*3600):
+        """ delete design docs created by `temp_view(..., promote=True)` 
+        not used since `max_age` seconds and remove unused indexes.
 
-    def temp_view(self, design, obj=None, wrapper=None, **params):
-        """ get adhoc view results. Like view it reeturn a ViewResult object."""
+        @param max_age: int, time in seconds
+        @return: list of deleted design doc ids
+        """
+        limit = time.time() - max_age
+        stale = []
+        for row in self.all_docs(startkey='_design/_auto_', 
+                endkey=u'_design/_auto_\ufff0', include_docs=True):
+            ddoc = row.get('doc')
+            if ddoc and ddoc.get('couchdbkit_last_used', 0) < limit:
+                stale.append(ddoc)
+                self._auto_views.pop(ddoc['_id'][len('_design/'):], None)
+        if stale:
+            self.bulk_delete(stale)
+            self.res.post('/_view_cleanup')
+        return [ddoc['_id'] for ddoc in stale]
+
+    def local_view(self, map_fun, reduce_fun=None, path=None, obj=None,
+            wrapper=None, row_class=None):
+        """ create a view computed in the client with python functions. 
+        Unlike `temp_view`, the index is kept and updated from the changes
+        of the database, so the view should be created once and then
+        queried like any view:
+
+            >>> view = db.local_view(lambda doc: [(doc.get('type'), 1)], '_count')
+            >>> view(group=True).all()
+
+        @param map_fun: function taking a document and returning or
+        yielding (key, value) pairs.
+        @param reduce_fun: function reduce(keys, values, rereduce) or
+        '_sum', '_count', '_stats'.
+        @param path: file where the index is saved between runs.
+        @param obj: Object with a wrapper function
+        @param wrapper: function used to wrap results
+        @param row_class: class used to decode rows instead of dicts
+
+        @return: :class:`couchdbkit.localview.LocalView` instance
+        """
+        from couchdbkit.localview import LocalView
         if obj is not None:
             if not hasattr(obj, 'wrap'):
                 raise AttributeError(" no 'wrap' method found in obj %s)" % str(obj))
             wrapper = obj.wrap
-        return TempView(self, design, wrapper=wrapper)(**params)
+        return LocalView(self, map_fun, reduce_fun=reduce_fun, path=path,
+                wrapper=wrapper, row_class=row_class)
+
+    def multi_view(self, queries):
+        """ run several view queries at once. 
+
+        @param queries: list of queries. A query could be a view name, a
+        tuple (view_name, params) or a `ViewResults` instance.
+
+        @return: list of fetched `ViewResults` in the order of queries.
+        If a query failed, the exception raised is returned in place of
+        its results.
+
+        See :class:`MultiQuery`.
+        """
+        multi = MultiQuery(self)
+        for query in queries:
+            if isinstance(query, tuple):
+                view_name, params = query
+                multi.add(view_name, **params)
+            else:
+                multi.add(query)
+        return multi.execute()
         
+    def show(self, show_name, docid=None, stream=False, stream_size=16384,
+            **params):
+        """ call a show function of a design doc. The response isn't
+        decoded.
+
+        @param show_name: str, name of the show like 'designname/showname'
+        @param docid: str, id of the document passed to the show function
+        @param stream: boolean, response return a ResponseStream object
+        @param stream_size: int, size in bytes of response stream block
+        @param params: params of the request
+
+        @return: str, body of the response or a ResponseStream object
+        """
+        dname, sname = show_name.split('/', 1)
+        path = '_design/%s/_show/%s' % (dname, sname)
+        if docid is not None:
+            path = '%s/%s' % (path, self.escape_docid(docid))
+        return self.res.get(path, _raw_json=True, _stream=stream,
+                _stream_size=stream_size, **params)
+
+    def list(self, list_name, view_name, stream=False, stream_size=16384, 
+            **params):
+        """ call a list function of a design doc on a view. The response
+        isn't decoded.
+
+        @param list_name: str, name of the list like 'designname/listname'
+        @param view_name: str, name of the view, 'viewname' for a view of
+        the same design doc or 'designname/viewname'.
+        @param stream: boolean, response return a ResponseStream object
+        @param stream_size: int, size in bytes of response stream block
+        @param params: params of the view and of the request
+
+        @return: str, body of the response or a ResponseStream object
+        """
+        dname, lname = list_name.split('/', 1)
+        path = '_design/%s/_list/%s/%s' % (dname, lname, view_name)
+        if 'keys' in params:
+            keys = params.pop('keys')
+            return self.res.post(path, payload={ 'keys': keys }, 
+                    _raw_json=True, _stream=stream, 
+                    _stream_size=stream_size, **params)
+        return self.res.get(path, _raw_json=True, _stream=stream,
+                _stream_size=stream_size, **params)
+
     def search( self, view_name, handler='_fti', wrapper=None, **params):
         """ Search. Return results from search. Use couchdb-lucene 
         with its default settings by default."""
@@ -626,6 +1294,8 @@ class Database(object):
         else:
             doc1 = doc
 
+        if self.doc_cache is not None:
+            self.doc_cache.delete(self, doc1['_id'])
         docid = self.escape_docid(doc1['_id'])
         res = self.res(docid).put(name, payload=content, 
                 headers=headers, rev=doc1['_rev'])
@@ -642,6 +1312,8 @@ class Database(object):
     
         @return: dict, with member ok set to True if delete was ok.
         """
+        if self.doc_cache is not None:
+            self.doc_cache.delete(self, doc['_id'])
         docid = self.escape_docid(doc['_id'])
         name = url_quote(name, safe="")
         
@@ -748,6 +1420,87 @@ class ViewResults(object):
             else:
                 yield row
                     
+    def stream(self):
+        """ iterate over rows without keeping them in memory. With a
+        large `keys` list, rows are yielded as soon as the chunk
+        containing their key has been fetched. """
+        view = self.view
+        wrapper = view._wrapper
+        row_class = view._row_class
+        pool = {}
+        for row in view._iter_rows(**self.params):
+            if row_class is not None:
+                row = row_class.from_dict(row, pool=pool)
+            if wrapper is not None:
+                row = wrapper(row)
+            yield row
+
+    def to_columns(self, fields=('id', 'key', 'value')):
+        """ decode rows in columns. Numeric columns are returned as
+        `array.array` ('l' for integers, 'd' for floats, None values are
+        NaN), others are lists where equal strings share the same object.
+        The type of a column is given by its first value not None. Rows
+        aren't kept in memory if results weren't already fetched.
+        
+        @param fields: list of fields to extract. A field could be a
+        dotted path in the row, like 'key.0' or 'value.sum'.
+
+        @return: dict of columns by field
+        """
+        if self._result_cache is not None:
+            rows = self._result_cache.get('rows', [])
+        else:
+            rows = self.view._iter_rows(**self.params)
+
+        pool = {}
+        getters = [(field, _field_getter(field)) for field in fields]
+        columns = [_ColumnBuilder(pool) for field in fields]
+        for row in rows:
+            for (field, getter), column in zip(getters, columns):
+                column.append(getter(row))
+
+        result = {}
+        for field, column in zip(fields, columns):
+            if column.values is None:
+                result[field] = [None] * column.nones
+            else:
+                result[field] = column.values
+        return result
+
+    def to_arrays(self, fields=('id', 'key', 'value'), dtypes=None):
+        """ same as `to_columns` but return NumPy arrays. Numeric
+        columns are converted without copy.
+        
+        @param fields: list of fields to extract, see `to_columns`
+        @param dtypes: dict, NumPy dtype of some fields. Default is
+        int64/float64 for numeric columns and object for others.
+
+        @return: dict of NumPy arrays by field
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("NumPy is needed to use ViewResults.to_arrays")
+
+        dtypes = dtypes or {}
+        result = {}
+        for field, column in self.to_columns(fields).iteritems():
+            dtype = dtypes.get(field)
+            if isinstance(column, array):
+                values = numpy.frombuffer(column, 
+                        dtype=numpy.dtype(column.typecode))
+                if dtype is not None:
+                    values = values.astype(dtype)
+            elif dtype is not None:
+                values = numpy.array(column, dtype=dtype)
+            else:
+                # fill one by one so list keys stay objects
+                values = numpy.empty(len(column), dtype=object)
+                for i, value in enumerate(column):
+                    values[i] = value
+            result[field] = values
+        return result
+
     def first(self):
         """
         Return the first result of this query or None if the result doesn’t contain any row.
@@ -792,6 +1545,17 @@ class ViewResults(object):
 
     def fetch(self):
         """ fetch results and cache them """
+        self._load_result(self._fetch_result(self.view))
+
+    def _fetch_result(self, view):
+        """ execute the query with `view`, which could be a clone of
+        the view used in another thread. """
+        cache = view._cache
+        if cache:
+            return cache.fetch(view, self.params)
+        return view._exec(**self.params)
+
+    def _load_result(self, result):
         # reset dynamic keys
         for key in  self._dynamic_keys:
             try:
@@ -799,8 +1563,15 @@ class ViewResults(object):
             except:
                 pass
         self._dynamic_keys = []
-        
-        self._result_cache = self.view._exec(**self.params)
+
+        self._result_cache = result
+        row_class = self.view._row_class
+        if row_class is not None:
+            rows = self._result_cache.get('rows', [])
+            pool = {}
+            for i, row in enumerate(rows):
+                # replace rows in place so decoded dicts are released
+                rows[i] = row_class.from_dict(row, pool=pool)
         self._total_rows = self._result_cache.get('total_rows')
         self._offset = self._result_cache.get('offset', 0)
         
@@ -848,6 +1619,15 @@ class ViewResults(object):
             params['key'] = key
         
         return ViewResults(self.view, **params)
+
+    def paginate(self, per_page=25, prefetch=False):
+        """ return a :class:`Paginator` over this query. 
+
+        @param per_page: int, number of rows by page
+        @param prefetch: bool, if True next page is fetched in background
+        while the current one is used.
+        """
+        return Paginator(self, per_page=per_page, prefetch=prefetch)
         
     def __iter__(self):
         return self.iterator()
@@ -857,45 +1637,680 @@ class ViewResults(object):
 
     def __nonzero__(self):
         return bool(len(self))
+
+
+class MultiQuery(object):
+    """ Run several view queries of a database at once. 
+    
+    Queries on the same view are sent in one request when the server 
+    supports multiple queries (CouchDB >= 2.2), others are run in 
+    parallel, using at most `max_size` connections of the server.
+
+        >>> multi = MultiQuery(db)
+        >>> by_day = multi.add('stats/by_day', group=True)
+        >>> last = multi.add('blog/by_date', descending=True, limit=10)
+        >>> results = multi.execute()
+
+    `execute` returns the fetched `ViewResults` in the order they were
+    added. If a query failed, the exception raised is returned in place
+    of its results.
+    """
+
+    def __init__(self, db, max_workers=None):
+        """
+        @param db: `Database` instance
+        @param max_workers: maximum number of concurrent requests, 
+        default is `max_size` of the server.
+        """
+        self.db = db
+        if max_workers is None:
+            max_workers = db.server.max_size
+        self.max_workers = max_workers
+        self.queries = []
+
+    def add(self, query, **params):
+        """ add a query. `query` is a view name or a `ViewResults`
+        instance, params are added to its params.
+
+        @return: `ViewResults` instance that will contain results.
+        """
+        if isinstance(query, basestring):
+            results = self.db.view(query, **params)
+        elif isinstance(query, ViewResults):
+            if params:
+                query_params = query.params.copy()
+                query_params.update(params)
+                query = ViewResults(query.view, **query_params)
+            results = query
+        else:
+            raise TypeError("query should be a view name or a ViewResults"
+                    " instance")
+        self.queries.append(results)
+        return results
+
+    def _groups(self):
+        """ group queries that could be sent in one request """
+        use_multi = len(self.queries) > 1 and \
+                self.db.server.version() >= (2, 2)
+        groups = {}
+        ordered = []
+        for idx, results in enumerate(self.queries):
+            view = results.view
+            if use_multi and isinstance(view, View) and not view._cache \
+                    and not results.params.get('_raw_json') \
+                    and view._db.dbname == self.db.dbname:
+                key = view.view_path
+                if key not in groups:
+                    groups[key] = []
+                    ordered.append(groups[key])
+                groups[key].append(idx)
+            else:
+                ordered.append([idx])
+        return ordered
+
+    def _multi_fetch(self, db, view_path, queries):
+        payload = {"queries": [self._json_params(results.params) 
+                                for results in queries]}
+        res = db.res.post('%s/queries' % view_path, payload=payload)
+        return res['results']
+
+    def _json_params(self, params):
+        json_params = {}
+        for name, value in params.items():
+            if value in ('true', 'false'):
+                value = (value == 'true')
+            json_params[name] = value
+        return json_params
+
+    def execute(self):
+        """ run all queries and return their results """
+        groups = self._groups()
+        funcs = []
+        for group in groups:
+            queries = [self.queries[idx] for idx in group]
+            if len(group) > 1:
+                funcs.append(lambda queries=queries: self._multi_fetch(
+                    self.db._clone(), queries[0].view.view_path, queries))
+            else:
+                funcs.append(lambda results=queries[0]: 
+                        [results._fetch_result(results.view._clone())])
+
+        outputs, errors = _run_parallel(funcs, self.max_workers)
+
+        all_results = [None] * len(self.queries)
+        for group, output, error in zip(groups, outputs, errors):
+            for i, idx in enumerate(group):
+                if error is not None:
+                    all_results[idx] = error[1]
+                else:
+                    results = self.queries[idx]
+                    results._load_result(output[i])
+                    all_results[idx] = results
+        return all_results
+
+
+class Row(object):
+    """ Compact view row. A row only stores its fields (`id`, `key`, 
+    `value`, `doc`, `error`) in slots instead of a dict, which makes a 
+    big difference with large results:
+
+        >>> results = db.view('stats/by_day', row_class=Row)
+        >>> row = results.first()
+        >>> row.key, row.value
+
+    Row also supports the mapping interface of rows decoded as dicts 
+    (`row['key']`, `row.get('doc')`, ...) so existing wrappers keep 
+    working. Fields that aren't in the row aren't set. 
+    """
+    __slots__ = ('id', 'key', 'value', 'doc', 'error', '_extra')
+
+    _fields = ('id', 'key', 'value', 'doc', 'error')
+
+    def __init__(self, **fields):
+        for name, value in fields.iteritems():
+            self[name] = value
+
+    @classmethod
+    def from_dict(cls, row, pool=None):
+        """ create a row from a decoded row. If `pool` is a dict, string
+        keys are shared between rows having the same key. """
+        obj = cls.__new__(cls)
+        for name, value in row.iteritems():
+            if name == 'key' and pool is not None:
+                if isinstance(value, basestring):
+                    value = pool.setdefault(value, value)
+                elif isinstance(value, list):
+                    for i, item in enumerate(value):
+                        if isinstance(item, basestring):
+                            value[i] = pool.setdefault(item, item)
+            obj[name] = value
+        return obj
+
+    def to_dict(self):
+        """ return the row as a dict """
+        return dict(self.iteritems())
+
+    def keys(self):
+        return [name for name in self]
+
+    def iteritems(self):
+        for name in self:
+            yield name, self[name]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __getitem__(self, name):
+        if name in self._fields:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                pass
+        else:
+            extra = getattr(self, '_extra', None)
+            if extra is not None and name in extra:
+                return extra[name]
+        raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        if name in self._fields:
+            setattr(self, name, value)
+        else:
+            try:
+                extra = self._extra
+            except AttributeError:
+                extra = self._extra = {}
+            extra[name] = value
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def __iter__(self):
+        for name in self._fields:
+            if hasattr(self, name):
+                yield name
+        for name in getattr(self, '_extra', None) or ():
+            yield name
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            self[name] = value
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.to_dict())
+
+
+class Page(object):
+    """ A page of results returned by a :class:`Paginator`. Rows are 
+    wrapped like in the view. `next_token` and `previous_token` could be
+    passed to `Paginator.page` to get next or previous page. They are 
+    None if there is no page in this direction.
+    """
+
+    def __init__(self, paginator, rows, next_token=None, previous_token=None):
+        self.paginator = paginator
+        self.rows = rows
+        self.next_token = next_token
+        self.previous_token = previous_token
+
+    has_next = property(lambda self: self.next_token is not None)
+    has_previous = property(lambda self: self.previous_token is not None)
+
+    def next(self):
+        """ return next page or None """
+        if self.next_token is None:
+            return None
+        return self.paginator.page(self.next_token)
+
+    def previous(self):
+        """ return previous page or None """
+        if self.previous_token is None:
+            return None
+        return self.paginator.page(self.previous_token)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        return self.rows[idx]
+
+
+class Paginator(object):
+    """ Paginate view results without using `skip`. Each page is 
+    fetched with `limit=per_page+1`, the extra row gives the 
+    `startkey`/`startkey_docid` of the next page, so deep pages are as 
+    fast as the first one.
+
+    Example:
+
+        >>> paginator = db.view('blog/by_date', descending=True).paginate(20)
+        >>> page = paginator.page()
+        >>> page = paginator.page(page.next_token)
+        >>> page = paginator.page(page.previous_token)
+
+    Tokens are opaque strings that could be used in urls.
+    """
+
+    def __init__(self, view_results, per_page=25, prefetch=False):
+        """ 
+        @param view_results: `ViewResults` instance to paginate.
+        @param per_page: int, number of rows by page
+        @param prefetch: bool, if True next page is fetched in 
+        background while the current one is used.
+        """
+        if per_page < 1:
+            raise ValueError("per_page should be a positive integer")
+
+        params = view_results.params.copy()
+        if 'keys' in params:
+            raise ValueError("a query with keys can't be paginated")
+        for name in ('limit', 'skip'):
+            params.pop(name, None)
+        if 'key' in params:
+            key = params.pop('key')
+            params['startkey'] = params['endkey'] = key
+
+        self.view = view_results.view
+        self.params = params
+        self.per_page = per_page
+        self.prefetch = prefetch
+        self.descending = params.get('descending') in (True, 'true')
+        self._prefetched = {}
+
+    def _encode_token(self, direction, key, docid):
+        return base64.urlsafe_b64encode(anyjson.serialize([direction, 
+                        key, docid]))
+
+    def _decode_token(self, token):
+        try:
+            direction, key, docid = anyjson.deserialize(
+                    base64.urlsafe_b64decode(str(token)))
+        except (TypeError, ValueError):
+            raise ValueError("invalid page token %r" % token)
+        if direction not in ('next', 'previous'):
+            raise ValueError("invalid page token %r" % token)
+        return direction, key, docid
+
+    def _page_params(self, token):
+        params = self.params.copy()
+        params['limit'] = self.per_page + 1
+        if token is None:
+            return params
+
+        direction, key, docid = self._decode_token(token)
+        params['startkey'] = key
+        if docid is not None:
+            params['startkey_docid'] = docid
+        else:
+            params.pop('startkey_docid', None)
+
+        if direction == 'previous':
+            # read the view backward from the first row of the current
+            # page, this row is skipped.
+            params['descending'] = not self.descending
+            params['skip'] = 1
+            for name in ('endkey', 'endkey_docid', 'inclusive_end'):
+                params.pop(name, None)
+            if 'startkey' in self.params:
+                params['endkey'] = self.params['startkey']
+                if 'startkey_docid' in self.params:
+                    params['endkey_docid'] = self.params['startkey_docid']
+        return params
+
+    def _fetch(self, view, token):
+        results = ViewResults(view, **self._page_params(token))
+        results.fetch()
+        return results._result_cache.get('rows', [])
+
+    def page(self, token=None):
+        """ return a :class:`Page`. If token is None, the first page is
+        returned. """
+        call = self._prefetched.pop(token, None)
+        self._prefetched.clear()
+        if call is not None:
+            rows = call.result()
+        else:
+            rows = self._fetch(self.view, token)
+
+        direction = None
+        if token is not None:
+            direction, key, docid = self._decode_token(token)
+
+        more = len(rows) > self.per_page
+        page_rows = rows[:self.per_page]
+        next_token = previous_token = None
+        if direction == 'previous':
+            page_rows.reverse()
+            # the row we started from is the first one of next page
+            next_token = self._encode_token('next', key, docid)
+            if more and page_rows:
+                previous_token = self._encode_token('previous',
+                        page_rows[0].get('key'), page_rows[0].get('id'))
+        else:
+            if more:
+                extra = rows[self.per_page]
+                next_token = self._encode_token('next', extra.get('key'),
+                        extra.get('id'))
+            if direction == 'next' and page_rows:
+                previous_token = self._encode_token('previous',
+                        page_rows[0].get('key'), page_rows[0].get('id'))
+
+        if self.prefetch and next_token is not None:
+            self._prefetched[next_token] = _BackgroundCall(self._fetch,
+                    self.view._clone(), next_token)
+
+        wrapper = self.view._wrapper
+        if wrapper is not None:
+            page_rows = [wrapper(row) for row in page_rows]
+        return Page(self, page_rows, next_token=next_token,
+                previous_token=previous_token)
         
         
 class ViewInterface(object):
     """ Generic object interface used by View and TempView objects. """
     
-    def __init__(self, db, wrapper=None):
+    def __init__(self, db, wrapper=None, cache=None, row_class=None):
         self._db = db
         self._wrapper = wrapper
+        self._cache = cache
+        self._row_class = row_class
         
     def __call__(self, **params):
         return ViewResults(self, **params)
         
     def __iter__(self):
         return self()
+
+    def _clone(self):
+        """ return a copy of this view bound to a clone of its
+        database, so it could be executed from another thread. """
+        view = copy.copy(self)
+        view._db = self._db._clone()
+        return view
         
     def _exec(self, **params):
         raise NotImplementedError
+
+    def _iter_rows(self, **params):
+        """ iterate over rows of the view for `params` """
+        params.pop('_raw_json', None)
+        return iter(self._exec(**params).get('rows', []))
+
+    def _cache_key(self, params):
+        """ key of results for `params` in a view cache """
+        params = self._db.res.encode_params(params)
+        return ((self._db.server.uri, self._db.dbname), self._cache_path(),
+                tuple(sorted(params.items())))
+
+    def _cache_path(self):
+        raise NotImplementedError
         
+class _FullReduce(Exception):
+    """ raised when a chunk of a keys query returned a reduce without
+    group, rows of chunks can't be merged """
+
 class View(ViewInterface):
-    """ Object used to wrap a view and return ViewResults. Generally called. """
+    """ Object used to wrap a view and return ViewResults. Generally called.
+    
+    Queries with a large `keys` list are deduplicated, split in chunks of
+    at most `keys_chunk_count` keys and `keys_chunk_bytes` bytes of JSON, 
+    and chunks are fetched in parallel. Rows are returned in the order of
+    the original keys.
+    """
+
+    keys_chunk_count = 1000
+    keys_chunk_bytes = 64 * 1024
     
-    def __init__(self, db, view_path, wrapper=None):
-        ViewInterface.__init__(self, db, wrapper=wrapper)
+    def __init__(self, db, view_path, wrapper=None, cache=None,
+            row_class=None):
+        ViewInterface.__init__(self, db, wrapper=wrapper, cache=cache,
+                row_class=row_class)
         self.view_path = view_path
+
+    def _cache_path(self):
+        return self.view_path
               
     def _exec(self, **params):
         if 'keys' in params:
             keys = params.pop('keys')
-            return self._db.res.post(self.view_path, payload={ 'keys': keys }, **params)
+            chunks = self._keys_chunks(keys)
+            if chunks is None:
+                return self._post_keys(keys, params)
+
+            raw_json = params.pop('_raw_json', False)
+            meta = {}
+            try:
+                rows = list(self._iter_chunked_rows(keys, chunks, params,
+                    meta))
+            except _FullReduce:
+                # reduce over all keys, can't be computed by chunks
+                params['_raw_json'] = raw_json
+                return self._post_keys(keys, params)
+            result = { 'total_rows': meta.get('total_rows'), 'offset': 0,
+                    'rows': rows }
+            if meta.get('update_seq') is not None:
+                result['update_seq'] = meta['update_seq']
+            if raw_json:
+                return anyjson.serialize(result)
+            return result
         else:
-            return self._db.res.get(self.view_path, **params)
+            return self._get(params)
+
+    def _iter_rows(self, **params):
+        params.pop('_raw_json', None)
+        if 'keys' in params:
+            keys = params.pop('keys')
+            chunks = self._keys_chunks(keys)
+            if chunks is not None:
+                return self._iter_keys_rows(keys, chunks, params)
+            return iter(self._post_keys(keys, params).get('rows', []))
+        return iter(self._exec(**params).get('rows', []))
+
+    def _iter_keys_rows(self, keys, chunks, params):
+        try:
+            for row in self._iter_chunked_rows(keys, chunks, params, {}):
+                yield row
+        except _FullReduce:
+            for row in self._post_keys(keys, params).get('rows', []):
+                yield row
+
+    def _get(self, params):
+        return self._db.res.get(self.view_path, **params)
+
+    def _post_keys(self, keys, params):
+        return self._db.res.post(self.view_path, payload={ 'keys': keys },
+                **params)
+
+    def _keys_chunks(self, keys):
+        """ return list of (hash, keys) chunks of unique keys or None
+        if `keys` can be sent in one request. """
+        if len(keys) < 2:
+            return None
+
+        seen = set()
+        chunks = []
+        chunk = []
+        size = 0
+        total_size = 0
+        for key in keys:
+            key_size = len(anyjson.serialize(key)) + 1
+            total_size += key_size
+            h = _key_hash(key)
+            if h in seen:
+                continue
+            seen.add(h)
+            if chunk and (len(chunk) >= self.keys_chunk_count or 
+                    size + key_size > self.keys_chunk_bytes):
+                chunks.append(chunk)
+                chunk = []
+                size = 0
+            chunk.append((h, key))
+            size += key_size
+        chunks.append(chunk)
+
+        if len(seen) == len(keys) and len(keys) <= self.keys_chunk_count \
+                and total_size <= self.keys_chunk_bytes:
+            return None
+        return chunks
+
+    def _fetch_chunks(self, chunks, params):
+        """ fetch chunks from at most `server.max_size` threads and
+        yield results in order. Each worker has its own clone of the
+        view, reused for the next chunk once its call is done. """
+        max_workers = max(self._db.server.max_size, 1)
+        calls = []
+        pending = iter(chunks)
+        for chunk in pending:
+            keys = [key for h, key in chunk]
+            view = self._clone()
+            calls.append((_BackgroundCall(view._post_keys, keys, params),
+                view))
+            if len(calls) >= max_workers:
+                break
+
+        while calls:
+            call, view = calls.pop(0)
+            try:
+                result = call.result()
+            except:
+                # don't leave requests running after the error
+                exc_info = sys.exc_info()
+                for other, view in calls:
+                    other.join()
+                raise exc_info[0], exc_info[1], exc_info[2]
+            for chunk in pending:
+                keys = [key for h, key in chunk]
+                calls.append((_BackgroundCall(view._post_keys, keys, params),
+                    view))
+                break
+            yield result
+
+    def _iter_chunked_rows(self, keys, chunks, params, meta):
+        """ yield rows of chunks in the order of `keys`. Rows are
+        matched to their key with `_key_hash` and are yielded once the
+        chunk containing it has been fetched. Duplicated keys yield their
+        rows each time. """
+        params = params.copy()
+        skip = int(params.pop('skip', 0) or 0)
+        limit = params.pop('limit', None)
+        if limit is not None:
+            limit = int(limit)
+            if limit <= 0:
+                return
+
+        chunk_of = {}
+        for idx, chunk in enumerate(chunks):
+            for h, key in chunk:
+                chunk_of[h] = idx
+        hashes = [_key_hash(key) for key in keys]
+        last_pos = {}
+        for pos, h in enumerate(hashes):
+            last_pos[h] = pos
+
+        rows_by_key = {}
+        pos = 0
+        count = 0
+        for idx, result in enumerate(self._fetch_chunks(chunks, params)):
+            if idx == 0:
+                meta['total_rows'] = result.get('total_rows')
+                meta['update_seq'] = result.get('update_seq')
+            rows = result.get('rows', [])
+            if len(rows) == 1 and 'id' not in rows[0] and \
+                    rows[0].get('key') is None:
+                raise _FullReduce
+            for row in rows:
+                h = _key_hash(row.get('key'))
+                rows_by_key.setdefault(h, []).append(row)
+            
+            while pos < len(hashes) and chunk_of[hashes[pos]] <= idx:
+                h = hashes[pos]
+                if last_pos[h] == pos:
+                    key_rows = rows_by_key.pop(h, [])
+                else:
+                    key_rows = rows_by_key.get(h, [])
+                pos += 1
+                for row in key_rows:
+                    if skip:
+                        skip -= 1
+                        continue
+                    yield row
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
             
 class TempView(ViewInterface):
     """ Object used to wrap a temporary and return ViewResults. """
-    def __init__(self, db, design, wrapper=None):
-        ViewInterface.__init__(self, db, wrapper=wrapper)
+    def __init__(self, db, design, wrapper=None, cache=None,
+            row_class=None):
+        ViewInterface.__init__(self, db, wrapper=wrapper, cache=cache,
+                row_class=row_class)
         self.design = design
         self._wrapper = wrapper
 
+    def _cache_path(self):
+        return anyjson.serialize(self.design)
+
     def _exec(self, **params):
         return self._db.res.post('_temp_view', payload=self.design,
                 **params)
+
+class _PromotedView(View):
+    """ View of the design doc saved by `Database.temp_view` with
+    `promote=True`. If the design doc was deleted, like by
+    `cleanup_auto_views` from another client, it's saved again and the
+    request is retried once. The design doc is only saved before the
+    first request. """
+
+    def __init__(self, db, design, wrapper=None, cache=None,
+            row_class=None):
+        self.design = design
+        self._auto_name = db._auto_view_name(design)
+        self._promoted = False
+        View.__init__(self, db, '_design/%s/_view/view' % self._auto_name,
+            wrapper=wrapper, cache=cache, row_class=row_class)
+
+    def _retry(self, func, *args):
+        if not self._promoted:
+            self._db._promote_temp_view(self.design)
+            self._promoted = True
+        try:
+            return func(self, *args)
+        except ResourceNotFound:
+            self._db._auto_views.pop(self._auto_name, None)
+            self._db._promote_temp_view(self.design)
+            return func(self, *args)
+
+    def _get(self, params):
+        return self._retry(View._get, params)
+
+    def _post_keys(self, keys, params):
+        return self._retry(View._post_keys, keys, params)
@@ -229,6 +229,88 @@ class BaseDocsLoader(object):
         current_design['couchapp'].update({'signatures': all_signatures})
         db[docid] = current_design
 
+PATCH_HANDLER = """function(doc, req) {
+    var fields = JSON.parse(req.body || "{}");
+    if (!doc) {
+        doc = { _id: req.id || req.uuid };
+    }
+    for (var name in fields) {
+        if (name.charAt(0) == "_") {
+            continue;
+        }
+        if (fields[name] === null) {
+            delete doc[name];
+        } else {
+            doc[name] = fields[name];
+        }
+    }
+    return [doc, {
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ ok: true, id: doc._id })
+    }];
+}"""
+
+INCREMENT_HANDLER = """function(doc, req) {
+    var field = req.query.field;
+    var by = parseFloat(req.query.by || "1");
+    if (!field || isNaN(by)) {
+        return [null, {
+            code: 400,
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ error: "bad_request",
+                reason: "a field and a numeric by are required" })
+        }];
+    }
+    if (!doc) {
+        doc = { _id: req.id || req.uuid };
+    }
+    doc[field] = (doc[field] || 0) + by;
+    return [doc, {
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify(doc[field])
+    }];
+}"""
+
+class UpdateHandlersLoader(BaseDocsLoader):
+    """ Load a design doc with generic update handlers, used with
+    `Database.update_handler`:
+
+        >>> UpdateHandlersLoader().sync(db)
+        >>> db.update_handler('couchdbkit/patch', 'mydoc', body={'title': 'new'})
+        ({u'ok': True, u'id': u'mydoc'}, u'3-...')
+        >>> db.update_handler('couchdbkit/increment', 'mydoc', field='hits', by=2)
+        (2, u'4-...')
+
+    `patch` sets the fields of the JSON object sent (null removes a
+    field), `increment` adds `by` (default 1) to the field `field`.
+    Documents are created if they don't exist. `increment` answers with
+    a 400 error if `field` is missing or `by` isn't a number.
+    """
+
+    handlers = {
+        'patch': PATCH_HANDLER,
+        'increment': INCREMENT_HANDLER
+    }
+
+    def __init__(self, design_name='couchdbkit', handlers=None):
+        """
+        @param design_name: str, name of the design doc
+        @param handlers: dict, other update handlers to install by name
+        """
+        self.design_name = design_name
+        self.extra_handlers = handlers or {}
+
+    def get_docs(self):
+        updates = self.handlers.copy()
+        updates.update(self.extra_handlers)
+        return {
+            '_id': '_design/%s' % self.design_name,
+            'language': 'javascript',
+            'updates': updates,
+            '_attachments': {},
+            'couchapp': {}
+        }
+
 class FileSystemDocsLoader(BaseDocsLoader):
     """ Load docs from the filesystem. This loader can find docs
     in folders on the filesystem and is the preferred way to load them. 
@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008-2009 Benoit Chesneau <benoitc@e-engura.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Views computed in the client with python functions. The index is built
+once from `_all_docs` and then updated from the `_changes` feed, so
+unlike temporary views the database isn't scanned on each query:
+
+    >>> def by_type(doc):
+    ...     yield doc.get('type'), 1
+    >>> view = db.local_view(by_type, '_count')
+    >>> view(group=True).all()
+    [{'key': u'post', 'value': 12}, {'key': u'user', 'value': 3}]
+
+Map functions take a document and return or yield (key, value) pairs.
+Reduce functions are called like couchdb javascript reduce functions,
+`reduce(keys, values, rereduce)`. Builtin '_sum', '_count' and '_stats'
+reduce functions are supported.
+
+Strings are compared by their unicode codepoints, not with the ICU
+collation used by couchdb. Objects are compared member by member like in
+couchdb when they keep the order of their members, like OrderedDict
+instances; members of other dicts have no order and are compared sorted
+by name.
+"""
+
+import bisect
+from collections import OrderedDict
+import cPickle
+from hashlib import md5
+import os
+import threading
+import time
+
+import anyjson
+
+from couchdbkit.client import ViewInterface
+
+__all__ = ['LocalView', 'collation_key']
+
+class _Max(object):
+    """ sorts after any value """
+    def __lt__(self, other):
+        return False
+    def __le__(self, other):
+        return other is self
+    def __gt__(self, other):
+        return other is not self
+    def __ge__(self, other):
+        return True
+    def __eq__(self, other):
+        return other is self
+    def __ne__(self, other):
+        return other is not self
+
+_MAX = _Max()
+
+def collation_key(value):
+    """ return a python value sorting like `value` in couchdb views:
+    null, false, true, numbers, strings, arrays then objects. Members of
+    an OrderedDict are compared in their order, members of other dicts
+    sorted by name. """
+    if value is None:
+        return (0,)
+    elif value is False:
+        return (1,)
+    elif value is True:
+        return (2,)
+    elif isinstance(value, (int, long, float)):
+        return (3, value)
+    elif isinstance(value, basestring):
+        return (4, value)
+    elif isinstance(value, (list, tuple)):
+        return (5, tuple([collation_key(item) for item in value]))
+    elif isinstance(value, OrderedDict):
+        return (6, tuple([(collation_key(k), collation_key(v)) \
+                for k, v in value.iteritems()]))
+    elif isinstance(value, dict):
+        return (6, tuple([(collation_key(k), collation_key(v)) \
+                for k, v in sorted(value.items())]))
+    raise TypeError("%r can't be used as a view key" % value)
+
+def _sum(keys, values, rereduce):
+    return sum(values)
+
+def _count(keys, values, rereduce):
+    if rereduce:
+        return sum(values)
+    return len(values)
+
+def _stats(keys, values, rereduce):
+    if rereduce:
+        return {
+            'sum': sum([v['sum'] for v in values]),
+            'count': sum([v['count'] for v in values]),
+            'min': min([v['min'] for v in values]),
+            'max': max([v['max'] for v in values]),
+            'sumsqr': sum([v['sumsqr'] for v in values])
+        }
+    return {
+        'sum': sum(values),
+        'count': len(values),
+        'min': min(values),
+        'max': max(values),
+        'sumsqr': sum([v * v for v in values])
+    }
+
+BUILTIN_REDUCE = {
+    '_sum': _sum,
+    '_count': _count,
+    '_stats': _stats
+}
+
+def _bool(value):
+    if isinstance(value, basestring):
+        return value == 'true'
+    return bool(value)
+
+def _func_signature(func):
+    if func is None or isinstance(func, basestring):
+        return repr(func)
+    code = getattr(func, 'func_code', None)
+    if code is None:
+        return repr(func)
+    return repr((code.co_code, code.co_consts, code.co_names))
+
+
+class LocalView(ViewInterface):
+    """ View computed in the client with a python map function and an
+    optional reduce function. The index is kept in memory, and in a local
+    file if `path` is given. It's updated from the `_changes` feed before
+    each query unless `stale` param is used. The file is written after
+    the build and then at most every `save_interval` seconds, call `close`
+    to save the last changes.
+
+    Entries of the index are tuples (collation key, docid, counter, key,
+    value) kept sorted.
+    """
+
+    reduce_block = 1000
+
+    # minimum time in seconds between two saves of the index by `update`.
+    # `save` and `close` save it at once.
+    save_interval = 60
+
+    def __init__(self, db, map_fun, reduce_fun=None, path=None,
+            wrapper=None, row_class=None, batch_size=1000):
+        """
+        @param db: Database instance
+        @param map_fun: function taking a document and yielding
+        (key, value) pairs
+        @param reduce_fun: function reduce(keys, values, rereduce) or name
+        of a builtin reduce function ('_sum', '_count', '_stats')
+        @param path: path of the file where the index is saved
+        @param wrapper: function used to wrap rows
+        @param row_class: class used to decode rows
+        @param batch_size: number of documents fetched by request
+        """
+        ViewInterface.__init__(self, db, wrapper=wrapper, row_class=row_class)
+        if isinstance(reduce_fun, basestring):
+            try:
+                reduce_fun = BUILTIN_REDUCE[reduce_fun]
+            except KeyError:
+                raise ValueError("unknown reduce function %s" % reduce_fun)
+        self.map_fun = map_fun
+        self.reduce_fun = reduce_fun
+        self.path = path
+        self.batch_size = batch_size
+        self.update_seq = None
+        self._entries = []
+        self._by_doc = {}
+        self._counter = 0
+        self._lock = threading.RLock()
+        # the index changed since it was saved
+        self._unsaved = False
+        self._last_save = 0
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def _signature(self):
+        return md5(_func_signature(self.map_fun) +
+                _func_signature(self.reduce_fun)).hexdigest()
+
+    def _load(self):
+        f = open(self.path, 'rb')
+        try:
+            state = cPickle.load(f)
+        finally:
+            f.close()
+        if state.get('dbname') != self._db.dbname or \
+                state.get('signature') != self._signature():
+            return
+        self.update_seq = state['update_seq']
+        self._entries = state['entries']
+        self._counter = state['counter']
+        self._by_doc = by_doc = {}
+        for entry in self._entries:
+            by_doc.setdefault(entry[1], []).append(entry)
+        self._last_save = time.time()
+
+    def save(self):
+        """ save the index in `path` """
+        if self.path is None:
+            return
+        self._lock.acquire()
+        try:
+            state = {
+                'dbname': self._db.dbname,
+                'signature': self._signature(),
+                'update_seq': self.update_seq,
+                'entries': self._entries,
+                'counter': self._counter
+            }
+            tmp_path = '%s.tmp' % self.path
+            f = open(tmp_path, 'wb')
+            try:
+                cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp_path, self.path)
+            self._unsaved = False
+            self._last_save = time.time()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """ save the index if it changed since it was saved """
+        if self._unsaved:
+            self.save()
+
+    def update(self):
+        """ build or update the index. Return True if the index
+        changed. The index is saved after a build, and then at most
+        every `save_interval` seconds. """
+        self._lock.acquire()
+        try:
+            if self.update_seq is None:
+                self._build()
+                self._unsaved = True
+                self.save()
+                return True
+
+            changed = self._process_changes()
+            if changed:
+                self._unsaved = True
+                if time.time() - self._last_save >= self.save_interval:
+                    self.save()
+            return changed
+        finally:
+            self._lock.release()
+
+    def _build(self):
+        seq = self._db.info()['update_seq']
+        self._entries = []
+        self._by_doc = {}
+        params = { 'include_docs': True, 'limit': self.batch_size + 1 }
+        while True:
+            rows = self._db.res.get('_all_docs', **params)['rows']
+            if len(rows) > self.batch_size:
+                next_row = rows.pop()
+            else:
+                next_row = None
+            entries = []
+            for row in rows:
+                entries.extend(self._map_doc(row['doc']))
+            self._entries.extend(entries)
+            if next_row is None:
+                break
+            params['startkey'] = next_row['id']
+        self._entries.sort()
+        # changes happened during the build are applied by next update
+        self.update_seq = seq
+        self._process_changes()
+
+    def _process_changes(self):
+        changed = False
+        while True:
+            result = self._db.res.get('_changes', since=self.update_seq,
+                    include_docs=True, limit=self.batch_size)
+            results = result.get('results', [])
+            for change in results:
+                docid = change['id']
+                if docid.startswith('_design/'):
+                    continue
+                self._remove_doc(docid)
+                if not change.get('deleted') and change.get('doc'):
+                    for entry in self._map_doc(change['doc']):
+                        bisect.insort(self._entries, entry)
+                changed = True
+            self.update_seq = result.get('last_seq', self.update_seq)
+            if len(results) < self.batch_size:
+                return changed
+
+    def _map_doc(self, doc):
+        docid = doc['_id']
+        if docid.startswith('_design/'):
+            return []
+        emitted = self.map_fun(doc)
+        if emitted is None:
+            return []
+
+        entries = []
+        for key, value in emitted:
+            self._counter += 1
+            entries.append((collation_key(key), docid, self._counter, key,
+                value))
+        if entries:
+            self._by_doc[docid] = entries
+        return entries
+
+    def _remove_doc(self, docid):
+        for entry in self._by_doc.pop(docid, []):
+            idx = bisect.bisect_left(self._entries, entry[:3])
+            if idx < len(self._entries) and self._entries[idx] is entry:
+                del self._entries[idx]
+
+    def _before(self, key, docid=None):
+        """ index of the first entry >= key (and docid) """
+        if docid is None:
+            bound = (collation_key(key),)
+        else:
+            bound = (collation_key(key), docid)
+        return bisect.bisect_left(self._entries, bound)
+
+    def _after(self, key, docid=None):
+        """ index following the last entry <= key (and docid) """
+        if docid is None:
+            bound = (collation_key(key), _MAX)
+        else:
+            bound = (collation_key(key), docid, _MAX)
+        return bisect.bisect_right(self._entries, bound)
+
+    def _select(self, params):
+        """ return entries selected by params, in order """
+        descending = _bool(params.get('descending', False))
+        inclusive_end = _bool(params.get('inclusive_end', True))
+
+        if 'keys' in params:
+            selected = []
+            for key in params['keys']:
+                entries = self._entries[self._before(key):self._after(key)]
+                if descending:
+                    entries.reverse()
+                selected.extend(entries)
+            return selected, 0
+
+        if 'key' in params:
+            params = params.copy()
+            params['startkey'] = params['endkey'] = params['key']
+            inclusive_end = True
+
+        startkey_docid = params.get('startkey_docid')
+        endkey_docid = params.get('endkey_docid')
+        if not descending:
+            lo, hi = 0, len(self._entries)
+            if 'startkey' in params:
+                lo = self._before(params['startkey'], startkey_docid)
+            if 'endkey' in params:
+                if inclusive_end:
+                    hi = self._after(params['endkey'], endkey_docid)
+                else:
+                    hi = self._before(params['endkey'], endkey_docid)
+            return self._entries[lo:max(lo, hi)], lo
+
+        lo, hi = 0, len(self._entries)
+        if 'startkey' in params:
+            hi = self._after(params['startkey'], startkey_docid)
+        if 'endkey' in params:
+            if inclusive_end:
+                lo = self._before(params['endkey'], endkey_docid)
+            else:
+                lo = self._after(params['endkey'], endkey_docid)
+        entries = self._entries[lo:max(lo, hi)]
+        entries.reverse()
+        return entries, len(self._entries) - max(lo, hi)
+
+    def _reduce(self, entries):
+        keys = [[entry[3], entry[1]] for entry in entries]
+        values = [entry[4] for entry in entries]
+        if len(values) <= self.reduce_block:
+            return self.reduce_fun(keys, values, False)
+
+        partials = []
+        for i in range(0, len(values), self.reduce_block):
+            partials.append(self.reduce_fun(keys[i:i + self.reduce_block],
+                values[i:i + self.reduce_block], False))
+        return self.reduce_fun(None, partials, True)
+
+    def _group(self, entries, group_level):
+        """ yield (key, entries) groups of consecutive entries """
+        group = []
+        group_key = group_ckey = None
+        for entry in entries:
+            key = entry[3]
+            if group_level is not None and isinstance(key, list):
+                key = key[:group_level]
+            ckey = collation_key(key)
+            if group and ckey != group_ckey:
+                yield group_key, group
+                group = []
+            group_key, group_ckey = key, ckey
+            group.append(entry)
+        if group:
+            yield group_key, group
+
+    def _fetch_docs(self, docids):
+        docs = {}
+        if not docids:
+            return docs
+        for row in self._db.all_docs(keys=docids, include_docs=True):
+            if row.get('doc') is not None:
+                docs[row['id']] = row['doc']
+        return docs
+
+    def _exec(self, **params):
+        raw_json = params.pop('_raw_json', False)
+        stale = params.get('stale')
+        if stale not in ('ok', 'update_after'):
+            self.update()
+
+        self._lock.acquire()
+        try:
+            entries, offset = self._select(params)
+            total_rows = len(self._entries)
+        finally:
+            self._lock.release()
+
+        skip = int(params.get('skip', 0) or 0)
+        limit = params.get('limit')
+        if limit is not None:
+            limit = int(limit)
+
+        if self.reduce_fun is not None and _bool(params.get('reduce', True)):
+            group_level = params.get('group_level')
+            if group_level is not None:
+                group_level = int(group_level)
+            if group_level:
+                groups = self._group(entries, group_level)
+            elif group_level is None and _bool(params.get('group', False)):
+                groups = self._group(entries, None)
+            # group_level=0 reduces all rows to one with a null key
+            elif entries:
+                groups = [(None, entries)]
+            else:
+                groups = []
+            rows = []
+            for key, group in groups:
+                if skip:
+                    skip -= 1
+                    continue
+                if limit is not None and len(rows) >= limit:
+                    break
+                rows.append({ 'key': key, 'value': self._reduce(group) })
+            result = { 'rows': rows }
+        else:
+            if limit is not None:
+                entries = entries[skip:skip + limit]
+            else:
+                entries = entries[skip:]
+            rows = [{ 'id': entry[1], 'key': entry[3], 'value': entry[4] } \
+                    for entry in entries]
+            if _bool(params.get('include_docs', False)):
+                docs = self._fetch_docs(list(set([row['id'] for row in rows])))
+                for row in rows:
+                    row['doc'] = docs.get(row['id'])
+            result = { 'total_rows': total_rows, 'offset': offset + skip,
+                    'rows': rows }
+
+        if stale == 'update_after':
+            self.update()
+        if raw_json:
+            return anyjson.serialize(result)
+        return result
+
+    def _cache_path(self):
+        return 'local:%s' % self._signature()
@@ -150,6 +150,7 @@ of the CouchDB value type has a corresponding Property class provided by the
 from couchdbkit.schema.properties import *
 from couchdbkit.schema.base import *
 from couchdbkit.schema.properties_proxy import *
+from couchdbkit.schema.session import *
 
 def contain(db, *docs):
     """ associate a db to multiple `Document` class"""
@@ -21,24 +21,26 @@ to map CouchDB document in Python statically, dynamically or both
 import datetime
 import decimal
 import re
+from UserDict import DictMixin
 import warnings
+import weakref
 
 from couchdbkit.client import Database
 from couchdbkit.schema import properties as p
 from couchdbkit.schema.properties import value_to_python, \
 convert_property, MAP_TYPES_PROPERTIES, ALLOWED_PROPERTY_TYPES, \
-LazyDict, LazyList, value_to_json
+LazyDict, LazyList, value_to_json, DICT_TYPES, LIST_TYPES
 from couchdbkit.exceptions import *
 from couchdbkit.resource import ResourceNotFound
 
 
 __all__ = ['ReservedWordError', 'ALLOWED_PROPERTY_TYPES', 'DocumentSchema', 
         'SchemaProperties', 'DocumentBase', 'QueryMixin', 'AttachmentMixin', 
-        'Document', 'StaticDocument', 'valid_id']
+        'Document', 'StaticDocument', 'valid_id', 'wrap_any']
 
-_RESERVED_WORDS = ['_id', '_rev', '$schema', 'type']
+_RESERVED_WORDS = frozenset(['_id', '_rev', '$schema', 'type'])
 
-_NODOC_WORDS = ['doc_type', 'type']
+_NODOC_WORDS = frozenset(['doc_type', 'type'])
 
 def check_reserved_words(attr_name):
     if attr_name in _RESERVED_WORDS:
@@ -51,6 +53,10 @@ def valid_id(value):
         return value
     raise TypeError('id "%s" is invalid' % value)
 
+# schema classes by doc_type, the last class defined for a doc_type wins.
+# Base classes of this module aren't registered.
+_DOC_TYPES = weakref.WeakValueDictionary()
+
 class SchemaProperties(type):
 
     def __new__(cls, name, bases, attrs):
@@ -96,7 +102,77 @@ class SchemaProperties(type):
                 attrs[attr_name] = prop
 
         attrs['_properties'] = properties
-        return type.__new__(cls, name, bases, attrs)        
+        attrs['_property_names'] = frozenset(properties)
+        new_cls = type.__new__(cls, name, bases, attrs)
+        if new_cls.__module__ != __name__:
+            _DOC_TYPES[doc_type] = new_cls
+        return new_cls
+
+    # incremented each time an attribute is added to or removed from a
+    # schema class, cached attribute names are then computed again.
+    _generation = 0
+
+    def __setattr__(cls, name, value):
+        if not hasattr(cls, name):
+            SchemaProperties._generation += 1
+        type.__setattr__(cls, name, value)
+
+    def __delattr__(cls, name):
+        SchemaProperties._generation += 1
+        type.__delattr__(cls, name)
+
+def _attribute_names(cls):
+    """ return a frozenset of the attribute names of a schema class and the
+    reserved words. Values set with these names are not dynamic
+    properties. """
+    cached = cls.__dict__.get('_attribute_names')
+    if cached is None or cached[0] != SchemaProperties._generation:
+        names = frozenset(dir(cls)).union(_RESERVED_WORDS)
+        cached = (SchemaProperties._generation, names)
+        type.__setattr__(cls, '_attribute_names', cached)
+    return cached[1]
+
+def _validation_plan(cls):
+    """ return the checks run by `validate` for a schema class, a list of
+    (property name, function validating its values). The functions are
+    compiled by the properties. The plan is built again when the class or
+    a compiled property changes. """
+    generation = (SchemaProperties._generation, p.Property._generation)
+    cached = cls.__dict__.get('_validation_plan')
+    if cached is None or cached[0] != generation:
+        plan = [(attr_name, prop.validate_function()) for attr_name, prop \
+                in cls._properties.iteritems()]
+        cached = (generation, plan)
+        type.__setattr__(cls, '_validation_plan', cached)
+    return cached[1]
+
+class DictView(DictMixin, object):
+    """ read-only view of a dict, returned by accessors which would
+    copy the dict otherwise """
+
+    def __init__(self, d):
+        self._d = d
+
+    def __getitem__(self, key):
+        return self._d[key]
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def keys(self):
+        return self._d.keys()
+
+    def iteritems(self):
+        return self._d.iteritems()
+
+    def __repr__(self):
+        return repr(self._d)
         
 
 class DocumentSchema(object):
@@ -104,8 +180,15 @@ class DocumentSchema(object):
     
     _dynamic_properties = None
     _allow_dynamic_properties = True
+    # set to True to remember the type found for each dynamic property
+    # when documents are wrapped, it is tried first on next documents.
+    _dynamic_type_hints = False
     _doc = None
     _db = None
+    # names of properties changed since the document was wrapped or saved
+    _dirty_fields = None
+    # (instance, property name) of the document containing this schema
+    _owner = None
     
     def __init__(self, _d=None, **properties):
         self._dynamic_properties = {} 
@@ -152,10 +235,22 @@ class DocumentSchema(object):
             return {}
         return self._dynamic_properties.copy()
 
+    def dynamic_properties_view(self):
+        """ get a read-only view of dynamic properties, without copy """
+        return DictView(self._dynamic_properties or {})
+
     def properties(self):
         """ get dict of defined properties """
         return self._properties.copy()
 
+    def properties_view(self):
+        """ get a read-only view of defined properties, without copy """
+        return DictView(self._properties)
+
+    def property_names(self):
+        """ get the frozenset of defined properties names """
+        return self._property_names
+
     def all_properties(self):
         """ get all properties. 
         Generally we just need to use keys"""
@@ -163,6 +258,28 @@ class DocumentSchema(object):
         all_properties.update(self.dynamic_properties())
         return all_properties
 
+    def _mark_dirty(self, name):
+        dirty_fields = self.__dict__.get('_dirty_fields')
+        if dirty_fields is None:
+            dirty_fields = self.__dict__['_dirty_fields'] = set()
+        dirty_fields.add(name)
+        owner = self.__dict__.get('_owner')
+        if owner is not None:
+            owner[0]._mark_dirty(owner[1])
+
+    def _clear_dirty(self):
+        self.__dict__.pop('_dirty_fields', None)
+
+    def is_dirty(self):
+        """ return True if a property changed since the document was
+        wrapped or saved """
+        return bool(self._dirty_fields)
+
+    def changed_fields(self):
+        """ get the set of properties names changed since the document
+        was wrapped or saved """
+        return set(self._dirty_fields or ())
+
     def to_json(self):
         if self._doc.get('doc_type') is None:
             doc_type = getattr(self, '_doc_type', self.__class__.__name__)
@@ -181,43 +298,39 @@ class DocumentSchema(object):
         
         if key == "_id" and valid_id(value):
             self._doc['_id'] = value
+            self._mark_dirty(key)
         else:
             check_reserved_words(key)
-            if not hasattr( self, key ) and not self._allow_dynamic_properties:
+            if not self._allow_dynamic_properties and not hasattr(self, key):
                 raise AttributeError("%s is not defined in schema (not a valid property)" % key)
             
             elif not key.startswith('_') and \
-                    key not in self.properties() and \
-                    key not in dir(self): 
+                    key not in self._property_names and \
+                    key not in _attribute_names(type(self)): 
                 if type(value) not in ALLOWED_PROPERTY_TYPES and \
-                        not isinstance(value, (p.Property,)):
+                        not isinstance(value, (p.Property, LazyDict, LazyList)):
                     raise TypeError("Document Schema cannot accept values of type '%s'." %
                             type(value).__name__)
                         
                 if self._dynamic_properties is None:
                     self._dynamic_properties = {}
                 
-                if isinstance(value, dict):
-                    if key not in self._doc or not value:
-                        self._doc[key] = {}
-                    elif not isinstance(self._doc[key], dict):
-                        self._doc[key] = {}
-                    value = LazyDict(value, self._doc[key])
-                elif isinstance(value, list):
-                    if key not in self._doc or not value:
-                        self._doc[key] = []
-                    elif not isinstance(self._doc[key], list):
-                        self._doc[key] = []
-                    value = LazyList(value, self._doc[key])
+                if isinstance(value, DICT_TYPES):
+                    self._doc[key] = {}
+                    value = LazyDict(value, self._doc[key],
+                            owner=(self, key), keep_values=True)
+                elif isinstance(value, LIST_TYPES):
+                    self._doc[key] = []
+                    value = LazyList(value, self._doc[key],
+                            owner=(self, key), keep_values=True)
                     
                 self._dynamic_properties[key] = value
 
-                if not isinstance(value, (p.Property,)) and \
-                        not isinstance(value, dict) and \
-                        not isinstance(value, list):
+                if not isinstance(value, (p.Property, LazyDict, LazyList)):
                     if callable(value):
                         value = value()
                     self._doc[key] = convert_property(value)
+                self._mark_dirty(key)
             else:
                 object.__setattr__(self, key, value)
 
@@ -226,6 +339,7 @@ class DocumentSchema(object):
         """
         if key in self._doc:
             del self._doc[key]
+            self._mark_dirty(key)
 
         if self._dynamic_properties and key in self._dynamic_properties:
             del self._dynamic_properties[key]
@@ -236,7 +350,11 @@ class DocumentSchema(object):
         """ get property value 
         """
         if self._dynamic_properties and key in self._dynamic_properties:
-            return self._dynamic_properties[key]
+            value = self._dynamic_properties[key]
+            if isinstance(value, (LazyDict, LazyList)):
+                # its json may have been changed in place
+                value._sync()
+            return value
         elif key == "_id" or key == "_rev":
             return self._doc.get(key)
         return getattr(super(DocumentSchema, self), key)
@@ -276,7 +394,9 @@ class DocumentSchema(object):
         
         @return: True if key exist.
         """ 
-        if key in self.all_properties():
+        if key in self._properties:
+            return True
+        elif self._dynamic_properties and key in self._dynamic_properties:
             return True
         elif key in self._doc:
             return True
@@ -286,11 +406,14 @@ class DocumentSchema(object):
         """ iter document instance properties
         """
 
-        all_properties = self.all_properties()
-
-        for prop, value in all_properties.iteritems():
+        for prop, value in self._properties.iteritems():
             if value is not None:
                 yield (prop, value)
+
+        if self._dynamic_properties:
+            for prop, value in self._dynamic_properties.items():
+                if value is not None:
+                    yield (prop, value)
                 
     iteritems = __iter__
 
@@ -307,11 +430,20 @@ class DocumentSchema(object):
     def __getstate__(self):
         """ let pickle play with us """
         obj_dict = self.__dict__.copy()
+        obj_dict.pop('_python_cache', None)
+        obj_dict.pop('_owner', None)
         return obj_dict
 
     @classmethod
     def wrap(cls, data):
         """ wrap `data` dict in object properties """
+        wrap_fast = cls.__dict__.get('_wrap_fast')
+        if wrap_fast is None:
+            wrap_fast = _compile_wrap(cls)
+            type.__setattr__(cls, '_wrap_fast', wrap_fast)
+        if wrap_fast is not False:
+            return wrap_fast(data)
+
         instance = cls()
         instance._doc = data        
         for prop in instance._properties.values():
@@ -326,8 +458,9 @@ class DocumentSchema(object):
             prop.__property_init__(instance, value)
             
         if cls._allow_dynamic_properties:
+            type_hints = _type_hints(cls)
             for attr_name, value in data.iteritems():
-                if attr_name in instance.properties():
+                if attr_name in cls._property_names:
                     continue
                 if value is None:
                     continue
@@ -336,16 +469,18 @@ class DocumentSchema(object):
                 elif attr_name == 'doc_type':
                     continue
                 else:
-                    value = value_to_python(value)
+                    value = value_to_python(value, type_hints=type_hints,
+                            name=attr_name)
                     setattr(instance, attr_name, value)
+        instance._clear_dirty()
         return instance
 
     def validate(self, required=True):
         """ validate a document """
-        for attr_name, value in self._doc.items():
-            if attr_name in self._properties:
-                self._properties[attr_name].validate(
-                        getattr(self, attr_name), required=required)
+        doc = self._doc
+        for attr_name, validate in _validation_plan(type(self)):
+            if attr_name in doc:
+                validate(getattr(self, attr_name), required)
         return True
      
     def clone(self, **kwargs):
@@ -382,6 +517,71 @@ class DocumentSchema(object):
                 attrs[attr_name] = prop
         return type('AnonymousSchema', (cls,), properties)
 
+def _type_hints(cls):
+    """ return the dict of types found for dynamic properties of the
+    class or None if `_dynamic_type_hints` isn't set """
+    if not cls._dynamic_type_hints:
+        return None
+    type_hints = cls.__dict__.get('_type_hints')
+    if type_hints is None:
+        type_hints = {}
+        type.__setattr__(cls, '_type_hints', type_hints)
+    return type_hints
+
+def _compile_wrap(cls):
+    """ build the wrap function of a schema class. The instance is created
+    without calling __init__ and values of declared properties are kept
+    as they are stored, they are converted when they are read. Only
+    missing properties get their default value. 
+
+    Return False if the class define its own __init__ or __setattr__, 
+    the generic wrap is then used. """
+    if cls.__init__.im_func not in _BASE_INITS or \
+            cls.__setattr__.im_func is not DocumentSchema.__setattr__.im_func:
+        return False
+
+    properties = cls._properties
+    prop_items = properties.items()
+    new = object.__new__
+
+    def wrap_fast(data):
+        instance = new(cls)
+        instance_dict = instance.__dict__
+        dynamic_properties = {}
+        instance_dict['_dynamic_properties'] = dynamic_properties
+        instance_dict['_doc'] = data
+
+        for name, prop in prop_items:
+            if data.get(name) is None:
+                prop.__property_init__(instance, prop.default_value())
+
+        if not cls._allow_dynamic_properties:
+            instance_dict.pop('_dirty_fields', None)
+            return instance
+
+        type_hints = _type_hints(cls)
+        # names handled by __setattr__ instead of being dynamic properties
+        setattr_names = _attribute_names(cls)
+        for key, value in data.items():
+            if value is None or key in properties or key == 'doc_type' or \
+                    key.startswith('_'):
+                continue
+            if key in setattr_names:
+                setattr(instance, key, value_to_python(value,
+                    type_hints=type_hints, name=key))
+            elif isinstance(value, dict):
+                dynamic_properties[key] = LazyDict(doc=value,
+                        owner=(instance, key), keep_values=True)
+            elif isinstance(value, list):
+                dynamic_properties[key] = LazyList(doc=value,
+                        owner=(instance, key), keep_values=True)
+            else:
+                dynamic_properties[key] = value_to_python(value,
+                        type_hints=type_hints, name=key)
+        instance_dict.pop('_dirty_fields', None)
+        return instance
+    return wrap_fast
+
 class DocumentBase(DocumentSchema):
     """ Base Document object that map a CouchDB Document.
     It allow you to statically map a document by 
@@ -430,10 +630,13 @@ class DocumentBase(DocumentSchema):
         return db
     
     def save(self, **params):
-        """ Save document in database.
+        """ Save document in database. Nothing is sent when the document
+        was already saved and no property changed since.
             
         @params db: couchdbkit.core.Database instance
         """
+        if self._doc.get('_rev') is not None and not self.is_dirty():
+            return
         self.validate()    
         if self._db is None:
             raise TypeError("doc database required to save document")
@@ -444,11 +647,13 @@ class DocumentBase(DocumentSchema):
             self._doc.update({'_id': doc['_id'], '_rev': doc['_rev']})
         elif '_id' in doc:
             self._doc.update({'_id': doc['_id']})
+        self._clear_dirty()
         
     store = save
 
     @classmethod
-    def bulk_save(cls, docs, use_uuids=True, all_or_nothing=False):
+    def bulk_save(cls, docs, use_uuids=True, all_or_nothing=False,
+            validate=False):
         """ Save multiple documents in database.
             
         @params docs: list of couchdbkit.schema.Document instance
@@ -457,14 +662,56 @@ class DocumentBase(DocumentSchema):
         restarts either all the changes will have been saved or none of them. 
         However, it does not do conflict checking, so the documents will 
         be committed even if this creates conflicts.
-        
+        @param validate: bool, validate documents with `validate_many`
+        before saving them
+
+        Documents already saved and not changed since are not sent.
+
+        @return: list of results of saved documents
         """
         if cls._db is None:
             raise TypeError("doc database required to save document")
         docs_to_save= [doc._doc for doc in docs if doc._doc_type == cls._doc_type]
         if not len(docs_to_save) == len(docs):
             raise ValueError("one of your documents does not have the correct type")
-        cls._db.bulk_save(docs_to_save, use_uuids=use_uuids, all_or_nothing=all_or_nothing)
+        docs = [doc for doc in docs if doc._doc.get('_rev') is None or \
+                doc.is_dirty()]
+        if not docs:
+            return []
+        if validate:
+            cls.validate_many(docs)
+        results = cls._db.bulk_save([doc._doc for doc in docs],
+                use_uuids=use_uuids, all_or_nothing=all_or_nothing)
+        for doc, result in zip(docs, results):
+            if 'error' not in result:
+                doc._clear_dirty()
+        return results
+
+    @classmethod
+    def validate_many(cls, docs, required=True):
+        """ validate a list of documents and report errors of all
+        documents at once.
+
+        @param docs: list of couchdbkit.schema.Document instance
+        @param required: bool, check required properties
+
+        @raise BadValueError: if one document or more aren't valid. The
+        `errors` attribute of the exception is the list of (doc, error)
+        tuples.
+        """
+        docs = list(docs)
+        errors = []
+        for doc in docs:
+            try:
+                doc.validate(required=required)
+            except BadValueError, e:
+                errors.append((doc, e))
+        if errors:
+            error = BadValueError("%s of %s documents are not valid: %s" % (
+                len(errors), len(docs), "; ".join([str(e) for doc, e in errors])))
+            error.errors = errors
+            raise error
+        return True
     
     @classmethod
     def get(cls, docid, rev=None, db=None, dynamic_properties=True):
@@ -521,6 +768,8 @@ class DocumentBase(DocumentSchema):
         del self._doc['_id']
         del self._doc['_rev']
     
+_BASE_INITS = (DocumentSchema.__init__.im_func, DocumentBase.__init__.im_func)
+
 class AttachmentMixin(object):
     """
     mixin to manage doc attachments.
@@ -572,32 +821,39 @@ class AttachmentMixin(object):
         
 class QueryMixin(object):
     """ Mixin that add query methods """
+
+    @classmethod
+    def wrap_row(cls, row):
+        """ wrap a view row in a document instance. The document is
+        included in the row or emitted as value. Other rows are returned
+        unchanged.
+
+        @param row: dict, row of view results
+        """
+        data = row.get('value')
+        docid = row.get('id')
+
+        if not data or data is None:
+            doc = row.get('doc', False)
+            if doc:
+                return cls.wrap(doc)
+            return row
+            
+        if not isinstance(data, dict) or not docid:
+            return row
+            
+        data['_id'] = docid
+        if 'rev' in data:
+            data['_rev'] = data.pop('rev')
+        obj = cls.wrap(data)
+        return obj
     
     @classmethod
     def __view(cls, view_type=None, data=None, wrapper=None, 
     dynamic_properties=True, **params):
-        def default_wrapper(row):
-            data = row.get('value')
-            docid = row.get('id')
-
-            if not data or data is None:
-                doc = row.get('doc', False)
-                if doc:
-                    return cls.wrap(doc)
-                return row
-                
-            if not isinstance(data, dict) or not docid:
-                return row
-                
-            data['_id'] = docid
-            if 'rev' in data:
-                data['_rev'] = data.pop('rev')
-            cls._allow_dynamic_properties = dynamic_properties
-            obj = cls.wrap(data)
-            return obj
-        
+        cls._allow_dynamic_properties = dynamic_properties
         if wrapper is None:
-            wrapper = default_wrapper
+            wrapper = cls.wrap_row
             
         if not wrapper:
             wrapper = None
@@ -644,6 +900,32 @@ class QueryMixin(object):
         return cls.__view(view_type="temp_view", data=design, wrapper=wrapper, 
             dynamic_properties=dynamic_properties, **params) 
         
+def wrap_any(row):
+    """ wrap a view row, or a document, with the schema class defined for
+    its `doc_type`. The document is the row itself, is included in the row
+    or is emitted as value. Rows without a known doc_type are returned
+    unchanged.
+
+    @param row: dict, row of view results or document
+    """
+    if 'doc_type' in row:
+        data = row
+    else:
+        data = row.get('doc')
+        if not data:
+            data = row.get('value')
+            if not isinstance(data, dict) or not row.get('id'):
+                return row
+
+    cls = _DOC_TYPES.get(data.get('doc_type'))
+    if cls is None:
+        return row
+    if data is row.get('value'):
+        data['_id'] = row['id']
+        if 'rev' in data:
+            data['_rev'] = data.pop('rev')
+    return cls.wrap(data)
+
 class Document(DocumentBase, QueryMixin, AttachmentMixin):
     """
     Full featured document object implementing the following :
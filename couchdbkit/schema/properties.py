@@ -19,6 +19,7 @@
 from calendar import timegm
 import decimal
 import datetime
+import operator
 import re
 import time
 
@@ -55,6 +56,104 @@ re_time = re.compile('^([01]\d|2[0-3])\D?([0-5]\d)\D?([0-5]\d)?\D?(\d{3})?$')
 re_datetime = re.compile('^(\d{4})\D?(0[1-9]|1[0-2])\D?([12]\d|0[1-9]|3[01])(\D?([01]\d|2[0-3])\D?([0-5]\d)\D?([0-5]\d)?\D?(\d{3})?([zZ]|([\+-])([01]\d|2[0-3])\D?([0-5]\d)?)?)?$')
 re_decimal = re.compile('^(\d+).(\d+)$')
 
+# fast ISO 8601 parsing & formatting. Values written by couchdbkit have
+# fixed formats (2009-02-06T18:58:20Z, 2009-02-06, 18:58:20) and are
+# converted with string slicing; others go through strptime. Parsed
+# values are immutable and kept in a small memo cache since the same
+# dates come back again and again in view results.
+
+ISO_CACHE_SIZE = 1000
+
+def _memoize_iso(parse):
+    cache = {}
+    def memoized(value):
+        try:
+            return cache[value]
+        except KeyError:
+            pass
+        result = parse(value)
+        if len(cache) >= ISO_CACHE_SIZE:
+            cache.clear()
+        cache[value] = result
+        return result
+    memoized.__name__ = parse.__name__
+    memoized.__doc__ = parse.__doc__
+    return memoized
+
+def _parse_datetime(value):
+    """ convert an ISO 8601 string to a datetime.datetime object """
+    if (len(value) == 20 and value[19] == 'Z' or len(value) == 19) and \
+            value[4] == '-' and value[7] == '-' and value[10] == 'T' and \
+            value[13] == ':' and value[16] == ':':
+        digits = value[:4] + value[5:7] + value[8:10] + value[11:13] + \
+                value[14:16] + value[17:19]
+        if digits.isdigit():
+            try:
+                return datetime.datetime(int(digits[:4]), int(digits[4:6]),
+                        int(digits[6:8]), int(digits[8:10]),
+                        int(digits[10:12]), int(digits[12:]))
+            except ValueError:
+                pass
+    try:
+        value = value.split('.', 1)[0] # strip out microseconds
+        value = value.rstrip('Z') # remove timezone separator
+        timestamp = timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+        return datetime.datetime.utcfromtimestamp(timestamp)
+    except ValueError, e:
+        raise ValueError('Invalid ISO date/time %r' % value)
+parse_datetime = _memoize_iso(_parse_datetime)
+
+def _parse_date(value):
+    """ convert an ISO 8601 string to a datetime.date object """
+    if len(value) == 10 and value[4] == '-' and value[7] == '-':
+        digits = value[:4] + value[5:7] + value[8:]
+        if digits.isdigit():
+            try:
+                return datetime.date(int(digits[:4]), int(digits[4:6]),
+                        int(digits[6:]))
+            except ValueError:
+                pass
+    try:
+        return datetime.date(*time.strptime(value, '%Y-%m-%d')[:3])
+    except ValueError, e:
+        raise ValueError('Invalid ISO date %r' % value)
+parse_date = _memoize_iso(_parse_date)
+
+def _parse_time(value):
+    """ convert an ISO 8601 string to a datetime.time object """
+    if len(value) == 8 and value[2] == ':' and value[5] == ':':
+        digits = value[:2] + value[3:5] + value[6:]
+        if digits.isdigit():
+            try:
+                return datetime.time(int(digits[:2]), int(digits[2:4]),
+                        int(digits[4:]))
+            except ValueError:
+                pass
+    try:
+        value = value.split('.', 1)[0] # strip out microseconds
+        return datetime.time(*time.strptime(value, '%H:%M:%S')[3:6])
+    except ValueError, e:
+        raise ValueError('Invalid ISO time %r' % value)
+parse_time = _memoize_iso(_parse_time)
+
+def format_datetime(value):
+    """ convert a datetime.datetime object to the ISO 8601 format
+    saved in couchdb, without microseconds """
+    if value.tzinfo is None:
+        return value.isoformat()[:19] + 'Z'
+    return value.replace(microsecond=0).isoformat() + 'Z'
+
+def format_date(value):
+    """ convert a datetime.date object to ISO 8601 """
+    return value.isoformat()
+
+def format_time(value):
+    """ convert a datetime.time object to ISO 8601, without
+    microseconds """
+    if value.tzinfo is None:
+        return value.isoformat()[:8]
+    return value.replace(microsecond=0).isoformat()
+
 class Property(object):
     """ Property base which all other properties
     inherit."""
@@ -86,6 +185,7 @@ class Property(object):
         self.document_class = document_class
         if self.name is None:
             self.name = property_name
+            self._reset_checks()
 
     def __property_init__(self, document_instance, value):
         """ method used to set value of the property when
@@ -99,14 +199,40 @@ class Property(object):
             return self
 
         value = document_instance._doc.get(self.name)
-        if value is not None:
-            value = self.to_python(value)
-        
-        return value
+        if value is None:
+            return value
+
+        if not self.cache_python:
+            python_value = self.to_python(value)
+            if self.mutable:
+                python_value._owner = (document_instance, self.name)
+            return python_value
+
+        # converted values are kept with the json value they come from,
+        # so they are recomputed when `_doc` is changed.
+        cache = document_instance.__dict__.get('_python_cache')
+        if cache is None:
+            cache = document_instance.__dict__['_python_cache'] = {}
+        cached = cache.get(self.name)
+        if cached is not None and cached[0] is value:
+            python_value = cached[1]
+            if isinstance(python_value, (LazyDict, LazyList)):
+                # `value` may have been changed in place
+                python_value._sync()
+            return python_value
+        python_value = self.to_python(value)
+        if self.mutable:
+            python_value._owner = (document_instance, self.name)
+        cache[self.name] = (value, python_value)
+        return python_value
 
     def __set__(self, document_instance, value):
         value = self.validate(value, required=False)
         document_instance._doc[self.name] = self.to_json(value)
+        cache = document_instance.__dict__.get('_python_cache')
+        if cache:
+            cache.pop(self.name, None)
+        document_instance._mark_dirty(self.name)
 
     def __delete__(self, document_instance):
         pass
@@ -119,29 +245,138 @@ class Property(object):
             default = default()
         return default
 
+    _choices = None
+    _choices_set = None
+    _validators = None
+    _validators_list = ()
+    _required = False
+
+    # incremented when checks already compiled by a property change,
+    # validation plans of the schemas are then built again
+    _generation = 0
+
+    def _reset_checks(self):
+        if self.__dict__.pop('_compiled', None) is not None:
+            Property._generation += 1
+
+    def _get_required(self):
+        return self._required
+
+    def _set_required(self, required):
+        self._required = required
+        self._reset_checks()
+    required = property(_get_required, _set_required)
+
+    def _get_choices(self):
+        return self._choices
+
+    def _set_choices(self, choices):
+        # choices are checked in a set when they are all hashable
+        self._choices = choices
+        self._choices_set = None
+        if choices:
+            try:
+                self._choices_set = frozenset(choices)
+            except TypeError:
+                pass
+        self._reset_checks()
+    choices = property(_get_choices, _set_choices)
+
+    def _get_validators(self):
+        return self._validators
+
+    def _set_validators(self, validators):
+        # list of the callables run by validate
+        self._validators = validators
+        if isinstance(validators, (list, tuple,)):
+            self._validators_list = [validator for validator in validators \
+                    if callable(validator)]
+        elif callable(validators):
+            self._validators_list = [validators]
+        else:
+            self._validators_list = []
+        self._reset_checks()
+    validators = property(_get_validators, _set_validators)
+
+    def in_choices(self, value):
+        """ test if value is one of the choices """
+        if self._choices_set is not None:
+            try:
+                return value in self._choices_set
+            except TypeError:
+                # unhashable value
+                pass
+        for choice in self._choices:
+            if choice == value:
+                return True
+        return False
+
+    # type or tuple of types of valid values. The type isn't checked for
+    # None values, nor for empty values when `check_empty_type` is False.
+    value_types = None
+    check_empty_type = True
+
+    def type_error(self, value):
+        """ return the message of the error raised when `value` isn't an
+        instance of `value_types` """
+        return 'Property %s must be a %s, not a %s' % (self.name,
+                self.data_type.__name__, type(value).__name__)
+
+    def items_check(self):
+        """ return a function checking the items of a container value or
+        None """
+        return None
+
+    def compile_validate(self):
+        """ return a function doing the checks of `validate`. Everything
+        they need (required, choices, validators, value types and items
+        check) is looked up once. """
+        name = self.name
+        is_required = self.required
+        empty = self.empty
+        choices = self._choices
+        in_choices = self.in_choices
+        validators = tuple(self._validators_list)
+        value_types = self.value_types
+        check_empty_type = self.check_empty_type
+        type_error = self.type_error
+        check_items = self.items_check()
+
+        def validate(value, required=True):
+            if required and empty(value):
+                if is_required:
+                    raise BadValueError("Property %s is required." % name)
+            elif choices and not in_choices(value):
+                raise BadValueError('Property %s is %r; must be one of %r' % (
+                    name, value, choices))
+            for validator in validators:
+                validator(value)
+            if value is None or value_types is None or \
+                    not (value or check_empty_type):
+                return value
+            if not isinstance(value, value_types):
+                raise BadValueError(type_error(value))
+            if check_items is not None:
+                check_items(value)
+            return value
+        return validate
+
+    def _compiled_validate(self):
+        compiled = self.__dict__.get('_compiled')
+        if compiled is None:
+            compiled = self._compiled = self.compile_validate()
+        return compiled
+
+    def validate_function(self):
+        """ return the function validating values of the property, the
+        compiled one unless `validate` is overridden """
+        if type(self).validate.im_func is Property.validate.im_func:
+            return self._compiled_validate()
+        return self.validate
+
     def validate(self, value, required=True):
         """ validate value """
-        if required and self.empty(value):
-            if self.required:
-                raise BadValueError("Property %s is required." % self.name)
-        else:
-            if self.choices:
-                match = False
-                for choice in self.choices:
-                    if choice == value:
-                        match = True
-                        break
-                if not match:
-                    raise BadValueError('Property %s is %r; must be one of %r' % (
-                        self.name, value, self.choices))
-        if self.validators:
-            if isinstance(self.validators, (list, tuple,)):
-                for validator in self.validators:
-                    if callable(validator):
-                        validator(value)
-            elif callable(self.validators):
-                self.validators(value)
-        return value
+        return self._compiled_validate()(value, required)
 
     def empty(self, value):
         """ test if value is empty """
@@ -157,6 +392,14 @@ class Property(object):
 
     data_type = None
 
+    # True when to_python is expensive enough to cache its result in
+    # the document instance
+    cache_python = False
+
+    # True when to_python returns an object reporting its changes to the
+    # document (a LazyDict, a LazyList or a DocumentSchema)
+    mutable = False
+
 class StringProperty(Property):
     """ string property str or unicode property 
     
@@ -165,17 +408,11 @@ class StringProperty(Property):
 
     to_python = unicode 
 
-    def validate(self, value, required=True):
-        value = super(StringProperty, self).validate(value,
-                required=required)
+    value_types = basestring
 
-        if value is None:
-            return value
-        
-        if not isinstance(value, basestring):
-            raise BadValueError(
-                'Property %s must be unicode or str instance, not a %s' % (self.name, type(value).__name__))
-        return value
+    def type_error(self, value):
+        return 'Property %s must be unicode or str instance, not a %s' % (
+                self.name, type(value).__name__)
 
     data_type = unicode
 
@@ -189,20 +426,12 @@ class IntegerProperty(Property):
     def empty(self, value):
         return value is None
 
-    def validate(self, value, required=True):
-        value = super(IntegerProperty, self).validate(value,
-                required=required)
+    value_types = (int, long,)
 
-        if value is None:
-            return value
-
-        if value is not None and not isinstance(value, (int, long,)):
-            raise BadValueError(
-                'Property %s must be %s or long instance, not a %s'
-                % (self.name, type(self.data_type).__name__, 
-                    type(value).__name__)) 
-
-        return value 
+    def type_error(self, value):
+        return 'Property %s must be %s or long instance, not a %s' % (
+                self.name, type(self.data_type).__name__,
+                type(value).__name__)
 
     data_type = int
 LongProperty = IntegerProperty
@@ -215,19 +444,11 @@ class FloatProperty(Property):
     to_python = float
     data_type = float
 
-    def validate(self, value, required=True):
-        value = super(FloatProperty, self).validate(value, 
-                required=required)
+    value_types = float
 
-        if value is None:
-            return value
-
-        if not isinstance(value, float):
-            raise BadValueError(
-                'Property %s must be float instance, not a %s'
-                % (self.name, type(value).__name__))
-        
-        return value
+    def type_error(self, value):
+        return 'Property %s must be float instance, not a %s' % (
+                self.name, type(value).__name__)
 Number = FloatProperty
 
 class BooleanProperty(Property):
@@ -238,19 +459,11 @@ class BooleanProperty(Property):
     to_python = bool
     data_type = bool
 
-    def validate(self, value, required=True):
-        value = super(BooleanProperty, self).validate(value, 
-                required=required)
-
-        if value is None:
-            return value
+    value_types = bool
 
-        if value is not None and not isinstance(value, bool):
-            raise BadValueError(
-                'Property %s must be bool instance, not a %s'
-                % (self.name, type(value).__name__))
-        
-        return value
+    def type_error(self, value):
+        return 'Property %s must be bool instance, not a %s' % (
+                self.name, type(value).__name__)
 
 class DecimalProperty(Property):
     """ Decimal property, map to Decimal python object
@@ -258,6 +471,7 @@ class DecimalProperty(Property):
     *ValueType*: decimal.Decimal
     """
     data_type = decimal.Decimal
+    cache_python = True
 
     def to_python(self, value):
         return decimal.Decimal(value)
@@ -279,16 +493,15 @@ class DateTimeProperty(Property):
         self.auto_now = auto_now
         self.auto_now_add = auto_now_add
 
-    def validate(self, value, required=True):
-        value = super(DateTimeProperty, self).validate(value, required=required)
+    check_empty_type = False
 
-        if value is None:
-            return value
+    @property
+    def value_types(self):
+        return self.data_type
 
-        if value and not isinstance(value, self.data_type):
-            raise BadValueError('Property %s must be a %s, current is %s' %
-                          (self.name, self.data_type.__name__, type(value).__name__))
-        return value
+    def type_error(self, value):
+        return 'Property %s must be a %s, current is %s' % (self.name,
+                self.data_type.__name__, type(value).__name__)
 
     def default_value(self):
         if self.auto_now or self.auto_now_add:
@@ -297,13 +510,7 @@ class DateTimeProperty(Property):
 
     def to_python(self, value):
         if isinstance(value, basestring):
-            try:
-                value = value.split('.', 1)[0] # strip out microseconds
-                value = value.rstrip('Z') # remove timezone separator
-                timestamp = timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
-                value = datetime.datetime.utcfromtimestamp(timestamp)
-            except ValueError, e:
-                raise ValueError('Invalid ISO date/time %r' % value)
+            value = parse_datetime(value)
         return value
 
     def to_json(self, value):
@@ -312,9 +519,10 @@ class DateTimeProperty(Property):
         
         if value is None:
             return value
-        return value.replace(microsecond=0).isoformat() + 'Z'
+        return format_datetime(value)
 
     data_type = datetime.datetime
+    cache_python = True
 
     @staticmethod
     def now():
@@ -334,16 +542,13 @@ class DateProperty(DateTimeProperty):
 
     def to_python(self, value):
         if isinstance(value, basestring):
-            try:
-                value = datetime.date(*time.strptime(value, '%Y-%m-%d')[:3])
-            except ValueError, e:
-                raise ValueError('Invalid ISO date %r' % value)
+            value = parse_date(value)
         return value
 
     def to_json(self, value):
         if value is None:
             return value
-        return value.isoformat()
+        return format_date(value)
 
 class TimeProperty(DateTimeProperty):
     """ Date property, like DateTime property but only
@@ -360,17 +565,13 @@ class TimeProperty(DateTimeProperty):
 
     def to_python(self, value):
         if isinstance(value, basestring):
-            try:
-                value = value.split('.', 1)[0] # strip out microseconds
-                value = datetime.time(*time.strptime(value, '%H:%M:%S')[3:6])
-            except ValueError, e:
-                raise ValueError('Invalid ISO time %r' % value)
+            value = parse_time(value)
         return value
 
     def to_json(self, value):
         if value is None:
             return value
-        return value.replace(microsecond=0).isoformat()
+        return format_time(value)
         
 
 class DictProperty(Property):
@@ -393,18 +594,29 @@ class DictProperty(Property):
             required=required, **kwds)
             
     data_type = dict
-    
-    def validate(self, value, required=True):
-        value = super(DictProperty, self).validate(value, required=required)
-        if value and value is not None:
-            if not isinstance(value, dict):
-                raise BadValueError('Property %s must be a dict' % self.name)
-            value = self.validate_dict_contents(value)
-        return value
+    cache_python = True
+    mutable = True
+
+    check_empty_type = False
+
+    @property
+    def value_types(self):
+        # the proxies are defined below
+        return DICT_TYPES
+
+    def type_error(self, value):
+        return 'Property %s must be a dict' % self.name
+
+    def items_check(self):
+        if type(self).validate_dict_contents.im_func is not \
+                DictProperty.validate_dict_contents.im_func:
+            return self.validate_dict_contents
+        return compile_content_check(message='Items of %s dict must all '
+                'be in %s' % (self.name, ALLOWED_PROPERTY_TYPES))
         
     def validate_dict_contents(self, value):
         try:
-            value = validate_dict_content(value)
+            check_content(value)
         except BadValueError:
             raise BadValueError(
                 'Items of %s dict must all be in %s' %
@@ -427,7 +639,7 @@ class DictProperty(Property):
         return dict(value)
         
     def to_python(self, value):
-        return LazyDict(value_to_python(value), value)
+        return LazyDict(doc=value)
         
     def to_json(self, value):
         return value_to_json(value)
@@ -460,19 +672,30 @@ class ListProperty(Property):
             required=required, **kwds)
         
     data_type = list
-        
-    def validate(self, value, required=True):
-        value = super(ListProperty, self).validate(value, required=required)
-        if value and value is not None:
-            if not isinstance(value, list):
-                raise BadValueError('Property %s must be a list' % self.name)
-            value = self.validate_list_contents(value)
-        return value
+    cache_python = True
+    mutable = True
+
+    check_empty_type = False
+
+    @property
+    def value_types(self):
+        # the proxies are defined below
+        return LIST_TYPES
+
+    def type_error(self, value):
+        return 'Property %s must be a list' % self.name
+
+    def items_check(self):
+        if type(self).validate_list_contents.im_func is not \
+                ListProperty.validate_list_contents.im_func:
+            return self.validate_list_contents
+        return compile_content_check(item_type=self.item_type,
+                message='Items of %s list must all be in %s' % (self.name,
+                    ALLOWED_PROPERTY_TYPES))
         
     def validate_list_contents(self, value):
-        value = validate_list_content(value, item_type=self.item_type)
         try:
-            value = validate_list_content(value, item_type=self.item_type)
+            check_content(value, item_type=self.item_type)
         except BadValueError:
             raise BadValueError(
                 'Items of %s list must all be in %s' %
@@ -495,7 +718,7 @@ class ListProperty(Property):
         return list(value)
         
     def to_python(self, value):
-        return LazyList(value_to_python(value, item_type=self.item_type), value, item_type=self.item_type)
+        return LazyList(doc=value, item_type=self.item_type)
         
     def to_json(self, value):
         return value_to_json(value, item_type=self.item_type)
@@ -513,91 +736,296 @@ class StringListProperty(ListProperty):
 
 # structures proxy
 
+# marks a missing value
+_MISSING = object()
+
+def _to_python_item(proxy, raw):
+    """ convert a json value stored in a proxy, containers are wrapped in
+    a new proxy """
+    if isinstance(raw, dict):
+        value = LazyDict(doc=raw, item_type=proxy.item_type,
+                keep_values=proxy.keep_values)
+    elif isinstance(raw, list):
+        value = LazyList(doc=raw, item_type=proxy.item_type,
+                keep_values=proxy.keep_values)
+    elif isinstance(raw, basestring):
+        return value_to_python(raw, item_type=proxy.item_type)
+    else:
+        return raw
+    value._parent = proxy
+    return value
+
+def _from_python_item(proxy, value):
+    """ return the json value stored in a proxy for `value` and the python
+    value kept for it, containers are copied in a new proxy """
+    if isinstance(value, dict):
+        raw = {}
+        value = LazyDict(value, raw, item_type=proxy.item_type,
+                keep_values=proxy.keep_values)
+    elif isinstance(value, list):
+        raw = []
+        value = LazyList(value, raw, item_type=proxy.item_type,
+                keep_values=proxy.keep_values)
+    else:
+        raw = value_to_json(value, item_type=proxy.item_type)
+        if proxy.keep_values:
+            return raw, value
+        return raw, _to_python_item(proxy, raw)
+    value._parent = proxy
+    return raw, value
+
 class LazyDict(dict):
-    """ object to make sure we keep updated of dict 
-    in _doc. We just override a dict and maintain change in
-    doc reference (doc[keyt] obviously).
+    """ dict of the python values of a dict of the document json (`doc`).
+    Values are converted when the proxy is built and every change is
+    written to `doc`. Nested dicts and lists are proxies too. Values with
+    nothing to convert are the objects stored in `doc`.
+
+    `_sync` updates the proxy after `doc` has been changed directly, it's
+    called when the proxy is read from its document.
+
+    With `keep_values`, values set are kept as is instead of being
+    read back from their json.
     """
 
-    def __init__(self, d, doc, item_type=None):
+    _owner = None
+    # proxy containing this one
+    _parent = None
+
+    def __init__(self, d=None, doc=None, item_type=None, owner=None,
+            keep_values=False):
         dict.__init__(self)
-        self.item_type = item_type
-        d = d or {}
+        if doc is None:
+            doc = {}
         self.doc = doc
-        for key, value in d.items():
-            self[key] = value
+        self.item_type = item_type
+        self.keep_values = keep_values
+        # (document, property name) notified of changes
+        self._owner = owner
+        self._load({}, {})
+        if d:
+            for key, value in d.items():
+                self[key] = value
+
+    def _load(self, raws, values):
+        """ convert items of `doc`. `values` are the python values of
+        `raws`, the json of the items, kept when an item is unchanged """
+        nested = False
+        for key, raw in self.doc.iteritems():
+            value = values.get(key, _MISSING)
+            if value is _MISSING or raws.get(key, _MISSING) is not raw:
+                value = _to_python_item(self, raw)
+            elif isinstance(value, (LazyDict, LazyList)):
+                value._sync()
+            if isinstance(value, (LazyDict, LazyList)):
+                nested = True
+            dict.__setitem__(self, key, value)
+        # json values of the items, to find changes made to `doc`
+        self._raws = dict(self.doc)
+        self._nested = nested
+
+    def _sync(self):
+        doc = self.doc
+        raws = self._raws
+        if raws == doc and False not in map(operator.is_,
+                map(raws.get, doc), doc.itervalues()):
+            if self._nested:
+                for value in dict.itervalues(self):
+                    if isinstance(value, (LazyDict, LazyList)):
+                        value._sync()
+            return
+        values = dict.copy(self)
+        dict.clear(self)
+        self._load(raws, values)
+
+    def _changed(self):
+        if self._parent is not None:
+            self._parent._changed()
+        elif self._owner is not None:
+            document, name = self._owner
+            document._mark_dirty(name)
 
     def __setitem__(self, key, value):
-        if isinstance(value, dict):
-            self.doc[key] = {}
-            value = LazyDict(value,  self.doc[key], item_type=self.item_type)
-        elif isinstance(value, list):
-            self.doc[key] = []
-            value = LazyList(value,  self.doc[key], item_type=self.item_type)
-        else:
-            self.doc.update({key: value_to_json(value, item_type=self.item_type) })
-        super(LazyDict, self).__setitem__(key, value)
+        raw, value = _from_python_item(self, value)
+        self.doc[key] = raw
+        self._raws[key] = raw
+        if isinstance(value, (LazyDict, LazyList)):
+            self._nested = True
+        dict.__setitem__(self, key, value)
+        self._changed()
 
     def __delitem__(self, key):
         del self.doc[key]
-        super(LazyDict, self).__delitem__(key)
-
-    def pop(self, key, default=None):
-        del self.doc[key]
-        return super(LazyDict, self).pop(key, default=default)
-
-    def setdefault(self, key, default):
-        if key in self:
-            return self[key]  
-        self.doc.setdefault(key, value_to_json(default, item_type=self.item_type))
-        super(LazyDict, self).setdefault(key, default)
-        return default
-
-    def update(self, value):
-        for k, v in value.items():
-            self[k] = v
+        self._raws.pop(key, None)
+        dict.__delitem__(self, key)
+        self._changed()
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = dict.__getitem__(self, key)
+        del self[key]
+        return value
 
-    def popitem(self, value):
-        new_value = super(LazyDict, self).popitem(value)
-        self.doc.popitem(value_to_json(value, item_type=self.item_type))
-        return new_value
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = iter(self).next()
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, other=None, **kwargs):
+        if other is not None:
+            if hasattr(other, 'keys'):
+                for key in other.keys():
+                    self[key] = other[key]
+            else:
+                for key, value in other:
+                    self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
 
     def clear(self):
         self.doc.clear()
-        super(LazyDict, self).clear()
+        self._raws.clear()
+        dict.clear(self)
+        self._changed()
+
+    def __reduce__(self):
+        return (self.__class__, (None, self.doc, self.item_type, None,
+            self.keep_values))
 
 class LazyList(list):
-    """ object to make sure we keep update of list 
-    in _doc. We just override a dict and maintain change in
-    doc reference (doc[keyt] obviously).
+    """ list of the python values of a list of the document json (`doc`).
+    Items are converted when the proxy is built and every change is
+    written to `doc`. Nested dicts and lists are proxies too. Items with
+    nothing to convert are the objects stored in `doc`.
+
+    `_sync` updates the proxy after `doc` has been changed directly, it's
+    called when the proxy is read from its document. Changes to the
+    length of `doc` are also found before the list is changed.
+
+    With `keep_values`, items set are kept as is instead of being
+    read back from their json.
     """
 
-    def __init__(self, l, doc, item_type=None):
-        self.item_type = item_type
-        l = l or []
-        list.__init__(self, l)
+    _owner = None
+    # proxy containing this one
+    _parent = None
+
+    def __init__(self, l=None, doc=None, item_type=None, owner=None,
+            keep_values=False):
+        list.__init__(self)
+        if doc is None:
+            doc = []
         self.doc = doc
-        for idx, item in enumerate(l):
-            try:
-                current = self.doc[idx]
-            except IndexError:
-                self.doc.append('')
-            self[idx] = item
-            
+        self.item_type = item_type
+        self.keep_values = keep_values
+        # (document, property name) notified of changes
+        self._owner = owner
+        self._load([], [])
+        if l:
+            self.extend(l)
+
+    def _load(self, raws, values):
+        """ convert items of `doc`. `values` are the python values of
+        `raws`, the json of the items, kept when an item is unchanged """
+        kept = {}
+        for raw, value in zip(raws, values):
+            kept[id(raw)] = value
+        items = []
+        nested = False
+        for raw in self.doc:
+            value = kept.get(id(raw), _MISSING)
+            if value is _MISSING:
+                value = _to_python_item(self, raw)
+            elif isinstance(value, (LazyDict, LazyList)):
+                value._sync()
+            if isinstance(value, (LazyDict, LazyList)):
+                nested = True
+            items.append(value)
+        list.__setitem__(self, slice(None), items)
+        # json values of the items, to find changes made to `doc`
+        self._raws = list(self.doc)
+        self._nested = nested
+
+    def _sync(self):
+        doc = self.doc
+        raws = self._raws
+        if len(raws) == len(doc) and \
+                False not in map(operator.is_, raws, doc):
+            if self._nested:
+                for value in list.__iter__(self):
+                    if isinstance(value, (LazyDict, LazyList)):
+                        value._sync()
+            return
+        self._load(raws, list.__getslice__(self, 0, len(raws)))
+
+    def _check(self):
+        # items of `doc` aren't at the same index anymore
+        if len(self._raws) != len(self.doc):
+            self._sync()
+
+    def _changed(self):
+        if self._parent is not None:
+            self._parent._changed()
+        elif self._owner is not None:
+            document, name = self._owner
+            document._mark_dirty(name)
+
+    def _set_nested(self, values):
+        for value in values:
+            if isinstance(value, (LazyDict, LazyList)):
+                self._nested = True
+                break
+
+    def __setitem__(self, index, value):
+        self._check()
+        if isinstance(index, slice):
+            items = [_from_python_item(self, item) for item in value]
+            raws = [raw for raw, item in items]
+            values = [item for raw, item in items]
+            self.doc[index] = raws
+            self._raws[index] = raws
+            list.__setitem__(self, index, values)
+            self._set_nested(values)
+        else:
+            raw, value = _from_python_item(self, value)
+            self.doc[index] = raw
+            self._raws[index] = raw
+            list.__setitem__(self, index, value)
+            self._set_nested([value])
+        self._changed()
+
+    def __setslice__(self, i, j, value):
+        self[max(0, i):max(0, j):] = value
+
     def __delitem__(self, index):
+        self._check()
         del self.doc[index]
+        del self._raws[index]
         list.__delitem__(self, index)
+        self._changed()
 
-    def __setitem__(self, index, value):
-        if isinstance(value, dict):
-            self.doc[index] = {}
-            value = LazyDict(value, self.doc[index], item_type=self.item_type)
-        elif isinstance(value, list):
-            self.doc[index] = []
-            value = LazyList(value, self.doc[index], item_type=self.item_type)
-        else:
-            self.doc[index] = value_to_json(value, item_type=self.item_type)
-        list.__setitem__(self, index, value)
+    def __delslice__(self, i, j):
+        del self[max(0, i):max(0, j):]
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, count):
+        self[:] = list(self) * count
+        return self
+
+    def __reduce__(self):
+        return (self.__class__, (None, self.doc, self.item_type, None,
+            self.keep_values))
 
     def append(self, *args, **kwargs):
         if args:
@@ -605,18 +1033,71 @@ class LazyList(list):
             value = args[0]
         else:
             value = kwargs
+        self._check()
+        raw, value = _from_python_item(self, value)
+        self.doc.append(raw)
+        self._raws.append(raw)
+        list.append(self, value)
+        self._set_nested([value])
+        self._changed()
+
+    def extend(self, values):
+        self._check()
+        items = [_from_python_item(self, value) for value in values]
+        raws = [raw for raw, item in items]
+        values = [item for raw, item in items]
+        self.doc.extend(raws)
+        self._raws.extend(raws)
+        list.extend(self, values)
+        self._set_nested(values)
+        self._changed()
+
+    def insert(self, index, value):
+        self._check()
+        raw, value = _from_python_item(self, value)
+        self.doc.insert(index, raw)
+        self._raws.insert(index, raw)
+        list.insert(self, index, value)
+        self._set_nested([value])
+        self._changed()
+
+    def pop(self, index=-1):
+        self._check()
+        self.doc.pop(index)
+        self._raws.pop(index)
+        value = list.pop(self, index)
+        self._changed()
+        return value
+
+    def remove(self, value):
+        del self[self.index(value)]
+
+    def reverse(self):
+        self._check()
+        self.doc.reverse()
+        self._raws.reverse()
+        list.reverse(self)
+        self._changed()
+
+    def sort(self, cmp=None, key=None, reverse=False):
+        # json values are moved with their python value, nothing is
+        # converted again
+        self._check()
+        items = zip(list.__getslice__(self, 0, len(self._raws)),
+                self._raws)
+        if key is None:
+            key = lambda value: value
+        items.sort(cmp=cmp, key=lambda item: key(item[0]), reverse=reverse)
+        raws = [raw for value, raw in items]
+        list.__setitem__(self, slice(None), [value for value, raw in items])
+        self._raws = raws
+        self.doc[:] = raws
+        self._changed()
+
+LIST_TYPES = (list, LazyList)
+DICT_TYPES = (dict, LazyDict)
+CONTAINER_TYPES = LIST_TYPES + DICT_TYPES
 
-        index = len(self)
-        if isinstance(value, dict):
-            self.doc.append({})
-            value = LazyDict(value, self.doc[index], item_type=self.item_type)
-        elif isinstance(value, list):
-            self.doc.append([])
-            value = LazyList(value, self.doc[index], item_type=self.item_type)
-        else:
-            self.doc.append(value_to_json(value, item_type=self.item_type))
-        super(LazyList, self).append(value)
-        
 # some mapping
  
 MAP_TYPES_PROPERTIES = {
@@ -634,10 +1115,14 @@ MAP_TYPES_PROPERTIES = {
         dict: DictProperty
 }           
             
+# properties used to convert values, they don't keep any state
+_CONVERT_PROPERTIES = dict([(data_type, property_class()) for \
+        data_type, property_class in MAP_TYPES_PROPERTIES.items()])
+
 def convert_property(value):
     """ convert a value to json from Property._to_json """
-    if type(value) in MAP_TYPES_PROPERTIES:
-        prop = MAP_TYPES_PROPERTIES[type(value)]()
+    prop = _CONVERT_PROPERTIES.get(type(value))
+    if prop is not None:
         value = prop.to_json(value)
     return value
 
@@ -661,11 +1146,58 @@ def validate_dict_content(value, item_type=None):
     return dict([(k, validate_content(v, 
                 item_type=item_type)) for k, v in value.iteritems()])
            
+def compile_content_check(item_type=None, message=None):
+    """ return a function testing if types of values in a list or a dict
+    are supported, like `validate_content` but without building a copy of
+    the value. The accepted types are computed once.
+
+    @param item_type: type expected for the values
+    @param message: message of the error raised instead of the default
+    one
+    """
+    if item_type is not None:
+        accepted = frozenset([item_type])
+        error = 'Items  must all be in %s' % item_type
+    else:
+        accepted = frozenset(ALLOWED_PROPERTY_TYPES)
+        error = 'Items  must all be in %s' % (ALLOWED_PROPERTY_TYPES)
+    if message is not None:
+        error = message
+    # containers are walked, even with an item_type of list or dict
+    scalars = accepted.difference([list, dict])
+
+    def check(value):
+        stack = [value]
+        while stack:
+            container = stack.pop()
+            if isinstance(container, DICT_TYPES):
+                items = container.itervalues()
+            else:
+                items = container
+            for item in items:
+                if type(item) in scalars:
+                    continue
+                elif isinstance(item, CONTAINER_TYPES):
+                    stack.append(item)
+                else:
+                    raise BadValueError(error)
+    return check
+
+_CONTENT_CHECKS = {}
+
+def check_content(value, item_type=None):
+    """ test if types of values in a list or a dict are supported,
+    like `validate_content` but without building a copy of the value """
+    check = _CONTENT_CHECKS.get(item_type)
+    if check is None:
+        check = _CONTENT_CHECKS[item_type] = compile_content_check(item_type)
+    check(value)
+
 def validate_content(value, item_type=None):
     """ validate a value. test if value is in supported types """
-    if isinstance(value, list):
+    if isinstance(value, LIST_TYPES):
         value = validate_list_content(value, item_type=item_type)
-    elif isinstance(value, dict):
+    elif isinstance(value, DICT_TYPES):
         value = validate_dict_content(value, item_type=item_type)
     elif item_type is not None and type(value) != item_type:
         raise BadValueError(
@@ -690,13 +1222,16 @@ def value_to_json(value, item_type=None):
     
     """
     if isinstance(value, datetime.datetime) and is_type_ok(item_type, datetime.datetime):
-        value = value.replace(microsecond=0).isoformat() + 'Z'
+        value = format_datetime(value)
     elif isinstance(value, datetime.date) and is_type_ok(item_type, datetime.date):
-        value = value.isoformat()
+        value = format_date(value)
     elif isinstance(value, datetime.time) and is_type_ok(item_type, datetime.time):
-        value = value.replace(microsecond=0).isoformat()
+        value = format_time(value)
     elif isinstance(value, decimal.Decimal) and is_type_ok(item_type, decimal.Decimal):
         value = unicode(value) 
+    elif isinstance(value, (LazyList, LazyDict)):
+        # copy of the stored json
+        value = value_to_json(value.doc)
     elif isinstance(value, list):
         value = list_to_json(value, item_type)
     elif isinstance(value, dict):
@@ -707,37 +1242,106 @@ def is_type_ok(item_type, value_type):
     return item_type is None or item_type == value_type
     
     
-def value_to_python(value, item_type=None):
+# converters used for strings recognized by `infer_type`, with the regexp
+# matching them. They are stateless and shared.
+PYTHON_CONVERTERS = {
+    datetime.date: (re_date, parse_date),
+    datetime.time: (re_time, parse_time),
+    datetime.datetime: (re_datetime, parse_datetime),
+    decimal.Decimal: (re_decimal, decimal.Decimal)
+}
+
+def infer_type(value, item_type=None):
+    """ return the python type of a json string saved via `value_to_json`
+    (date, time, datetime or Decimal) or None if it is a plain string.
+    """
+    # all formats start with a digit and are at least 3 chars long, most
+    # strings are rejected here without running any regexp.
+    size = len(value)
+    if size < 3 or not '0' <= value[0] <= '9':
+        return None
+    if 8 <= size <= 10 and is_type_ok(item_type, datetime.date) and \
+            re_date.match(value):
+        return datetime.date
+    if 4 <= size <= 12 and is_type_ok(item_type, datetime.time) and \
+            re_time.match(value):
+        return datetime.time
+    if size >= 8 and is_type_ok(item_type, datetime.datetime) and \
+            re_datetime.match(value):
+        return datetime.datetime
+    if is_type_ok(item_type, decimal.Decimal) and re_decimal.match(value):
+        return decimal.Decimal
+    return None
+
+def _string_to_python(value, item_type=None, type_hints=None, name=None):
+    if type_hints is not None:
+        data_type = type_hints.get(name)
+        if data_type is not None:
+            regexp, converter = PYTHON_CONVERTERS[data_type]
+            if regexp.match(value):
+                try:
+                    return converter(value)
+                except:
+                    pass
+
+    data_type = infer_type(value, item_type=item_type)
+    if data_type is None:
+        return value
+    try: 
+        #sometimes regex fail so return value
+        value = PYTHON_CONVERTERS[data_type][1](value)
+    except:
+        return value
+    if type_hints is not None:
+        type_hints[name] = data_type
+    return value
+
+def _container_to_python(value, item_type=None):
+    # convert nested lists and dicts using a stack instead of recursion
+    if isinstance(value, list):
+        root = list(value)
+    else:
+        root = dict(value)
+    stack = [root]
+    while stack:
+        container = stack.pop()
+        if isinstance(container, list):
+            keys = xrange(len(container))
+        else:
+            keys = container.keys()
+        for key in keys:
+            item = container[key]
+            if isinstance(item, basestring):
+                container[key] = _string_to_python(item, item_type=item_type)
+            elif isinstance(item, list):
+                item = container[key] = list(item)
+                stack.append(item)
+            elif isinstance(item, dict):
+                item = container[key] = dict(item)
+                stack.append(item)
+    return root
+
+def value_to_python(value, item_type=None, type_hints=None, name=None):
     """ convert a json value to python type using regexp. values converted
     have been put in json via `value_to_json` .
+
+    @param value: json value
+    @param item_type: type expected for the values
+    @param type_hints: dict, types previously found for strings by name.
+    The hinted type of `name` is tried first and the dict is updated.
+    @param name: name of the value in `type_hints`
     """
-    data_type = None
     if isinstance(value, basestring):
-        if re_date.match(value) and is_type_ok(item_type, datetime.datetime):
-            data_type = datetime.date
-        elif re_time.match(value) and is_type_ok(item_type, datetime.date):
-            data_type = datetime.time
-        elif re_datetime.match(value) and is_type_ok(item_type, datetime.time):
-            data_type = datetime.datetime
-        elif re_decimal.match(value) and is_type_ok(item_type, decimal.Decimal):
-            data_type = decimal.Decimal
-        if data_type is not None:
-            prop = MAP_TYPES_PROPERTIES[data_type]()
-            try: 
-                #sometimes regex fail so return value
-                value = prop.to_python(value)
-            except:
-                pass           
-    elif isinstance(value, list):
-        value = list_to_python(value, item_type=item_type)
-    elif isinstance(value, dict):
-        value = dict_to_python(value, item_type=item_type)
+        return _string_to_python(value, item_type=item_type,
+                type_hints=type_hints, name=name)
+    elif isinstance(value, (list, dict)):
+        return _container_to_python(value, item_type=item_type)
     return value
     
 def list_to_python(value, item_type=None):
     """ convert a list of json values to python list """
-    return [value_to_python(item, item_type=item_type) for item in value]
+    return _container_to_python(list(value), item_type=item_type)
     
 def dict_to_python(value, item_type=None):
     """ convert a json object values to python dict """
-    return dict([(k, value_to_python(v, item_type=item_type)) for k, v in value.iteritems()])
+    return _container_to_python(dict(value), item_type=item_type)
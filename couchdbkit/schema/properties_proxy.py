@@ -86,6 +86,12 @@ class SchemaProperty(Property):
             
         self._use_instance = use_instance
         self._schema = schema
+
+        # instances share their json with the documents using them, the
+        # wrapped value is only cached when the schema is a class.
+        self.cache_python = not use_instance
+
+    mutable = True
         
     def default_value(self):
         if not self._use_instance:
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008-2009 Benoit Chesneau <benoitc@e-engura.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Unit of work for documents. A session keeps one instance per document id
+and sends all saves and deletes in one `_bulk_docs` request:
+
+    >>> from couchdbkit import Session
+    >>> session = Session(db)
+    >>> greeting = session.get(Greeting, 'someid')
+    >>> session.get(Greeting, 'someid') is greeting # no request
+    True
+    >>> greeting.content = "hello"
+    >>> session.add(greeting)
+    >>> session.add(Greeting(content="world"))
+    >>> session.flush()
+    []
+
+Instances are kept with weak references, a document no longer used by
+the application is loaded again on next read. Documents waiting for a
+flush are kept until they are saved.
+"""
+
+import weakref
+
+from couchdbkit.schema.base import DocumentBase
+
+__all__ = ['Session']
+
+class Session(object):
+    """ Identity map and pending changes of documents of a database """
+
+    def __init__(self, db):
+        """
+        @param db: couchdbkit.client.Database instance
+        """
+        self.db = db
+        # loaded instances by document id
+        self.identity_map = weakref.WeakValueDictionary()
+        # documents waiting for a flush, by id() of the instances
+        self._to_save = {}
+        self._to_delete = {}
+
+    def _register(self, doc):
+        docid = doc._doc.get('_id')
+        if docid is None:
+            return doc
+        current = self.identity_map.get(docid)
+        if current is not None:
+            return current
+        self.identity_map[docid] = doc
+        return doc
+
+    def __contains__(self, docid):
+        return docid in self.identity_map
+
+    def get(self, cls, docid):
+        """ get document with `docid`, the database is only requested
+        when the document isn't already loaded in the session.
+
+        @param cls: Document class used to wrap the document
+        @param docid: str, document id
+        @return: instance of `cls`
+        """
+        doc = self.identity_map.get(docid)
+        if doc is None:
+            doc = self.db.get(docid, wrapper=cls.wrap)
+            self.identity_map[docid] = doc
+        elif not isinstance(doc, cls):
+            raise TypeError("document %s is already loaded as %s" % (docid,
+                doc.__class__.__name__))
+        return doc
+
+    def view(self, cls, view_name, **params):
+        """ get view results wrapped with `cls`. Documents already loaded
+        in the session are returned instead of the new instances.
+
+        @param cls: Document class used to wrap the rows
+        @param view_name: str, name of view
+        @param params: params of the view
+        @return: :class:`couchdbkit.client.ViewResults` instance
+        """
+        def wrapper(row):
+            obj = cls.wrap_row(row)
+            # rows which aren't documents, dicts or `row_class` instances
+            if not isinstance(obj, DocumentBase):
+                return obj
+            return self._register(obj)
+        return self.db.view(view_name, wrapper=wrapper, **params)
+
+    def add(self, doc):
+        """ save `doc` on next flush. Unchanged documents already saved
+        are not sent. A ValueError is raised if another instance of the
+        document is already loaded in the session.
+
+        @param doc: Document instance
+        """
+        if self._register(doc) is not doc:
+            raise ValueError("another instance of document %s is already "
+                "loaded in the session" % doc._doc['_id'])
+        self._to_delete.pop(id(doc), None)
+        self._to_save[id(doc)] = doc
+
+    def delete(self, doc):
+        """ delete `doc` on next flush
+
+        @param doc: Document instance
+        """
+        self._to_save.pop(id(doc), None)
+        if doc._doc.get('_rev') is not None:
+            self._to_delete[id(doc)] = doc
+
+    def clear(self):
+        """ forget loaded documents and pending changes """
+        self.identity_map.clear()
+        self._to_save.clear()
+        self._to_delete.clear()
+
+    def flush(self, all_or_nothing=False):
+        """ save and delete pending documents with one request.
+
+        @param all_or_nothing: see `couchdbkit.client.Database.bulk_save`
+        @return: list of (doc, result) of documents not saved, like on
+        conflict. These documents stay pending.
+        @raise BadValueError: if documents to save aren't valid, see
+        `couchdbkit.schema.Document.validate_many`. Nothing is sent.
+        """
+        to_save = []
+        for key, doc in self._to_save.items():
+            if doc._doc.get('_rev') is None or doc.is_dirty():
+                to_save.append(doc)
+            else:
+                del self._to_save[key]
+        if to_save:
+            DocumentBase.validate_many(to_save)
+        to_delete = self._to_delete.values()
+        if not to_save and not to_delete:
+            return []
+
+        docs = [doc._doc for doc in to_save]
+        for doc in to_delete:
+            docs.append({ '_id': doc._doc['_id'], '_rev': doc._doc['_rev'],
+                '_deleted': True })
+        results = self.db.bulk_save(docs, all_or_nothing=all_or_nothing)
+
+        errors = []
+        for doc, result in zip(to_save + to_delete, results):
+            if 'error' in result:
+                errors.append((doc, result))
+            elif id(doc) in self._to_save:
+                del self._to_save[id(doc)]
+                doc._clear_dirty()
+                self.identity_map[result['id']] = doc
+            else:
+                del self._to_delete[id(doc)]
+                if self.identity_map.get(result['id']) is doc:
+                    del self.identity_map[result['id']]
+                del doc._doc['_id']
+                del doc._doc['_rev']
+        return errors
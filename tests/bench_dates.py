@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008-2009 Benoit Chesneau <benoitc@e-engura.com> 
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""
+Benchmark of date properties: wrap documents with a datetime, a date and
+a time property plus a dynamic date, like view results, then read or set
+the fields. No server is needed:
+
+    $ python tests/bench_dates.py [number of docs]
+"""
+
+import datetime
+import sys
+import time
+
+from couchdbkit.schema import Document, DateTimeProperty, DateProperty, \
+TimeProperty
+
+class Event(Document):
+    created = DateTimeProperty()
+    day = DateProperty()
+    hour = TimeProperty()
+
+def make_rows(count):
+    rows = []
+    for i in xrange(count):
+        rows.append({
+            '_id': 'event%s' % i,
+            'doc_type': 'Event',
+            'created': '2009-02-%02dT18:%02d:%02dZ' % (i % 28 + 1, i % 60,
+                (i // 60) % 60),
+            'day': '2009-02-%02d' % (i % 28 + 1),
+            'hour': '18:%02d:%02d' % (i % 60, (i // 60) % 60),
+            'published': '2010-03-%02d' % (i % 28 + 1)
+        })
+    return rows
+
+def bench_read(rows):
+    for row in rows:
+        doc = Event.wrap(row)
+        doc.created, doc.day, doc.hour, doc.published
+
+def bench_set(rows):
+    now = datetime.datetime(2009, 2, 6, 18, 58, 20)
+    today = now.date()
+    hour = now.time()
+    for row in rows:
+        doc = Event.wrap(row)
+        doc.created = now
+        doc.day = today
+        doc.hour = hour
+        doc.published = today
+
+def run(name, func, count, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        # wrapped documents use the rows as their json
+        rows = make_rows(count)
+        start = time.time()
+        func(rows)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-14s %.2fs" % (name + ':', best)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 20000
+    print "%s docs" % count
+    run("wrap + read", bench_read, count)
+    run("wrap + set", bench_set, count)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008-2009 Benoit Chesneau <benoitc@e-engura.com> 
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""
+Benchmark of the type inference of dynamic values: convert lists and
+dicts of 20 strings, mostly plain text with a few dates, like the
+dynamic properties of wrapped documents. No server is needed:
+
+    $ python tests/bench_infer.py [number of conversions]
+"""
+
+import sys
+import time
+
+from couchdbkit.schema import value_to_python
+
+WORDS = ['hello', 'world', 'a', 'couchdb', '', 'x1', 'plain text value',
+        '1 apple', 'https://example.com/', 'ok', 'no', 'yes', 'test',
+        'document', 'view', 'key']
+
+def make_values(count):
+    values = []
+    for i in xrange(count):
+        items = [WORDS[(i + j) % len(WORDS)] for j in xrange(16)]
+        items.extend(['2009-02-%02d' % (i % 28 + 1), '18:%02d:00' % (i % 60),
+            '2009-02-06T18:%02d:20Z' % (i % 60), '%s' % i])
+        values.append(items)
+    return values
+
+def bench_list(values):
+    for value in values:
+        value_to_python(value)
+
+def bench_dict(values):
+    for value in values:
+        value_to_python(dict([('field%s' % j, item) \
+                for j, item in enumerate(value)]))
+
+def run(name, func, count, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        # values are converted in place
+        values = make_values(count)
+        start = time.time()
+        func(values)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-14s %.2fs" % (name + ':', best)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 20000
+    print "%s conversions" % count
+    run("list", bench_list, count)
+    run("dict", bench_dict, count)
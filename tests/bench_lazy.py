@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008-2009 Benoit Chesneau <benoitc@e-engura.com> 
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""
+Benchmark of list properties: wrap documents with a declared and a
+dynamic list of 200 dates, like view results, then read one item of
+each list or append to them. Only wrapping is measured too. No server is
+needed:
+
+    $ python tests/bench_lazy.py [number of docs]
+"""
+
+import datetime
+import sys
+import time
+
+from couchdbkit.schema import Document, ListProperty
+
+class Serie(Document):
+    days = ListProperty()
+
+def make_rows(count):
+    rows = []
+    for i in xrange(count):
+        days = ['2009-%02d-%02d' % (j % 12 + 1, j % 28 + 1) \
+                for j in xrange(200)]
+        rows.append({
+            '_id': 'serie%s' % i,
+            'doc_type': 'Serie',
+            'days': days,
+            'other_days': list(days)
+        })
+    return rows
+
+def bench_wrap(rows):
+    for row in rows:
+        Serie.wrap(row)
+
+def bench_read(rows):
+    for row in rows:
+        doc = Serie.wrap(row)
+        doc.days[0], doc.other_days[0]
+
+def bench_append(rows):
+    day = datetime.date(2010, 3, 1)
+    for row in rows:
+        doc = Serie.wrap(row)
+        doc.days.append(day)
+        doc.other_days.append(day)
+
+def run(name, func, count, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        # wrapped documents use the rows as their json
+        rows = make_rows(count)
+        start = time.time()
+        func(rows)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-14s %.2fs" % (name + ':', best)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 2000
+    print "%s docs" % count
+    run("wrap", bench_wrap, count)
+    run("wrap + read", bench_read, count)
+    run("wrap + append", bench_append, count)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008-2009 Benoit Chesneau <benoitc@e-engura.com> 
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""
+Benchmark of attribute assignment on documents: set 4 declared
+properties, then 4 dynamic properties, of one document. No server is
+needed:
+
+    $ python tests/bench_setattr.py [number of assignments]
+"""
+
+import sys
+import time
+
+from couchdbkit.schema import Document, StringProperty, IntegerProperty, \
+FloatProperty, BooleanProperty
+
+class Item(Document):
+    name = StringProperty()
+    count = IntegerProperty()
+    price = FloatProperty()
+    available = BooleanProperty()
+
+def bench_declared(count):
+    doc = Item()
+    for i in xrange(count):
+        doc.name = 'item'
+        doc.count = i
+        doc.price = 1.5
+        doc.available = True
+
+def bench_dynamic(count):
+    doc = Item()
+    for i in xrange(count):
+        doc.color = 'red'
+        doc.size = i
+        doc.weight = 1.5
+        doc.fragile = True
+
+def run(name, func, count, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func(count)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-14s %.2fs" % (name + ':', best)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 20000
+    print "%s x 4 assignments" % count
+    run("declared", bench_declared, count)
+    run("dynamic", bench_dynamic, count)
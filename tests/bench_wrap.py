@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008-2009 Benoit Chesneau <benoitc@e-engura.com> 
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""
+Benchmark of Document.wrap: wrap documents with string, number, boolean,
+list and dict properties plus two dynamic properties, like view results,
+then read the fields. No server is needed:
+
+    $ python tests/bench_wrap.py [number of docs]
+"""
+
+import sys
+import time
+
+from couchdbkit.schema import Document, StringProperty, IntegerProperty, \
+FloatProperty, BooleanProperty, ListProperty, DictProperty
+
+class Post(Document):
+    title = StringProperty()
+    author = StringProperty()
+    count = IntegerProperty()
+    score = FloatProperty()
+    published = BooleanProperty()
+    tags = ListProperty()
+    meta = DictProperty()
+
+def make_rows(count):
+    rows = []
+    for i in xrange(count):
+        rows.append({
+            '_id': 'post%s' % i,
+            'doc_type': 'Post',
+            'title': 'title %s' % i,
+            'author': 'author%s' % (i % 100),
+            'count': i,
+            'score': i / 3.0,
+            'published': i % 2 == 0,
+            'tags': ['tag%s' % (i % 10), 'tag%s' % (i % 7)],
+            'meta': { 'lang': 'en', 'words': i % 1000 },
+            'category': 'category%s' % (i % 5),
+            'rank': i % 50
+        })
+    return rows
+
+def bench_wrap(rows):
+    for row in rows:
+        Post.wrap(row)
+
+def bench_read(rows):
+    for row in rows:
+        doc = Post.wrap(row)
+        doc.title, doc.author, doc.count, doc.score, doc.published, \
+        doc.tags, doc.meta, doc.category, doc.rank
+
+def run(name, func, count, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        # wrapped documents use the rows as their json
+        rows = make_rows(count)
+        start = time.time()
+        func(rows)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-14s %.2fs" % (name + ':', best)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 20000
+    print "%s docs" % count
+    run("wrap", bench_wrap, count)
+    run("wrap + read", bench_read, count)
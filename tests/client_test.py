@@ -16,11 +16,19 @@
 #
 __author__ = 'benoitc@e-engura.com (Benoît Chesneau)'
 
+from collections import OrderedDict
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
+import anyjson
+
 from restkit import ResourceNotFound, RequestFailed
 
 from couchdbkit import *
+from couchdbkit.localview import collation_key
 
 class ClientServerTestCase(unittest.TestCase):
     def setUp(self):
@@ -458,6 +466,107 @@ class ClientDatabaseTestCase(unittest.TestCase):
         self.assert_(db.info()['doc_del_count'] == 4)
 
         del self.Server['couchdbkit_test']
+
+    def testExistsMany(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.bulk_save([{'_id': 'test%s' % i} for i in range(4)])
+        db.delete_doc('test3')
+        
+        revs = db.revs_many(['test0', 'test3', 'unknown'])
+        self.assert_(revs['test0']['rev'] == db.get('test0')['_rev'])
+        self.assert_(revs['test3']['deleted'] == True)
+        self.assert_(revs['unknown'] is None)
+        exists = db.exists_many(['test0', 'test3', 'unknown'])
+        self.assert_(exists == {'test0': True, 'test3': False, 
+            'unknown': False})
+
+        db.delete_doc(['test0', 'test1', 'unknown'])
+        self.assert_(len(db) == 1)
+        db.bulk_delete(['test2'])
+        self.assert_(len(db) == 0)
+        del self.Server['couchdbkit_test']
+
+    def testUpdateMany(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.save_doc({'_id': 'test', 'n': 0})
+        db.save_doc({'_id': 'test1', 'n': 0})
+        
+        db2 = self.Server['couchdbkit_test']
+        calls = []
+        def incr(doc):
+            calls.append(doc['_id'])
+            if len(calls) == 1:
+                # concurrent update
+                doc2 = db2.get('test')
+                doc2['n'] = 10
+                db2.save_doc(doc2)
+            doc['n'] = doc.get('n', 0) + 1
+
+        docs = db.update_many(['test', 'test1', 'test2', 'test1'], incr,
+                backoff=0.01)
+        self.assert_(calls == ['test', 'test1', 'test2', 'test'])
+        self.assert_(db.get('test')['n'] == 11)
+        self.assert_(docs['test2']['n'] == 1)
+        doc = db.update_doc('test1', lambda doc: dict(doc, n=42))
+        self.assert_(db.get('test1')['_rev'] == doc['_rev'])
+
+        results = db.bulk_save([{'_id': 'test', 'n': 0}, {'_id': 'test3'}])
+        self.assert_(results[0]['error'] == 'conflict')
+        self.assert_('test3' in db)
+        del self.Server['couchdbkit_test']
+
+    def testUpdateHandler(self):
+        db = self.Server.create_db('couchdbkit_test')
+        UpdateHandlersLoader().sync(db)
+        
+        result, rev = db.update_handler('couchdbkit/increment', 'test',
+                field='hits', by=2)
+        self.assert_(result == 2)
+        doc = db.get('test')
+        self.assert_(doc['_rev'] == rev)
+        self.assert_(doc['hits'] == 2)
+        db.update_handler('couchdbkit/increment', 'test', field='hits')
+        self.assert_(db.get('test')['hits'] == 3)
+        self.assertRaises(RequestFailed, db.update_handler,
+                'couchdbkit/increment', 'test')
+        self.assertRaises(RequestFailed, db.update_handler,
+                'couchdbkit/increment', 'test', field='hits', by='two')
+        self.assert_(db.get('test')['hits'] == 3)
+
+        result, rev = db.update_handler('couchdbkit/patch', 'test',
+                body={'title': 'test', 'hits': None})
+        doc = db.get('test')
+        self.assert_(doc['_rev'] == rev)
+        self.assert_(doc['title'] == 'test')
+        self.assert_('hits' not in doc)
+        del self.Server['couchdbkit_test']
+
+    def testShowAndList(self):
+        db = self.Server.create_db('couchdbkit_test')
+        design_doc = {
+            '_id': '_design/test',
+            'language': 'javascript',
+            'shows': {
+                'title': """function(doc, req) { return doc.title; }"""
+            },
+            'lists': {
+                'titles': """function(head, req) { var row; while (row = getRow()) { send(row.value + "\\n"); } }"""
+            },
+            'views': {
+                'all': {
+                    "map": """function(doc) { if (doc.title) { emit(doc._id, doc.title); }}"""
+                }
+            }
+        }
+        db.save_doc(design_doc)
+        db.bulk_save([{'_id': 'test%s' % i, 'title': 'title%s' % i} for i in range(3)])
+
+        self.assert_(db.show('test/title', 'test1') == 'title1')
+        self.assert_(db.list('test/titles', 'all') == "title0\ntitle1\ntitle2\n")
+        self.assert_(db.list('test/titles', 'all', limit=1) == "title0\n")
+        stream = db.list('test/titles', 'all', keys=['test2'], stream=True)
+        self.assert_("".join(stream) == "title2\n")
+        del self.Server['couchdbkit_test']
         
     def testCopy(self):
         db = self.Server.create_db('couchdbkit_test')
@@ -489,6 +598,103 @@ class ClientDatabaseTestCase(unittest.TestCase):
         
         del self.Server['couchdbkit_test']
 
+    def testGetChanged(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.bulk_save([{'_id': 'test%s' % i} for i in range(4)])
+        revs = dict([(row['id'], row['value']['rev']) for row in db.all_docs()])
+        doc = db.get('test1')
+        db.save_doc(doc)
+        db.delete_doc('test2')
+        revs['test4'] = None
+        revs['unknown'] = '1-abc'
+
+        changed = db.get_changed(revs)
+        self.assert_(sorted(changed.keys()) == ['test1', 'test2', 'unknown'])
+        self.assert_(changed['test1']['_rev'] == doc['_rev'])
+        self.assert_(changed['test2'] is None)
+        self.assert_(changed['unknown'] is None)
+        del self.Server['couchdbkit_test']
+
+    def testDocumentCache(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.doc_cache = cache = DocumentCache(max_entries=10)
+        doc = { '_id': 'test', 'f': 'a' }
+        db.save_doc(doc)
+        doc1 = db.get('test')
+        self.assert_(doc1 == doc)
+        self.assert_(cache.hits == 1)
+        doc1['f'] = 'b'
+        self.assert_(db.get('test')['f'] == 'a')
+
+        db.save_doc(doc1)
+        self.assert_(db.get('test')['_rev'] == doc1['_rev'])
+        self.assert_(cache.hits == 3)
+        db.delete_doc(doc1)
+        self.assertRaises(ResourceNotFound, db.get, 'test')
+        self.assert_(cache.misses == 1)
+
+        db.bulk_save([{'_id': 'test2'}])
+        cache.process_changes(db)
+        db2 = self.Server['couchdbkit_test']
+        doc2 = db2.get('test2')
+        db2.save_doc(doc2)
+        cache.process_changes(db)
+        self.assert_(db.get('test2')['_rev'] == doc2['_rev'])
+
+        # doc posted when no uuid could be fetched
+        def next_uuid(count=None):
+            raise RequestFailed("no uuid")
+        db.server.next_uuid = next_uuid
+        res = anyjson.deserialize(db.save_doc({ 'f': 'c' }, _raw_json=True))
+        self.assert_(db.get(res['id'])['f'] == 'c')
+        del self.Server['couchdbkit_test']
+
+    def testIdFilter(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.bulk_save([{'_id': 'test%s' % i} for i in range(10)])
+        db.id_filter = DocIdFilter(db, capacity=100, refresh_interval=0)
+        self.assert_('test1' in db)
+        self.assert_('unknown' not in db)
+        db.save_doc({'_id': 'test10'})
+        self.assert_('test10' in db)
+
+        db2 = self.Server['couchdbkit_test']
+        db2.save_doc({'_id': 'test11'})
+        self.assert_('test11' in db)
+
+        db.save_doc({'_id': 'test12'}, _raw_json=True)
+        self.assert_(db.id_filter.bloom.metadata['server'] == \
+                self.Server.uri)
+        self.assert_('test12' in db.id_filter.bloom)
+
+        # local documents are never in the filter
+        db2.save_doc({'_id': '_local/test'})
+        db.id_filter.might_contain = lambda docid: False
+        self.assert_('_local/test' in db)
+        self.assert_('test1' not in db)
+        del self.Server['couchdbkit_test']
+
+    def testBloomFilterFile(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, 'not a filter')
+            os.close(fd)
+            self.assertRaises(ValueError, BloomFilter, capacity=100,
+                    path=path)
+            self.assert_(open(path).read() == 'not a filter')
+
+            os.unlink(path)
+            bloom = BloomFilter(capacity=100, path=path)
+            bloom.add('test')
+            bloom.close()
+            self.assertRaises(ValueError, BloomFilter, capacity=1000,
+                    path=path)
+            bloom = BloomFilter(capacity=100, path=path)
+            self.assert_('test' in bloom)
+            bloom.close()
+        finally:
+            os.unlink(path)
+
 
 class ClientViewTestCase(unittest.TestCase):
     def setUp(self):
@@ -719,6 +925,253 @@ class ClientViewTestCase(unittest.TestCase):
 
         del self.Server['couchdbkit_test']
 
+    def testPaginator(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.bulk_save([{'_id': 'test%02d' % i} for i in range(12)])
+
+        paginator = db.all_docs().paginate(5, prefetch=True)
+        page = paginator.page()
+        self.assert_([row['id'] for row in page] == ['test%02d' % i for i in range(5)])
+        self.assert_(page.has_next and not page.has_previous)
+
+        page = paginator.page(page.next_token)
+        self.assert_([row['id'] for row in page] == ['test%02d' % i for i in range(5, 10)])
+        page = page.next()
+        self.assert_([row['id'] for row in page] == ['test10', 'test11'])
+        self.assert_(not page.has_next)
+
+        page = page.previous()
+        self.assert_([row['id'] for row in page] == ['test%02d' % i for i in range(5, 10)])
+        page = page.previous()
+        self.assert_([row['id'] for row in page] == ['test%02d' % i for i in range(5)])
+        self.assert_(not page.has_previous)
+
+        page = db.all_docs(descending=True).paginate(5).page()
+        self.assert_([row['id'] for row in page.next()] == ['test%02d' % i for i in range(6, 1, -1)])
+        del self.Server['couchdbkit_test']
+
+    def testViewCache(self):
+        from couchdbkit.cache import ViewCache
+        db = self.Server.create_db('couchdbkit_test')
+        db.save_doc({'_id': 'test1'})
+        db.view_cache = cache = ViewCache(check_update_seq=True, seq_interval=0)
+
+        self.assert_(len(db.all_docs()) == 1)
+        self.assert_(len(db.all_docs()) == 1)
+        self.assert_(cache.hits == 1 and cache.misses == 1)
+        self.assert_(len(db.all_docs(cache=False)) == 1)
+        self.assert_(cache.hits == 1 and cache.misses == 1)
+        # hits return copies
+        db.all_docs().all()[0]['id'] = 'changed'
+        self.assert_(db.all_docs().all()[0]['id'] == 'test1')
+
+        db.save_doc({'_id': 'test2'})
+        self.assert_(len(db.all_docs()) == 2)
+        self.assert_(cache.misses == 2)
+        del self.Server['couchdbkit_test']
+
+    def testViewRowClass(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.save_doc({'_id': 'test1', 'string': 'test'})
+        db.save_doc({'_id': 'test2', 'string': 'test'})
+
+        rows = db.all_docs(row_class=Row, include_docs=True).all()
+        self.assert_(len(rows) == 2)
+        row = rows[0]
+        self.assert_(isinstance(row, Row))
+        self.assert_(row.id == 'test1' and row['key'] == 'test1')
+        self.assert_(row.doc['string'] == 'test')
+        self.assert_(row.get('error') is None and 'error' not in row)
+        self.assert_(rows == db.all_docs(include_docs=True).all())
+        del self.Server['couchdbkit_test']
+
+    def testMultiView(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.bulk_save([{'_id': 'test%s' % i} for i in range(5)])
+
+        results = db.multi_view([
+            '_all_docs',
+            ('_all_docs', {'limit': 2}),
+            db.all_docs(startkey='test3'),
+            'test/unknown'
+        ])
+        self.assert_(len(results) == 4)
+        self.assert_(len(results[0]) == 5)
+        self.assert_([row['id'] for row in results[1]] == ['test0', 'test1'])
+        self.assert_([row['id'] for row in results[2]] == ['test3', 'test4'])
+        self.assert_(isinstance(results[3], Exception))
+        del self.Server['couchdbkit_test']
+
+    def testViewChunkedKeys(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.bulk_save([{'_id': 'test%s' % i} for i in range(10)])
+
+        keys = ['test5', 'test1', 'unknown', 'test1', 'test7', 'test0']
+        view = View(db, '_all_docs')
+        view.keys_chunk_count = 2
+        results = view(keys=keys)
+        self.assert_(len(results) == 6)
+        self.assert_([row['key'] for row in results] == keys)
+        self.assert_(results.all()[2]['error'] == 'not_found')
+        self.assert_(results.total_rows == 10)
+
+        rows = list(view(keys=keys).stream())
+        self.assert_([row['key'] for row in rows] == keys)
+        rows = view(keys=keys, skip=1, limit=3).all()
+        self.assert_([row['key'] for row in rows] == keys[1:4])
+
+        # one clone per worker
+        db.server.max_size = 2
+        clones = []
+        clone = view._clone
+        def counting_clone():
+            clones.append(1)
+            return clone()
+        view._clone = counting_clone
+        self.assert_([row['key'] for row in view(keys=keys)] == keys)
+        self.assert_(len(clones) == 2)
+
+        # keys returned in another form
+        def post_keys(keys, params):
+            rows = []
+            for key in keys:
+                if isinstance(key, dict):
+                    key = OrderedDict(sorted(key.items(), reverse=True))
+                elif type(key) == int:
+                    key = float(key)
+                rows.append({'key': key, 'value': 1})
+            return {'total_rows': len(rows), 'offset': 0, 'rows': rows}
+        view = View(db, '_all_docs')
+        view.keys_chunk_count = 2
+        view._post_keys = post_keys
+        keys = [1, {'a': 1, 'b': 2}, True, 1, 'x']
+        self.assert_([row['key'] for row in view(keys=keys)] == keys)
+
+        # running chunks are done when an error is raised
+        done = []
+        def failing_post_keys(keys, params):
+            if 'x' in keys:
+                raise ValueError
+            time.sleep(0.05)
+            done.append(keys)
+            return post_keys(keys, params)
+        view._post_keys = failing_post_keys
+        results = view(keys=['x', 1, {'a': 1, 'b': 2}, True])
+        self.assertRaises(ValueError, results.all)
+        self.assert_(len(done) == 1)
+        del self.Server['couchdbkit_test']
+
+    def testViewToColumns(self):
+        db = self.Server.create_db('couchdbkit_test')
+        design_doc = {
+            '_id': '_design/test',
+            'language': 'javascript',
+            'views': {
+                'all': {
+                    "map": """function(doc) { if (doc.docType == "test") { emit([doc.n, doc.name], {"n": doc.n, "half": doc.n / 2}); }}"""
+                },
+                'sparse': {
+                    "map": """function(doc) { if (doc.docType == "test") { emit(doc.n, {"n": doc.n % 2 ? doc.n : null, "name": doc.n ? doc.name : null}); }}"""
+                }
+            }
+        }
+        db.save_doc(design_doc)
+        db.bulk_save([{'_id': 'test%s' % i, 'docType': 'test', 'n': i,
+            'name': 'test'} for i in range(4)])
+
+        columns = db.view('test/all').to_columns(['id', 'key.0', 'key.1',
+            'value.n', 'value.half'])
+        self.assert_(list(columns['id']) == ['test0', 'test1', 'test2', 'test3'])
+        self.assert_(columns['key.0'].typecode == 'l')
+        self.assert_(list(columns['value.n']) == [0, 1, 2, 3])
+        self.assert_(columns['value.half'].typecode == 'd')
+        self.assert_(list(columns['value.half']) == [0, 0.5, 1, 1.5])
+        self.assert_(columns['key.1'][0] is columns['key.1'][3])
+
+        # type given by the first value not None
+        columns = db.view('test/sparse').to_columns(['value.n',
+            'value.name'])
+        self.assert_(columns['value.n'].typecode == 'd')
+        values = list(columns['value.n'])
+        self.assert_(values[0] != values[0] and values[2] != values[2])
+        self.assert_([values[1], values[3]] == [1, 3])
+        self.assert_(columns['value.name'] == [None, 'test', 'test', 'test'])
+        del self.Server['couchdbkit_test']
+
+    def testLocalView(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.bulk_save([{'_id': 'test%s' % i, 'n': i % 2} for i in range(6)])
+
+        def by_n(doc):
+            yield [doc['n'], doc['_id']], 1
+        view = db.local_view(by_n, '_count')
+        self.assert_(view().first()['value'] == 6)
+        results = view(group_level=1).all()
+        self.assert_(results == [{'key': [0], 'value': 3}, 
+            {'key': [1], 'value': 3}])
+        self.assert_(view(group_level=0).all() == [{'key': None,
+            'value': 6}])
+        # objects are compared member by member
+        self.assert_(collation_key(OrderedDict([('b', 1), ('a', 2)])) >
+            collation_key(OrderedDict([('a', 2), ('b', 1)])))
+        self.assert_(collation_key({'b': 1}) < collation_key({'b': 1,
+            'c': None}))
+        rows = view(reduce=False, startkey=[1], endkey=[1, {}], 
+                descending=True).all()
+        self.assert_(rows == [] )
+        rows = view(reduce=False, startkey=[1, {}], endkey=[1], 
+                descending=True, limit=2).all()
+        self.assert_([row['id'] for row in rows] == ['test5', 'test3'])
+
+        db.delete_doc('test5')
+        db.save_doc({'_id': 'test6', 'n': 0})
+        self.assert_(view(group_level=1, stale='ok').all()[0]['value'] == 3)
+        results = view(group_level=1).all()
+        self.assert_(results == [{'key': [0], 'value': 4}, 
+            {'key': [1], 'value': 2}])
+
+        # the index is saved after the build, then on close
+        path = os.path.join(tempfile.mkdtemp(), 'by_n.index')
+        view = db.local_view(by_n, '_count', path=path)
+        self.assert_(view().first()['value'] == 6)
+        seq = db.local_view(by_n, '_count', path=path).update_seq
+        self.assert_(seq == view.update_seq)
+        db.save_doc({'_id': 'test7', 'n': 1})
+        self.assert_(view().first()['value'] == 7)
+        self.assert_(db.local_view(by_n, '_count', path=path).update_seq == seq)
+        view.close()
+        self.assert_(db.local_view(by_n, '_count', path=path).update_seq > seq)
+        shutil.rmtree(os.path.dirname(path))
+        del self.Server['couchdbkit_test']
+
+    def testPromotedTempView(self):
+        db = self.Server.create_db('couchdbkit_test')
+        db.bulk_save([{'_id': 'test%s' % i, 'docType': 'test'} for i in range(3)])
+        design = {
+            "map": """function(doc) { if (doc.docType == "test") { emit(doc._id, doc);
+}}"""
+        }
+        results = db.temp_view(design, promote=True)
+        # saved on the first request only
+        self.assert_(len(db.all_docs(startkey='_design/_auto_',
+                endkey=u'_design/_auto_\ufff0')) == 0)
+        self.assert_(len(results) == 3)
+        ddocs = db.all_docs(startkey='_design/_auto_', 
+                endkey=u'_design/_auto_\ufff0').all()
+        self.assert_(len(ddocs) == 1)
+        self.assert_(len(db.temp_view(design, promote=True)) == 3)
+        self.assert_(db.cleanup_auto_views() == [])
+        self.assert_(db.cleanup_auto_views(max_age=-1) == [ddocs[0]['id']])
+        self.assert_(ddocs[0]['id'] not in db)
+
+        # deleted by another client, saved again on next query
+        self.assert_(len(db.temp_view(design, promote=True)) == 3)
+        db2 = self.Server['couchdbkit_test']
+        self.assert_(db2.cleanup_auto_views(max_age=-1) == [ddocs[0]['id']])
+        self.assert_(len(db.temp_view(design, promote=True)) == 3)
+        self.assert_(ddocs[0]['id'] in db)
+        del self.Server['couchdbkit_test']
+
         
 
 if __name__ == '__main__':
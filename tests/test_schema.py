@@ -18,8 +18,11 @@ __author__ = 'benoitc@e-engura.com (Benoît Chesneau)'
 
 import datetime
 import decimal
+import gc
 import unittest
 
+import anyjson
+
 from couchdbkit import *
 
 class DocumentTestCase(unittest.TestCase):
@@ -120,6 +123,23 @@ class DocumentTestCase(unittest.TestCase):
         doc.test = "test"
         self.assert_('test' in doc)
 
+    def testPropertiesView(self):
+        class Test(Document):
+            string = StringProperty(default="test")
+        doc = Test()
+        doc.test = "test"
+        self.assert_(doc.property_names() == frozenset(['string']))
+        self.assert_('string' in doc.properties_view())
+        self.assert_(doc.dynamic_properties_view().keys() == ['test'])
+        def ftest():
+            doc.dynamic_properties_view()['test2'] = "test"
+        self.assertRaises(Exception, ftest)
+
+        Test.helper = None
+        doc.helper = "test"
+        self.assert_('helper' not in doc.dynamic_properties_view())
+        self.assert_(doc.helper == "test")
+
     def testLen(self):
         class Test(Document):
             string = StringProperty(default="test")
@@ -192,6 +212,151 @@ class DocumentTestCase(unittest.TestCase):
 
         self.server.delete_db('couchdbkit_test')
 
+    def testDirtyTracking(self):
+        db = self.server.create_db('couchdbkit_test')
+        class Blog(DocumentSchema):
+            title = StringProperty()
+
+        class Test(Document):
+            string = StringProperty()
+            l = ListProperty()
+            blog = SchemaProperty(Blog)
+        Test._db = db
+
+        doc = Test(string="test", l=[1, {"a": 2}])
+        doc.save()
+        self.assert_(doc.is_dirty() == False)
+        rev = doc._rev
+        doc.save()
+        self.assert_(doc._rev == rev)
+
+        doc = Test.get(doc._id)
+        self.assert_(doc.is_dirty() == False)
+        doc.l[1]['a'] = 3
+        self.assert_(doc.changed_fields() == set(['l']))
+        doc.blog.title = "title"
+        doc.other = "dynamic"
+        self.assert_(doc.changed_fields() == set(['l', 'blog', 'other']))
+        doc.save()
+        self.assert_(doc._rev != rev)
+        self.assert_(doc.is_dirty() == False)
+
+        doc2 = Test.get(doc._id)
+        self.assert_(doc2.l[1]['a'] == 3)
+        self.assert_(doc2.blog.title == "title")
+        doc2.string = "test2"
+        results = Test.bulk_save([doc, doc2])
+        self.assert_(len(results) == 1)
+        self.assert_(results[0]['id'] == doc2._id)
+        self.assert_(doc2.is_dirty() == False)
+
+        self.server.delete_db('couchdbkit_test')
+
+    def testSession(self):
+        db = self.server.create_db('couchdbkit_test')
+        class Test(Document):
+            string = StringProperty()
+        Test._db = db
+
+        doc = Test(string="test")
+        doc.save()
+
+        session = Session(db)
+        doc1 = session.get(Test, doc._id)
+        self.assert_(session.get(Test, doc._id) is doc1)
+        rows = list(session.view(Test, '_all_docs', include_docs=True))
+        self.assert_(rows == [doc1])
+        rows = list(session.view(Test, '_all_docs', keys=['missing'],
+            row_class=Row))
+        self.assert_(isinstance(rows[0], Row))
+
+        doc1.string = "test1"
+        doc2 = Test(string="test2")
+        session.add(doc1)
+        session.add(doc2)
+        self.assert_(session.flush() == [])
+        self.assert_(doc2._id in session)
+        self.assert_(db.get(doc1._id)['string'] == "test1")
+        self.assert_(db.get(doc2._id)['string'] == "test2")
+
+        # one instance per document id
+        class Other(Document):
+            pass
+        self.assertRaises(TypeError, session.get, Other, doc1._id)
+        doc.string = "conflict"
+        self.assertRaises(ValueError, session.add, doc)
+        self.assert_(session.flush() == [])
+        session.clear()
+
+        # conflict
+        session.add(doc)
+        session.delete(doc2)
+        errors = session.flush()
+        self.assert_(len(errors) == 1)
+        self.assert_(errors[0][0] is doc)
+        self.assert_(errors[0][1]['error'] == "conflict")
+        self.assert_(doc2._id is None)
+        self.assert_(len(db) == 1)
+        self.assert_(len(session.flush()) == 1)
+        session.clear()
+
+        # errors of all documents are reported
+        class Required(Document):
+            string = StringProperty(required=True)
+        bad1, bad2 = Required(), Required()
+        session.add(bad1)
+        session.add(bad2)
+        try:
+            session.flush()
+        except BadValueError, e:
+            self.assert_([d for d, error in e.errors] in ([bad1, bad2],
+                [bad2, bad1]))
+        else:
+            self.fail("documents aren't valid")
+        self.assert_(len(db) == 1)
+
+        self.server.delete_db('couchdbkit_test')
+
+    def testWrapByDocType(self):
+        db = self.server.create_db('couchdbkit_test')
+        class Cat(Document):
+            name = StringProperty()
+        class Dog(Document):
+            doc_type = "dog"
+            name = StringProperty()
+        Cat._db = db
+        Dog._db = db
+
+        Cat(name="cat").save()
+        Dog(name="dog").save()
+        db.save_doc({ "name": "other", "doc_type": "unknown" })
+
+        results = db.view('_all_docs', include_docs=True,
+                wrap_by_doc_type=True)
+        docs = dict((getattr(doc, 'name', None) or doc['doc']['name'], doc)
+                for doc in results)
+        self.assert_(isinstance(docs['cat'], Cat))
+        self.assert_(isinstance(docs['dog'], Dog))
+        self.assert_(isinstance(docs['other'], dict))
+
+        self.assert_(isinstance(wrap_any(db.get(docs['dog']._id)), Dog))
+        row = { 'id': docs['cat']._id, 'value': { 'doc_type': 'Cat',
+            'name': 'cat' } }
+        self.assert_(wrap_any(row)._id == docs['cat']._id)
+
+        self.assertRaises(ValueError, db.view, '_all_docs',
+                wrapper=lambda row: row, wrap_by_doc_type=True)
+
+        # library classes aren't registered and classes aren't kept alive
+        row = { 'doc_type': 'Document' }
+        self.assert_(wrap_any(row) is row)
+        del Dog, docs, results
+        gc.collect()
+        row = { 'doc_type': 'dog' }
+        self.assert_(wrap_any(row) is row)
+
+        self.server.delete_db('couchdbkit_test')
+
  
 
     def testGet(self):
@@ -297,6 +462,40 @@ class DocumentTestCase(unittest.TestCase):
 
         self.assert_(len(doc2._dynamic_properties) == 1)
 
+    def testWrap(self):
+        class TestDoc(Document):
+            field1 = StringProperty()
+            field2 = IntegerProperty(default=4)
+            field3 = DateTimeProperty()
+
+        class TestDoc2(TestDoc):
+            def __init__(self, *args, **kwargs):
+                TestDoc.__init__(self, *args, **kwargs)
+                self._initialized = True
+
+        for cls in (TestDoc, TestDoc2):
+            data = {
+                '_id': 'test',
+                '_rev': '1-abc',
+                'doc_type': 'TestDoc',
+                'field1': 'a',
+                'field3': '2009-01-01T10:00:00Z',
+                'field4': '2009-01-02',
+                'field5': {'a': [1, 2]}
+            }
+            doc = cls.wrap(data)
+            self.assert_(doc._id == 'test')
+            self.assert_(doc.field1 == 'a')
+            self.assert_(doc.field2 == 4)
+            self.assert_(doc.field3 == datetime.datetime(2009, 1, 1, 10, 0, 0))
+            self.assert_(doc.field4 == datetime.date(2009, 1, 2))
+            self.assert_(doc.field5 == {'a': [1, 2]})
+            self.assert_(sorted(doc.dynamic_properties().keys()) ==
+                    ['field4', 'field5'])
+            doc.field5['b'] = 1
+            self.assert_(doc.to_json()['field5'] == {'a': [1, 2], 'b': 1})
+        self.assert_(doc._initialized)
+
     def testView(self):
         class TestDoc(Document):
             field1 = StringProperty()
@@ -558,6 +757,53 @@ class PropertyTestCase(unittest.TestCase):
             test.string = "test"
         self.assertRaises(BadValueError, ftest)
 
+    def testChoices(self):
+        class Test(Document):
+            string = StringProperty(choices=["a", "b"])
+            mixed = DictProperty(default={"a": 1}, choices=[{"a": 1}, {"b": 2}])
+
+        test = Test()
+        test.string = "a"
+        test.mixed = {"b": 2}
+        def ftest():
+            test.string = "c"
+        self.assertRaises(BadValueError, ftest)
+        def ftest2():
+            test.mixed = {"c": 3}
+        self.assertRaises(BadValueError, ftest2)
+
+    def testValidateMany(self):
+        class Test(Document):
+            string = StringProperty(required=True)
+            l = ListProperty()
+
+        docs = [Test(string="a"), Test(), Test(string="c", l=[1, [2, {"a": 3}]]),
+                Test()]
+        try:
+            Test.validate_many(docs)
+        except BadValueError, e:
+            self.assert_([doc for doc, error in e.errors] == [docs[1], docs[3]])
+        else:
+            self.fail("BadValueError not raised")
+        self.assert_(Test.validate_many(docs[:1]))
+
+        def ftest():
+            docs[0].l = [1, [2, set()]]
+        self.assertRaises(BadValueError, ftest)
+
+        # bulk_save only validates when asked
+        Test._db = self.db
+        self.assertRaises(BadValueError, Test.bulk_save, docs, validate=True)
+        self.assert_(len(self.db) == 0)
+        self.assert_(len(Test.bulk_save(docs)) == 4)
+
+        # the plan follows changes of the properties
+        Test.string.choices = ["a", "b"]
+        self.assertRaises(BadValueError, docs[2].validate)
+        Test.string.choices = None
+        Test.string.required = False
+        self.assert_(Test.validate_many(docs))
+
     def testIntegerProperty(self):
         class Test(Document):
             field = IntegerProperty()
@@ -614,6 +860,81 @@ class PropertyTestCase(unittest.TestCase):
         value = test.field
         self.assert_(isinstance(value, datetime.time))
 
+    def testIsoFormats(self):
+        class Test(Document):
+            field = DateTimeProperty()
+            day = DateProperty()
+            at = TimeProperty()
+
+        test = Test.wrap({
+            'field': '2008-11-10T08:00:00.123Z',
+            'day': '2008-11-10',
+            'at': '08:00:00'
+        })
+        self.assert_(test.field == datetime.datetime(2008, 11, 10, 8, 0, 0))
+        self.assert_(test.day == datetime.date(2008, 11, 10))
+        self.assert_(test.at == datetime.time(8, 0, 0))
+
+        test.field = datetime.datetime(2008, 11, 10, 8, 0, 0, 905556)
+        self.assert_(test._doc['field'] == "2008-11-10T08:00:00Z")
+        test.at = datetime.time(8, 0, 0, 905556)
+        self.assert_(test._doc['at'] == "08:00:00")
+
+        test._doc['day'] = '2008-11-31'
+        self.assertRaises(ValueError, getattr, test, 'day')
+
+    def testValueToPython(self):
+        value = value_to_python({
+            'a': ['2008-11-10', {'b': ['08:00:00', 1, None]}],
+            'c': '1.5',
+            'd': 'essai'
+        })
+        self.assert_(value == {
+            'a': [datetime.date(2008, 11, 10), {'b': [datetime.time(8, 0, 0), 1, None]}],
+            'c': decimal.Decimal('1.5'),
+            'd': 'essai'
+        })
+        value = value_to_python(['2008-11-10'], item_type=datetime.date)
+        self.assert_(value == [datetime.date(2008, 11, 10)])
+        value = value_to_python(['2008-11-10'], item_type=unicode)
+        self.assert_(value == ['2008-11-10'])
+
+        class Test(Document):
+            _dynamic_type_hints = True
+
+        test = Test.wrap({'field': '2008-11-10T08:00:00Z'})
+        self.assert_(test.field == datetime.datetime(2008, 11, 10, 8, 0, 0))
+        self.assert_(Test._type_hints == {'field': datetime.datetime})
+        test = Test.wrap({'field': 'essai'})
+        self.assert_(test.field == 'essai')
+
+    def testPropertyCache(self):
+        class MySchema(DocumentSchema):
+            astring = StringProperty()
+
+        class Test(Document):
+            field = DateTimeProperty()
+            price = DecimalProperty()
+            schema = SchemaProperty(MySchema)
+
+        test = Test.wrap({
+            'field': '2008-11-10T08:00:00Z',
+            'price': '1.50',
+            'schema': {'astring': u'test'}
+        })
+        value = test.field
+        self.assert_(value == datetime.datetime(2008, 11, 10, 8, 0, 0))
+        self.assert_(test.field is value)
+        self.assert_(test.price is test.price)
+        self.assert_(test.schema is test.schema)
+
+        test.field = datetime.datetime(2009, 1, 1, 8, 0, 0)
+        self.assert_(test.field == datetime.datetime(2009, 1, 1, 8, 0, 0))
+        test._doc['price'] = '2.00'
+        self.assert_(test.price == decimal.Decimal('2.00'))
+        test.schema.astring = u'other'
+        self.assert_(test._doc['schema']['astring'] == u'other')
+
     def testMixProperties(self):
         class Test(Document):
             field = StringProperty()
@@ -1014,6 +1335,106 @@ class PropertyTestCase(unittest.TestCase):
         self.assertTrue(a2.validate(required=False))
         self.assertTrue(a2.validate())
         
+    def testLazyContainers(self):
+        class A(Document):
+            l = ListProperty()
+
+        data = {'doc_type': 'A', 'l': [1, '2009-05-10', {'a': [1]}],
+                'd': {'a': '21:19:21'}}
+        a = A.wrap(data)
+        self.assert_(a.l[1] == datetime.date(2009, 5, 10))
+        self.assert_(a.d['a'] == datetime.time(21, 19, 21))
+        self.assert_(a.l.doc is data['l'])
+        self.assert_(a.d.doc is data['d'])
+
+        a.l[2]['a'].append(datetime.date(2009, 5, 11))
+        self.assert_(data['l'][2] == {'a': [1, '2009-05-11']})
+        a.l.insert(0, 0)
+        self.assert_(a.l.pop(1) == 1)
+        self.assert_(data['l'] == [0, '2009-05-10', {'a': [1, '2009-05-11']}])
+        a.l[2]['a'].remove(1)
+        a.l[2]['a'].append(datetime.date(2009, 5, 12))
+        a.l[2]['a'].sort(reverse=True)
+        self.assert_(data['l'][2] == {'a': ['2009-05-12', '2009-05-11']})
+        a.d.update({'b': [1]})
+        self.assert_(data['d'] == {'a': '21:19:21', 'b': [1]})
+
+        a.e = a.d
+        a.e['c'] = 1
+        self.assert_('c' not in data['d'])
+        self.assert_(a._doc['e'] == {'a': '21:19:21', 'b': [1], 'c': 1})
+
+        self.assert_(isinstance(a.l, list))
+        self.assert_(isinstance(a.d, dict))
+        a.l = [1, "b", {"c": [2]}]
+        self.assert_(anyjson.deserialize(anyjson.serialize(a.l)) == \
+                [1, "b", {"c": [2]}])
+        a.d = {"c": [1, "d"]}
+        self.assert_(anyjson.deserialize(anyjson.serialize({'d': a.d})) == \
+                {'d': {"c": [1, "d"]}})
+        self.assert_(['a'] + a.l == ['a'] + list(a.l))
+        self.assert_(list(reversed(a.l)) == list(a.l)[::-1])
+
+    def testLazyContainersSync(self):
+        class A(Document):
+            l = ListProperty()
+            d = DictProperty()
+
+        a = A.wrap({'doc_type': 'A', 'l': [1, 2, 3],
+            'd': {'k': '2020-01-01', 'n': {'x': 1}}})
+        self.assert_(len(a.l) == 3)
+        a._doc['l'].append(4)
+        self.assert_(len(a.l) == 4)
+        self.assert_(a.l == [1, 2, 3, 4])
+        a._doc['l'][:] = []
+        self.assert_(list(a.l) == [])
+        l = a.l
+        a._doc['l'].extend([5, 6])
+        l.append(7)
+        self.assert_(l == [5, 6, 7])
+        self.assert_(a._doc['l'] == [5, 6, 7])
+
+        # C-level readers see the python values
+        date = datetime.date(2020, 1, 1)
+        self.assert_(dict(a.d) == {'k': date, 'n': {'x': 1}})
+        self.assert_(a.d.copy()['k'] == date)
+        def f(**kwargs):
+            return kwargs
+        self.assert_(f(**a.d)['k'] == date)
+        a._doc['d']['n']['x'] = 2
+        a._doc['d']['z'] = '2020-01-02'
+        self.assert_(a.d == {'k': date, 'n': {'x': 2},
+            'z': datetime.date(2020, 1, 2)})
+        a.d['n']['y'] = 3
+        self.assert_(a._doc['d']['n'] == {'x': 2, 'y': 3})
+        self.assert_('d' in a.changed_fields())
+
+    def testLazyListIndexes(self):
+        class A(Document):
+            l = ListProperty()
+
+        a = A.wrap({'doc_type': 'A', 'l': [1, 2, 3]})
+        self.assert_(a.l[-3] == 1)
+        def fget():
+            return a.l[-5]
+        self.assertRaises(IndexError, fget)
+        def fset():
+            a.l[-5] = 9
+        self.assertRaises(IndexError, fset)
+        def fdel():
+            del a.l[3]
+        self.assertRaises(IndexError, fdel)
+        self.assert_(a._doc['l'] == [1, 2, 3])
+
+        # like list, insert is bounded
+        a.l.insert(-5, 0)
+        a.l.insert(10, 4)
+        self.assert_(a.l == [0, 1, 2, 3, 4])
+        self.assert_(a._doc['l'] == [0, 1, 2, 3, 4])
+        a.l[-1] = 5
+        self.assert_(a.l.pop(-2) == 3)
+        self.assert_(a._doc['l'] == [0, 1, 2, 5])
+
     def testDynamicDictProperty(self):
         from datetime import datetime
         class A(Document):